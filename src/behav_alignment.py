@@ -0,0 +1,101 @@
+### Maps Bonsai behavioural events onto the z-projected imaging frames that suite2p sees
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+def to_seconds(values):
+    """Converts a column of Bonsai timestamps, either numbers or date strings such as
+    2023-02-01T10:15:02.1234567+00:00, to float seconds. Values that can't be read are NaN."""
+    values = pd.Series(values)
+    numeric = pd.to_numeric(values, errors="coerce")
+    if numeric.notna().any() or values.isna().all():
+        return numeric.to_numpy(dtype=np.float64)
+    times = pd.to_datetime(values, utc=True, errors="coerce")
+    return ((times - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64)
+
+def read_timestamps(path, time_column=0):
+    """Reads a Bonsai csv with or without a header row.
+
+    Args:
+        path (Str or Path object): csv file.
+        time_column (int or str, optional): Position or name of the timestamp column. A header
+            row is assumed if a name is given or the first value can't be read as a time.
+            Defaults to 0.
+
+    Returns:
+        table (DataFrame): The csv, with numeric columns converted to numbers.
+        times (array): Timestamp of each row in seconds.
+
+    Raises:
+        ValueError: If two columns of the header have the same name.
+    """
+    table = pd.read_csv(path, header=None)
+    first = table.iloc[:1]
+    if isinstance(time_column, str) or np.isnan(to_seconds(first.iloc[:, time_column])[0]):
+        table.columns = [str(c) for c in first.iloc[0]]
+        table = table.iloc[1:].reset_index(drop=True)
+        duplicates = sorted(set(table.columns[table.columns.duplicated()]))
+        if duplicates:
+            raise ValueError(f"{Path(path).name} has more than one column named {', '.join(duplicates)}")
+
+    for column in table.columns:
+        numeric = pd.to_numeric(table[column], errors="coerce")
+        if numeric.notna().all():
+            table[column] = numeric
+
+    times = table.iloc[:, time_column] if isinstance(time_column, int) else table[time_column]
+    return table, to_seconds(times)
+
+def column_arrays(table):
+    """Returns the columns of an events table as column_<name> arrays for np.savez, with text
+    columns as strings. The prefix keeps them apart from the fixed keys of the alignment file."""
+    columns = {}
+    for column in table.columns:
+        values = table[column].to_numpy()
+        columns[f"column_{column}"] = values.astype(str) if values.dtype == object else values
+    return columns
+
+def align_events(event_times, frame_times, zplanes=3, temporal_bin=1, n_raw_frames=None):
+    """Finds the raw and z-projected imaging frame of every event at once.
+
+    Raw frame i is projected into frame i // (zplanes * temporal_bin), and frames after the
+    last full (binned) volume are dropped as in remove_leftover_frames. Events before the
+    first frame or after the end of the last full volume get -1.
+
+    Args:
+        event_times (array): Event times in seconds.
+        frame_times (array): Time of each raw imaging frame, in the same clock.
+        zplanes (int, optional): Raw frames per projected frame. Defaults to 3.
+        temporal_bin (int, optional): Projected frames averaged into each frame suite2p
+            reads, from the prep_settings. Defaults to 1.
+        n_raw_frames (int, optional): Raw frames in the tiff, if known, in case the frame
+            file has extra rows. Defaults to None.
+
+    Returns:
+        dict: event_raw_frames and event_frames (int32), and volume_times, the time of the
+            first raw frame of each projected (and binned) frame.
+    """
+    per_frame = zplanes * temporal_bin
+    frame_times = np.asarray(frame_times, dtype=np.float64)
+    event_times = np.asarray(event_times, dtype=np.float64)
+    if n_raw_frames is not None:
+        frame_times = frame_times[:n_raw_frames]
+    if np.any(np.diff(frame_times) < 0):
+        raise ValueError("Frame times are not in order")
+
+    usable = len(frame_times) - len(frame_times) % per_frame
+    # the last frame lasts one frame interval like the others
+    interval = np.median(np.diff(frame_times)) if len(frame_times) > 1 else 0
+    end = frame_times[usable - 1] + interval if usable else -np.inf
+
+    raw = np.searchsorted(frame_times, event_times, side="right") - 1
+    inside = (raw >= 0) & (event_times < end) & ~np.isnan(event_times)
+    raw = np.where(inside, raw, -1)
+    projected = np.where(inside, raw // per_frame, -1)
+
+    return {
+        "event_raw_frames": raw.astype(np.int32),
+        "event_frames": projected.astype(np.int32),
+        "volume_times": frame_times[:usable:per_frame],
+    }
@@ -0,0 +1,267 @@
+### Benchmarks the prep hot path on synthetic ScanImage-like stacks and compares against a stored baseline
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import logging
+import itertools
+import contextlib
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import tifffile
+
+try:
+    import resource
+except ImportError:  # windows, peak memory is not reported
+    resource = None
+
+MB = 1024 ** 2
+
+def peak_rss():
+    """Returns the peak resident memory of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def make_stack(path, nframes, size=512, dtype="uint16", zplanes=3, block=300, seed=0):
+    """Writes a synthetic multi-plane stack like the ones ScanImage saves.
+
+    Planes are interleaved (frame i is plane i % zplanes), each with its own background
+    and a few flickering cells on top of noise. Frames are written uncompressed and
+    contiguous so the file can be memory mapped, the same as raw ScanImage tiffs.
+
+    Args:
+        path (Str or Path object): Tiff to write, skipped if it already exists.
+        nframes (int): Number of raw frames, left as given so leftover frames are included.
+        size (int, optional): Frame height and width. Defaults to 512.
+        dtype (str, optional): uint16 or int16. Defaults to "uint16".
+        zplanes (int, optional): Number of interleaved planes. Defaults to 3.
+        block (int, optional): Frames generated at once. Defaults to 300.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        Path: Path to the stack.
+    """
+    path = Path(path)
+    if path.is_file():
+        return path
+    os.makedirs(path.parent, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    backgrounds = [rng.uniform(200, 600) + 100 * np.sin(xx / size * np.pi * (p + 1)) for p in range(zplanes)]
+
+    # gaussian cells, each with a random activity trace
+    n_cells = 50
+    centres = rng.uniform(0, size, (n_cells, 2))
+    cells = np.exp(-((yy[None] - centres[:, 0, None, None]) ** 2 + (xx[None] - centres[:, 1, None, None]) ** 2) / 30)
+    cells = cells.reshape(n_cells, -1).astype(np.float32)
+
+    # a pool of noise frames reused in a shifting order, generating fresh noise for every frame is too slow
+    noise = rng.normal(0, 40, (64, size, size)).astype(np.float32)
+    info = np.iinfo(dtype)
+
+    def pages():
+        for start in range(0, nframes, block):
+            idx = np.arange(start, min(start + block, nframes))
+            activity = rng.exponential(200, (len(idx), n_cells)).astype(np.float32)
+            frames = (activity @ cells).reshape(len(idx), size, size)
+            frames += np.stack([backgrounds[i % zplanes] for i in idx])
+            frames += noise[(idx * 7) % len(noise)]
+            if dtype == "int16":
+                frames -= 300
+            yield from np.clip(frames, info.min, info.max).astype(dtype)
+
+    # written as one series from a generator so the whole stack is never in memory
+    tmp_path = path.with_suffix(".tmp.tif")
+    tifffile.imwrite(tmp_path, pages(), shape=(nframes, size, size), dtype=dtype, bigtiff=True)
+    os.replace(tmp_path, path)
+    return path
+
+def case_id(case):
+    return "|".join(f"{key}={case[key]}" for key in sorted(case) if key not in ("stack", "out_dir", "repeat"))
+
+def run_case(case):
+    """Runs one benchmark case and returns its timings. Called in a fresh process so the
+    peak memory belongs to this case only."""
+    # imported here so the parent process does not load the processing stack
+    from helper_fx import (Preprocess, TiffStack, TiffChunkWriter, Suite2pBinaryWriter, process_in_chunks,
+                           remove_leftover_frames, reshape_array)
+
+    stack = case["stack"]
+    zplanes = case["zplanes"]
+    out_dir = Path(case["out_dir"])
+    base_rss = peak_rss()
+
+    def load():
+        if case["mode"] == "streaming":
+            return TiffStack(stack)
+        return tifffile.imread(stack)
+
+    im = load()
+    nframes, nbytes = len(im), im.shape[0] * im.shape[1] * im.shape[2] * np.dtype(im.dtype).itemsize
+
+    def run():
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        if case["path"] == "remove_leftover_frames":
+            remove_leftover_frames(im, zplanes=zplanes)
+        elif case["path"] == "reshape_array":
+            reshape_array(remove_leftover_frames(im, zplanes=zplanes), zplanes=zplanes)
+        elif case["path"] == "process_in_chunks":
+            trimmed = remove_leftover_frames(im, zplanes=zplanes)
+            if case["output"] == "binary":
+                writer = Suite2pBinaryWriter(out_dir, case["chunk_size"] // zplanes, halve=im.dtype == np.uint16)
+            else:
+                writer = TiffChunkWriter(out_dir)
+            process_in_chunks(trimmed, out_dir, chunk_size=case["chunk_size"], n_workers=case["n_workers"],
+                              writers={"max": writer}, zplanes=zplanes)
+        elif case["path"] == "prep_for_s2p":
+            # frame QC is part of prep so it is timed too, there is no project for a catalog
+            config_data = {"prep_settings": {"zplanes": zplanes, "chunk_size": case["chunk_size"],
+                                             "n_workers": case["n_workers"], "output": case["output"],
+                                             "streaming": case["mode"] == "streaming"},
+                           "catalog": {"enabled": False}}
+            preprocess = Preprocess(config_data, False, True, False)
+            preprocess.logger = logging.getLogger("benchmark")
+            preprocess.imaging_file_local = stack
+            preprocess.ses_ij_path = out_dir / "proc_ij"
+            preprocess.ses_s2p_path = out_dir / "proc_s2p"
+            preprocess.final_ses_s2p_path = preprocess.ses_s2p_path
+            os.makedirs(preprocess.ses_ij_path)
+            preprocess.prep_for_s2p()
+
+    # best of repeat runs, the chunk code prints every chunk so its output is hidden
+    seconds = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(case["repeat"]):
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+
+    if isinstance(im, TiffStack):
+        im.close()
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    best = max(min(seconds), 1e-9)
+    peak = peak_rss()
+    return {
+        "frames": nframes,
+        "seconds": best,
+        "frames_per_s": nframes / best,
+        "mb_per_s": nbytes / MB / best,
+        "peak_rss_mb": peak / MB if peak is not None else None,
+        "base_rss_mb": base_rss / MB if base_rss is not None else None,
+    }
+
+def make_cases(paths, frames, dtypes, modes, chunk_sizes, workers, outputs, zplanes):
+    # every combination of options that changes what each code path does
+    cases = []
+    for path, nframes, dtype, mode in itertools.product(paths, frames, dtypes, modes):
+        # reshape_array needs the whole stack as an array
+        if path == "reshape_array" and mode == "streaming":
+            continue
+        case = {"path": path, "frames": nframes, "dtype": dtype, "mode": mode, "zplanes": zplanes}
+        if path in ("process_in_chunks", "prep_for_s2p"):
+            for chunk_size, n_workers, output in itertools.product(chunk_sizes, workers, outputs):
+                cases.append(dict(case, chunk_size=chunk_size, n_workers=n_workers, output=output))
+        else:
+            cases.append(case)
+    return cases
+
+def compare(results, baseline, tolerance):
+    """Compares results with a baseline, returning the ids of cases that got slower or use more
+    memory by more than tolerance (a fraction)."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        slower = result["frames_per_s"] < base["frames_per_s"] * (1 - tolerance)
+        bigger = (result["peak_rss_mb"] is not None and base.get("peak_rss_mb") is not None
+                  and result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance))
+        if slower or bigger:
+            regressions.append(key)
+    return regressions
+
+def print_table(results, baseline):
+    print(f"{'case':<95} {'frames/s':>10} {'MB/s':>9} {'peak MB':>9} {'vs base':>8}")
+    for key, result in results.items():
+        base = baseline.get(key)
+        ratio = f"{result['frames_per_s'] / base['frames_per_s']:.2f}x" if base else "-"
+        peak = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else "-"
+        print(f"{key:<95} {result['frames_per_s']:>10.0f} {result['mb_per_s']:>9.1f} {peak:>9} {ratio:>8}")
+
+def split(text, cast=str):
+    return [cast(t) for t in text.replace(",", " ").split()]
+
+@click.command()
+@click.option("--paths", default="remove_leftover_frames reshape_array process_in_chunks prep_for_s2p", help="Code paths to benchmark")
+@click.option("--frames", default="10000", help="Raw frames per synthetic stack, e.g. '10000 100000'")
+@click.option("--size", type=int, default=512, help="Frame height and width")
+@click.option("--dtypes", default="uint16 int16", help="Data types of the synthetic stacks")
+@click.option("--zplanes", type=int, default=3, help="Number of interleaved z planes")
+@click.option("--modes", default="streaming memory", help="Read the stack lazily (streaming) or load it all (memory)")
+@click.option("--chunk-sizes", default="1800", help="Chunk sizes for process_in_chunks and prep_for_s2p")
+@click.option("--workers", default="1 4", help="Values of n_workers for process_in_chunks and prep_for_s2p")
+@click.option("--outputs", default="tif binary", help="Prep outputs to write (tif chunks or suite2p binary)")
+@click.option("--repeat", type=int, default=3, help="Runs per case, the fastest is kept")
+@click.option("--data-dir", default="benchmark_data", help="Folder for the synthetic stacks, which are reused between runs")
+@click.option("--results", default="benchmark_results.json", help="File the results are written to")
+@click.option("--baseline", default="benchmark_baseline.json", help="Baseline results to compare against")
+@click.option("--save-baseline", type=bool, is_flag=True, help="Saves these results as the new baseline")
+@click.option("--tolerance", type=float, default=0.2, help="Fraction slower (or more memory) than the baseline counted as a regression")
+def run_benchmarks(paths, frames, size, dtypes, zplanes, modes, chunk_sizes, workers, outputs, repeat, data_dir,
+                   results, baseline, save_baseline, tolerance):
+    data_dir = Path(data_dir)
+    cases = make_cases(split(paths), split(frames, int), split(dtypes), split(modes),
+                       split(chunk_sizes, int), split(workers, int), split(outputs), zplanes)
+
+    measured = {}
+    # a fresh process per case so peak memory is not carried over from the case before
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        stack = data_dir / f"stack_{case['frames']}x{size}x{size}_{case['dtype']}_{zplanes}planes.tif"
+        if not stack.is_file():
+            print(f"Writing synthetic stack {stack}")
+            make_stack(stack, case["frames"], size=size, dtype=case["dtype"], zplanes=zplanes)
+
+        key = case_id(dict(case, size=size))
+        print(f"Running {key}")
+        job = dict(case, stack=str(stack), out_dir=str(data_dir / "output"), repeat=repeat)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measured[key] = executor.submit(run_case, job).result()
+
+    baseline_results = {}
+    if os.path.isfile(baseline):
+        with open(baseline) as f:
+            baseline_results = json.load(f)["results"]
+
+    print_table(measured, baseline_results)
+
+    contents = {"machine": {"platform": platform.platform(), "python": platform.python_version(),
+                            "cpus": os.cpu_count()}, "results": measured}
+    with open(results, "w") as f:
+        json.dump(contents, f, indent=2)
+    if save_baseline:
+        with open(baseline, "w") as f:
+            json.dump(contents, f, indent=2)
+        print(f"Saved baseline to {baseline}")
+
+    regressions = compare(measured, baseline_results, tolerance)
+    if regressions:
+        print(f"{len(regressions)} cases regressed by more than {tolerance:.0%} against {baseline}:")
+        for key in regressions:
+            print(f"  {key}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,198 @@
+### Local SQLite catalog of project folders, session manifests and stage outputs, so planning
+### a run doesn't make a metadata call on the file share for every folder and file
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from datetime import datetime
+
+from manifest import output_unchanged
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    present INTEGER NOT NULL,
+    n_entries INTEGER,
+    checked TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifests (
+    path TEXT PRIMARY KEY,
+    contents TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    session TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    outputs_hash TEXT NOT NULL,
+    n_files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    present INTEGER NOT NULL,
+    finished TEXT,
+    checked TEXT NOT NULL,
+    PRIMARY KEY (session, stage)
+);
+"""
+
+def now():
+    return datetime.now().isoformat(timespec="seconds")
+
+def outputs_hash(outputs):
+    return hashlib.sha1(json.dumps(outputs, sort_keys=True).encode()).hexdigest()[:16]
+
+def outputs_on_disk(outputs):
+    # the same check as SessionManifest.outputs_exist, without the expected paths
+    return len(outputs) > 0 and all(output_unchanged(o) for o in outputs)
+
+class ProjectCatalog():
+    """SQLite file remembering what is on disk in the project so it is only checked once.
+
+    Three things are kept: whether each project folder exists and how many entries it has,
+    the contents of each session manifest, and, for each session stage, its output files
+    and whether they were all still on disk when last checked. The pipeline updates the
+    catalog as it creates folders and finishes stages. Changes made outside the pipeline
+    (e.g. deleting a suite2p folder by hand or a run on another machine) are only seen after
+    reconcile(), which checks every entry against the disk again.
+
+    The journal is kept next to the database, so it can live on a network share, but a
+    local disk is much faster (set catalog path in the config).
+
+    Args:
+        path (Str or Path object): SQLite file, created if missing.
+        read_only (bool, optional): Opens an existing file for reading only, e.g. for status
+            commands. What would be written is dropped, so folders and outputs are checked on
+            disk every time. Defaults to False.
+    """
+    def __init__(self, path, read_only=False):
+        self.path = Path(path)
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, timeout=60,
+                                         check_same_thread=False, isolation_level=None)
+            return
+        os.makedirs(self.path.parent, exist_ok=True)
+        # one connection shared by the copy back threads, with a long timeout for --jobs workers
+        self._conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        if self.read_only and not sql.startswith("SELECT"):
+            return []
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # folders
+
+    def dir_state(self, path):
+        """Returns (exists, number of entries) of a folder, read from disk the first time."""
+        rows = self._execute("SELECT present, n_entries FROM dirs WHERE path = ?", (str(path),))
+        if rows and rows[0][1] is not None:
+            return bool(rows[0][0]), rows[0][1]
+        present = os.path.isdir(path)
+        n_entries = len(os.listdir(path)) if present else 0
+        self._execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (str(path), int(present), n_entries, now()))
+        return present, n_entries
+
+    def make_dirs(self, paths):
+        """Creates any folders in paths that are missing. Every folder is checked on disk, as
+        folders the catalog knows about can still be deleted (e.g. a wiped fast disk), and only
+        new ones are written to the catalog."""
+        paths = [str(p) for p in paths]
+        if not paths:
+            return
+        created = []
+        for path in paths:
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
+                created.append(path)
+        for path in created:
+            # the number of entries is counted when it's first asked for
+            self._execute("INSERT OR REPLACE INTO dirs VALUES (?, 1, NULL, ?)", (path, now()))
+        self.forget_dirs([Path(p).parent for p in created])
+
+    def forget_dirs(self, paths):
+        # folders whose contents changed are read from disk again next time
+        paths = {str(p) for p in paths}
+        if paths:
+            marks = ",".join("?" * len(paths))
+            self._execute(f"UPDATE dirs SET n_entries = NULL WHERE path IN ({marks})", list(paths))
+
+    # manifests
+
+    def get_manifest(self, path):
+        rows = self._execute("SELECT contents FROM manifests WHERE path = ?", (str(path),))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_manifest(self, path, contents):
+        self._execute("INSERT OR REPLACE INTO manifests VALUES (?, ?, ?)", (str(path), json.dumps(contents), now()))
+
+    # stage outputs
+
+    def outputs_present(self, session, stage, outputs):
+        """Returns whether these outputs were on disk when last checked, or None if they
+        haven't been checked (or the stage has since written other files)."""
+        rows = self._execute("SELECT present FROM stages WHERE session = ? AND stage = ? AND outputs_hash = ?",
+                             (session, stage, outputs_hash(outputs)))
+        return bool(rows[0][0]) if rows else None
+
+    def record_outputs(self, session, stage, outputs, present=True, finished=None):
+        self._execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (session, stage, json.dumps(outputs), outputs_hash(outputs), len(outputs),
+                       sum(o["size"] for o in outputs), int(present), finished, now()))
+        # the folders the stage wrote into have new entries
+        folders = set()
+        for o in outputs:
+            folders.update(str(p) for p in list(Path(o["path"]).parents)[:4])
+        self.forget_dirs(folders)
+
+    def forget(self, session=None, paths=()):
+        """Drops what the catalog knows about a session's stage outputs and about folders
+        in or under paths, e.g. after the pipeline deleted them, so they are checked on disk
+        next time."""
+        if session is not None:
+            self._execute("DELETE FROM stages WHERE session = ?", (session,))
+        for path in paths:
+            path = str(path)
+            self._execute("DELETE FROM dirs WHERE path = ? OR path LIKE ?", (path, path.rstrip("/") + "/%"))
+        self.forget_dirs([Path(p).parent for p in paths])
+
+    def reconcile(self):
+        """Checks every folder, manifest and stage output in the catalog against the disk.
+
+        Returns:
+            dict: Number of entries that changed in each table.
+        """
+        changed = {"dirs": 0, "manifests": 0, "stages": 0}
+        for path, present, n_entries in self._execute("SELECT path, present, n_entries FROM dirs"):
+            is_dir = os.path.isdir(path)
+            entries = len(os.listdir(path)) if is_dir else 0
+            if bool(present) != is_dir or (n_entries is not None and n_entries != entries):
+                changed["dirs"] += 1
+            self._execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (path, int(is_dir), entries, now()))
+
+        for path, contents in self._execute("SELECT path, contents FROM manifests"):
+            if os.path.isfile(path):
+                with open(path) as f:
+                    on_disk = json.load(f)
+                if on_disk != json.loads(contents):
+                    changed["manifests"] += 1
+                    self.put_manifest(path, on_disk)
+            else:
+                changed["manifests"] += 1
+                self._execute("DELETE FROM manifests WHERE path = ?", (path,))
+
+        for session, stage, outputs, present in self._execute("SELECT session, stage, outputs, present FROM stages"):
+            on_disk = outputs_on_disk(json.loads(outputs))
+            if on_disk != bool(present):
+                changed["stages"] += 1
+            self._execute("UPDATE stages SET present = ?, checked = ? WHERE session = ? AND stage = ?",
+                          (int(on_disk), now(), session, stage))
+        return changed
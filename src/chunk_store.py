@@ -0,0 +1,157 @@
+### Chunked, optionally compressed Zarr or HDF5 store for the projected movie
+import threading
+from pathlib import Path
+
+# file name of the store in the session's proc_ij folder for each output format
+STORE_NAMES = {"zarr": "movie.zarr", "hdf5": "movie.h5"}
+COMPRESSIONS = (None, "zstd", "lz4", "blosc", "gzip")
+
+def zarr_compression(compression, level, v3):
+    # codecs for zarr 3 or numcodecs compressors for zarr 2
+    if compression is None:
+        return None
+    if compression == "gzip":
+        if v3:
+            from zarr.codecs import GzipCodec
+            return GzipCodec(level=level)
+        from numcodecs import GZip
+        return GZip(level=level)
+
+    if v3:
+        from zarr.codecs import ZstdCodec, BloscCodec
+        if compression == "zstd":
+            return ZstdCodec(level=level)
+        cname = "lz4" if compression == "lz4" else "zstd"
+        return BloscCodec(cname=cname, clevel=level, shuffle="bitshuffle")
+
+    from numcodecs import Zstd, LZ4, Blosc
+    if compression == "zstd":
+        return Zstd(level=level)
+    if compression == "lz4":
+        return LZ4()
+    return Blosc(cname="zstd", clevel=level, shuffle=Blosc.BITSHUFFLE)
+
+def hdf5_compression(compression, level):
+    # keyword arguments for h5py create_dataset, zstd, lz4 and blosc need hdf5plugin
+    if compression is None:
+        return {}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": level}
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(f"{compression} compression in hdf5 needs hdf5plugin (pip install hdf5plugin), or use gzip")
+    if compression == "zstd":
+        return dict(hdf5plugin.Zstd(clevel=level))
+    if compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    return dict(hdf5plugin.Blosc(cname="zstd", clevel=level, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+
+class ChunkedStore():
+    """A Zarr or HDF5 store holding one array per projection, chunked along frames so each
+    chunk of process_in_chunks is a single store chunk.
+
+    Zarr chunks are compressed and written by the worker threads at the same time. h5py
+    can't write from several threads, so hdf5 writes take turns.
+
+    Args:
+        path (Str or Path object): movie.zarr folder or movie.h5 file.
+        store_format (str): "zarr" or "hdf5".
+        compression (str, optional): None, "zstd", "lz4", "blosc" or "gzip". Defaults to None.
+        level (int, optional): Compression level. Defaults to 3.
+        resume (bool, optional): Keeps the arrays of an interrupted zarr write so only the
+            missing chunks are written. Defaults to False.
+    """
+    def __init__(self, path, store_format, compression=None, level=3, resume=False):
+        if store_format not in STORE_NAMES:
+            raise ValueError(f"Unknown store format {store_format}. Options are {list(STORE_NAMES)}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}. Options are {COMPRESSIONS}")
+        self.path = Path(path)
+        self.store_format = store_format
+        self.compression = compression
+        self.level = level
+        self._lock = threading.Lock()
+        self._open_writers = 0
+        self.resume = resume and store_format == "zarr"
+
+        if store_format == "zarr":
+            import zarr
+            self.root = zarr.open_group(str(self.path), mode="a" if self.resume else "w")
+        else:
+            import h5py
+            self.root = h5py.File(self.path, "w")
+
+    def writer(self, name, nframes, frames_per_chunk, attrs=None):
+        """Returns a writer with write(i, frames) and close() for the array called name."""
+        with self._lock:
+            self._open_writers += 1
+        return ChunkedStoreWriter(self, name, nframes, frames_per_chunk, attrs or {})
+
+    def create_array(self, name, shape, chunks, dtype, attrs):
+        if self.resume and name in self.root:
+            array = self.root[name]
+            if array.shape == shape and array.chunks == chunks and array.dtype == dtype:
+                return array
+            del self.root[name]
+        if self.store_format == "zarr":
+            v3 = hasattr(self.root, "create_array")
+            compressor = zarr_compression(self.compression, self.level, v3)
+            if v3:
+                array = self.root.create_array(name, shape=shape, chunks=chunks, dtype=dtype,
+                                               compressors=[compressor] if compressor is not None else None)
+            else:
+                array = self.root.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype, compressor=compressor)
+        else:
+            array = self.root.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype,
+                                             **hdf5_compression(self.compression, self.level))
+        array.attrs.update(attrs)
+        return array
+
+    def release(self):
+        # the hdf5 file is closed once every writer has finished
+        with self._lock:
+            self._open_writers -= 1
+            if self._open_writers == 0 and self.store_format == "hdf5":
+                self.root.close()
+
+class ChunkedStoreWriter():
+    """Writes chunk i of a projection to frames i * frames_per_chunk onwards of one array.
+    The array is created on the first write, once the frame shape and dtype are known."""
+    def __init__(self, store, name, nframes, frames_per_chunk, attrs):
+        self.store = store
+        self.name = name
+        self.nframes = nframes
+        self.frames_per_chunk = frames_per_chunk
+        self.attrs = attrs
+        self.array = None
+
+    def write(self, i, frames):
+        with self.store._lock:
+            if self.array is None:
+                self.array = self.store.create_array(self.name, (self.nframes,) + frames.shape[1:],
+                                                     (self.frames_per_chunk,) + frames.shape[1:],
+                                                     frames.dtype, self.attrs)
+
+        start = i * self.frames_per_chunk
+        if self.store.store_format == "zarr":
+            self.array[start:start + len(frames)] = frames
+        else:
+            with self.store._lock:
+                self.array[start:start + len(frames)] = frames
+
+    def close(self):
+        self.store.release()
+
+def open_store_array(path, name):
+    """Opens a projection in a store for reading frame windows, e.g. array[1000:2000].
+
+    Returns:
+        array: zarr array or h5py dataset (close it with array.file.close()).
+    """
+    path = Path(path)
+    if path.suffix == ".zarr":
+        import zarr
+        return zarr.open_group(str(path), mode="r")[name]
+    import h5py
+    return h5py.File(path, "r")[name]
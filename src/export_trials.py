@@ -0,0 +1,40 @@
+### Joins the peri-event trial tensors of many sessions into one cohort table
+import json
+
+import click
+
+from helper_fx import Preprocess
+
+@click.command()
+@click.option("--config-file", "-c", type=str, default="config.json", help="A file containing config options")
+@click.option("--animals", "-a", type=str, default="all", help="List of animals to export, or all")
+@click.option("--dates", "-d", type=str, default="all", help="List of dates to export, or all")
+@click.option("--use-fast-dir", "-f", type=bool, is_flag=True, help="Reads traces left on the fast disk by a run with --use-fast-dir")
+@click.option("--extract", "-T", type=bool, is_flag=True, help="Extracts the trials of sessions that don't have them or whose traces or settings changed first")
+@click.option("--output", "-o", type=str, default=None, help="Folder for the cohort files (defaults to processeddata/trials in the project dir)")
+def run_export(config_file, animals, dates, use_fast_dir, extract, output):
+    with open(config_file) as f:
+        config_data = json.load(f)
+
+    preprocess = Preprocess(config_data, use_fast_dir, False, False)
+    preprocess.set_project_dir()
+    preprocess.set_logger()
+    preprocess.read_metafile()
+    preprocess.parse_animals(animals)
+    preprocess.parse_dates(dates)
+    preprocess.plan_sessions()
+    preprocess.define_root()
+    preprocess.define_nwb_paths()
+
+    if extract:
+        for animal, date in preprocess.sessions:
+            preprocess.define_animal_paths(animal)
+            if preprocess.check_valid_combo(animal, date):
+                preprocess.process_session(extract_trials=True)
+
+    output = output or preprocess.project_dir / "processeddata" / "trials"
+    table = preprocess.export_trials(output)
+    preprocess.logger.info(f"Wrote {len(table)} cell trials to {output}")
+
+if __name__ == "__main__":
+    run_export()
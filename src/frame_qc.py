@@ -0,0 +1,100 @@
+### Per-frame quality metrics measured while prep reads the raw frames, and suite2p bad frames
+import numpy as np
+import pandas as pd
+
+class FrameQC():
+    """Collects mean intensity, saturation, flatness and frame-to-frame jump of every raw frame.
+
+    measure() is called by the prep workers with each chunk of raw frames, so nothing is read
+    twice. Chunks fill their own rows of preallocated arrays and can be measured in any order
+    from several threads. The jump of a frame is the mean absolute difference from the frame
+    before it in the same plane (zplanes frames earlier), on every stride-th row and column.
+
+    Args:
+        n_frames (int): Raw frames that will be measured.
+        zplanes (int): Number of interleaved z planes.
+        saturation_value (int or float): Pixels at or above this count as saturated.
+        stride (int, optional): Pixel step used for the jump and flatness. Defaults to 4.
+    """
+    def __init__(self, n_frames, zplanes, saturation_value, stride=4):
+        self.zplanes = zplanes
+        self.saturation_value = saturation_value
+        self.stride = max(1, int(stride))
+        self.mean = np.full(n_frames, np.nan, dtype=np.float32)
+        self.saturated = np.full(n_frames, np.nan, dtype=np.float32)
+        self.std = np.full(n_frames, np.nan, dtype=np.float32)
+        self.jump = np.full(n_frames, np.nan, dtype=np.float32)
+
+    def measure(self, start, chunk, previous=None):
+        """Measures a chunk of raw frames starting at frame start. previous holds the raw
+        frames just before the chunk (at least zplanes), or None for the first chunk."""
+        rows = slice(start, start + len(chunk))
+        self.mean[rows] = chunk.mean(axis=(1, 2), dtype=np.float64)
+        # saturated pixels are only counted in the few frames that reach the saturation value
+        saturated = np.zeros(len(chunk), dtype=np.float32)
+        for k in np.flatnonzero(chunk.max(axis=(1, 2)) >= self.saturation_value):
+            saturated[k] = np.count_nonzero(chunk[k] >= self.saturation_value) / chunk[k].size
+        self.saturated[rows] = saturated
+
+        s = self.stride
+        sub = chunk[:, ::s, ::s].astype(np.float32)
+        self.std[rows] = sub.std(axis=(1, 2))
+        if previous is not None:
+            sub = np.concatenate([previous[-self.zplanes:, ::s, ::s].astype(np.float32), sub])
+            first = start - self.zplanes
+        else:
+            first = start
+        diffs = np.abs(sub[self.zplanes:] - sub[:-self.zplanes]).mean(axis=(1, 2))
+        self.jump[first + self.zplanes:first + self.zplanes + len(diffs)] = diffs
+
+    def values(self, start, n_frames):
+        # metrics of n_frames frames from start, to keep with a chunk's progress record
+        rows = slice(start, start + n_frames)
+        return {name: getattr(self, name)[rows] for name in ["mean", "saturated", "std", "jump"]}
+
+    def restore(self, start, values):
+        # metrics of a chunk measured by an earlier, interrupted run
+        for name, array in values.items():
+            getattr(self, name)[start:start + len(array)] = array
+
+    def flags(self, blank_fraction=0.2, jump_mads=10, max_saturated_fraction=0.1):
+        """Flags blank or dropped frames (mean below blank_fraction of the plane's median, or
+        no variation at all), jumps more than jump_mads median absolute deviations above the
+        median jump of the plane, and frames with more than max_saturated_fraction saturated.
+
+        Returns:
+            dict: blank, jump and saturated boolean arrays, one value per raw frame.
+        """
+        blank = self.std == 0
+        jump = np.zeros(len(self.mean), dtype=bool)
+        for plane in range(self.zplanes):
+            mean, jumps = self.mean[plane::self.zplanes], self.jump[plane::self.zplanes]
+            blank[plane::self.zplanes] |= mean < blank_fraction * np.nanmedian(mean) if len(mean) else False
+            valid = jumps[~np.isnan(jumps)]
+            if len(valid):
+                median = np.median(valid)
+                mad = 1.4826 * np.median(np.abs(valid - median))
+                jump[plane::self.zplanes] = np.nan_to_num(jumps, nan=0) > median + jump_mads * max(mad, 1e-6)
+        return {"blank": blank, "jump": jump, "saturated": self.saturated > max_saturated_fraction}
+
+    def table(self, raw_per_frame, **thresholds):
+        """One row per raw frame with its plane, the suite2p frame it goes into (raw frame //
+        raw_per_frame), its metrics and flags, and bad if any flag is set."""
+        flags = self.flags(**thresholds)
+        frames = np.arange(len(self.mean))
+        table = pd.DataFrame({
+            "frame": frames,
+            "plane": frames % self.zplanes,
+            "suite2p_frame": frames // raw_per_frame,
+            "mean": self.mean,
+            "saturated": self.saturated,
+            "std": self.std,
+            "jump": self.jump,
+            **{f"{name}_frame": flag for name, flag in flags.items()},
+        })
+        table["bad"] = table[[f"{name}_frame" for name in flags]].any(axis=1)
+        return table
+
+def bad_suite2p_frames(table):
+    # suite2p frames holding any bad raw frame, for suite2p's bad_frames.npy
+    return np.unique(table.loc[table["bad"], "suite2p_frame"].to_numpy()).astype(np.int64)
@@ -6,13 +6,32 @@ from pathlib import Path
 from datetime import datetime
 import logging
 import shutil
-
-import numpy as np
-import pandas as pd
-
-import imageio
-
-from suite2p import default_ops, run_s2p
+import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import json
+
+from lazy import LazyModule
+from manifest import SessionManifest, STAGE_CHAIN, file_record, file_records, params_hash
+from transfer import get_backend
+from staging import StagingManager, GB
+from metrics import StageMetrics
+from chunk_store import ChunkedStore, STORE_NAMES, open_store_array
+from suite2p_worker import Suite2pClient, worker_settings
+from catalog import ProjectCatalog
+
+# imported on first use so planning and status commands start quickly, suite2p (and with it
+# torch and cellpose) and the cross-session modules are imported in the methods that use them
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+imageio = LazyModule("imageio")
+tifffile = LazyModule("tifffile")
+
+# stages in the order they are run for a session, named after the Preprocess methods
+STAGES = ["get_data", "get_behav", "prep_for_s2p", "imagej_zproject", "align_behav", "run_suite2p", "compute_dff",
+          "extract_trials", "copy_from_fast_disk"]
 
 # the base class used for most scripts in this package
 class Preprocess():
@@ -22,6 +41,10 @@ class Preprocess():
     self.use_fast_dir = use_fast_dir
     self.overwrite = overwrite
     self.delete_intermediates = delete_intermediates
+    self.metrics = None
+    self.catalog = None
+    # set by commands that only report on the project, so nothing is created or written
+    self.read_only = False
     print("class initialized")
 
   def set_project_dir(self):
@@ -29,15 +52,79 @@ class Preprocess():
 
     if not os.path.isdir(self.project_dir):
         print("does not exist")
-        os.makedirs(self.project_dir, exist_ok=True)
+        if not self.read_only:
+            os.makedirs(self.project_dir, exist_ok=True)
   
   def set_logger(self):
     self.logger = setup_logger(self.project_dir)
 
+  def set_metrics(self, path=None):
+    # stage timings for this run go next to the log files
+    if path is None:
+        path = self.project_dir / "log" / "{}_{}_metrics.jsonl".format(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'), os.getpid())
+    self.metrics = StageMetrics(path)
+    self.logger.info(f"Writing stage metrics to {path}")
+
+  def get_storage(self):
+    # storage backend used for all downloads, set by the storage section of the config
+    if getattr(self, "storage", None) is None:
+        self.storage = get_backend(self.config_data, logger=self.logger)
+    return self.storage
+
+  def get_catalog(self):
+    # catalog of project folders, manifests and stage outputs, or None if turned off in the
+    # catalog section of the config
+    settings = self.config_data.get("catalog", {})
+    if not settings.get("enabled", True):
+        return None
+    if self.catalog is None:
+        path = Path(settings.get("path") or self.project_dir / "log" / "catalog.sqlite")
+        if self.read_only:
+            if not path.is_file():
+                return None
+            self.catalog = ProjectCatalog(path, read_only=True)
+        else:
+            self.catalog = ProjectCatalog(path)
+    return self.catalog
+
+  def reconcile_catalog(self):
+    # checks everything in the catalog against the disk, e.g. after deleting files by hand,
+    # which is the only write a read-only command makes and only when asked to
+    catalog = self.get_catalog()
+    if catalog is None:
+        return
+    if catalog.read_only:
+        writable = ProjectCatalog(catalog.path)
+        changed = writable.reconcile()
+        writable.close()
+    else:
+        changed = catalog.reconcile()
+    self.logger.info(f"Reconciled catalog {catalog.path} with disk, changed entries: {changed}")
+
+  def forget_session_files(self, paths):
+    # called after the pipeline deletes files of the current session
+    catalog = self.get_catalog()
+    if catalog is not None:
+        catalog.forget(self.session_key(), paths)
+
+  def make_dirs(self, paths):
+    # folders that had to be created are recorded in the catalog
+    if self.read_only:
+        return
+    catalog = self.get_catalog()
+    if catalog is not None:
+        catalog.make_dirs(paths)
+        return
+    for path in paths:
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
   def get_metafile(self):
     self.logger.info("Downloading metafile from remote repo")
-    path_to_azcopy = self.config_data["path_to_azcopy"]
-    subprocess.call("{} cp {} {}".format(path_to_azcopy, self.config_data["metafile"], self.project_dir), shell=True)
+    metafile_local = self.project_dir / Path(self.config_data["metafile"]).name
+    result = self.get_storage().copy(self.config_data["metafile"], metafile_local)
+    if not result.ok:
+        self.logger.warning(f"Failed to download metafile: {result.message}")
 
   def read_metafile(self):
     self.csv_file = self.project_dir / Path(self.config_data["metafile"]).name
@@ -45,12 +132,37 @@ class Preprocess():
         self.logger.info("Exiting as metafile does not exist in project directory")
         sys.exit(2)
 
-    self.metadata = pd.read_csv(self.csv_file, encoding = "ISO-8859-1")
+    # the parsed index is cached next to the metafile, so planning doesn't need pandas until
+    # the metafile changes
+    index_file = self.csv_file.with_name(self.csv_file.stem + "_index.json")
+    source = file_record(self.csv_file)
+    cached = None
+    if index_file.is_file():
+        with open(index_file) as f:
+            cached = json.load(f)
+    if cached is not None and cached["source"] == source:
+        self.rows = cached["rows"]
+        self.session_index = {(animal, date): positions for animal, date, positions in cached["sessions"]}
+        return
+
+    metadata, session_index = index_metafile(pd.read_csv(self.csv_file, encoding = "ISO-8859-1"))
+    self.rows = metadata.astype(object).where(metadata.notna(), None).to_dict("records")
+    self.session_index = {key: [int(p) for p in positions] for key, positions in session_index.items()}
+    if self.read_only:
+        return
+
+    tmp = index_file.with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"source": source, "rows": self.rows,
+                   "sessions": [[animal, date, positions] for (animal, date), positions in self.session_index.items()]},
+                  f, default=str)
+    os.replace(tmp, index_file)
 
   def parse_animals(self, animal_string):
     print("parsing animals")
+    self.all_animals = animal_string == "all"
     if animal_string == "all":
-        self.animals = self.metadata["animal"].unique()
+        self.animals = list(dict.fromkeys(row["animal"] for row in self.rows))
     elif animal_string == "":
         self.logger.info("No animals given. Exiting")
         sys.exit(2)
@@ -61,8 +173,9 @@ class Preprocess():
 
   def parse_dates(self, date_string):
 
+    self.all_dates = date_string == "all"
     if date_string == "all":
-        self.dates = self.metadata["date"].unique()
+        self.dates = list(dict.fromkeys(row["date"] for row in self.rows))
     elif date_string == "":
         self.logger.info("No dates given. Exiting")
         sys.exit(2)
@@ -70,13 +183,68 @@ class Preprocess():
         self.dates = date_string.split()
     
     self.logger.info(f"Dates being analyzed are {self.dates}")
+
+  def plan_sessions(self):
+    """Builds the list of (animal, date) sessions to run from the metafile index.
+
+    Only pairs that exist in the metafile are kept, so "all" animals and dates does not mean
+    looking up every combination. Duplicated rows, rows with dates or days that can't be
+    parsed and (when animals and dates are both listed) missing pairs are reported up front.
+    """
+    animals = [str(a) for a in self.animals]
+    date_order = {str(d): i for i, d in enumerate(self.dates)}
+
+    dates_by_animal = {}
+    for animal, date in self.session_index:
+        dates_by_animal.setdefault(str(animal), []).append(date)
+
+    self.sessions = []
+    for animal in animals:
+        dates = [d for d in dates_by_animal.get(animal, []) if str(d) in date_order]
+        self.sessions += [(animal, d) for d in sorted(dates, key=lambda d: date_order[str(d)])]
+
+    duplicates = [key for key in self.sessions if len(self.session_index[key]) > 1]
+    if duplicates:
+        self.logger.warning(f"These sessions have more than one row in the metafile and will be skipped: {duplicates}")
+
+    unparsed = [key for key in self.sessions if key not in duplicates
+                and self.rows[self.session_index[key][0]]["ses_path"] is None]
+    if unparsed:
+        self.logger.warning(f"These sessions have a date or day that can't be read and will be skipped: {unparsed}")
+
+    unknown_animals = [a for a in animals if a not in dates_by_animal]
+    if unknown_animals and not self.all_animals:
+        self.logger.warning(f"Animals not found in metafile: {unknown_animals}")
+
+    if not self.all_animals and not self.all_dates:
+        found = set(self.sessions)
+        missing = [(a, str(d)) for a in animals for d in self.dates if (a, str(d)) not in found]
+        if missing:
+            self.logger.warning(f"No rows in metafile for: {missing}")
+
+    self.sessions = [key for key in self.sessions if key not in duplicates and key not in unparsed]
+    self.logger.info(f"Planned {len(self.sessions)} sessions")
+
+  def show_sessions(self):
+    # prints the planned sessions as a table, used for dry runs
+    rows = pd.DataFrame([self.rows[self.session_index[key][0]] for key in self.sessions])
+    columns = [c for c in ["animal", "date", "ses_path", "folder", "scanimagefile"] if c in rows.columns]
+    print(rows[columns].to_string(index=False))
     
   def define_root(self):
-    if self.use_fast_dir:
+    if self.use_fast_dir and self.read_only:
+        # the staging state isn't needed to report on sessions, and the manager locks and writes it
+        self.path_root = Path(self.config_data["path_to_fast_dir"])
+        self.staging = None
+    elif self.use_fast_dir:
         self.logger.info("Using specified fast data disk. Will not save intermediates, only suite2p files.")
         self.path_root = Path(self.config_data["path_to_fast_dir"])
+        self.staging = StagingManager(self.path_root, self.config_data, self.logger)
+        if self.get_catalog() is not None:
+            self.staging.on_evict = lambda key, paths: self.catalog.forget(key, paths)
     else:
         self.path_root = self.project_dir
+        self.staging = None
 
   def define_nwb_paths(self): 
     self.path_raw = self.path_root / "rawdata"
@@ -86,38 +254,76 @@ class Preprocess():
     self.path_proc_ij = self.path_processed / "proc_ij"
     self.path_proc_s2p = self.path_processed / "proc_s2p"
 
-    if not os.path.isdir(self.path_raw):
-        os.makedirs(self.path_raw, exist_ok=True)
-        os.makedirs(self.path_imaging, exist_ok=True)
-        os.makedirs(self.path_behav, exist_ok=True)
-        self.logger.info("Creating directories for raw data.")
-
-    if not os.path.isdir(self.path_processed):
-        os.makedirs(self.path_processed, exist_ok=True)
-        os.makedirs(self.path_proc_ij, exist_ok=True)
-        os.makedirs(self.path_proc_s2p, exist_ok=True)
-        self.logger.info("Creating directories for processed data.")
+    self.make_dirs([self.path_raw, self.path_imaging, self.path_behav,
+                    self.path_processed, self.path_proc_ij, self.path_proc_s2p])
 
   def define_multisession_paths(self):
-    print("defining multisession path")
+    # cross-session outputs for one animal, kept in the project dir next to proc_s2p
+    self.path_multisession = self.project_dir / "processeddata" / "multisession" / f"sub-{self.animal}"
+    self.make_dirs([self.path_multisession])
+
+  def multisession_ops_files(self):
+    # suite2p ops.npy of each planned session that has been through suite2p, by session name
+    ops_files = {}
+    for animal, date in self.sessions:
+        if not self.check_valid_combo(animal, date):
+            continue
+        self.define_session_paths()
+        ops_path = self.final_ses_s2p_path / "suite2p" / "plane0" / "ops.npy"
+        if ops_path.is_file():
+            ops_files[self.ses_path] = ops_path
+        else:
+            self.logger.warning(f"No suite2p output for {animal}, {date}. Run process_individual.py with --do-suite2p first.")
+    return ops_files
+
+  def register_sessions(self):
+    """Registers the planned sessions of one animal to a common reference.
+
+    Transforms and the reference are cached in the animal's multisession folder, so only
+    new sessions are registered unless --overwrite is given.
+
+    Returns:
+        dict: Transform of each session, see SessionRegistration.run.
+    """
+    from registration import SessionRegistration
+    registration = SessionRegistration(self.path_multisession / "registration", self.config_data, self.logger)
+    return registration.run(self.multisession_ops_files(), rebuild=self.overwrite)
+
+  def match_rois(self, transforms):
+    """Matches suite2p ROIs across the registered sessions of one animal.
+
+    Matches between each pair of sessions are cached in the animal's multisession folder,
+    so adding a date only matches the pairs with the new session.
+
+    Args:
+        transforms (dict): Transform of each session from register_sessions.
+
+    Returns:
+        DataFrame: Suite2p ROI index of each cell in each session, see ROIMatcher.run.
+    """
+    plane_paths = {session: ops_path.parent for session, ops_path in self.multisession_ops_files().items()}
+    shape = np.load(self.path_multisession / "registration" / "reference.npy", mmap_mode="r").shape
+    from roi_matching import ROIMatcher
+    matcher = ROIMatcher(self.path_multisession / "roi_matching", self.config_data, self.logger)
+    return matcher.run(plane_paths, transforms, shape)
     
 
   def check_valid_combo(self, animal, date):
     self.animal, self.date = animal, date
-    self.logger.info("Now analysing {}, {}".format(self.animal, self.date))
-    self.row = self.metadata.query("animal == @self.animal & date == @self.date")
-    if len(self.row) > 1:
+    positions = self.session_index.get((str(self.animal), str(self.date)), [])
+    if len(positions) > 1:
         self.logger.info(f"Too many values in metafile for {self.animal} on {self.date}")
         return False
-    
-    try:
-        self.ses_path = get_session_string_from_df(self.row)
-        self.day = str(self.row['day'].item()).zfill(3)
-        return True
-    except:
+
+    self.row = self.rows[positions[0]] if positions else None
+    if self.row is None or self.row["ses_path"] is None:
         self.logger.info(f"Cannot find matching values for {self.animal} on {self.date}")
         return False
 
+    self.ses_path = self.row["ses_path"]
+    self.day = self.row["day_str"]
+    return True
+
   def define_animal_paths(self, animal):
     self.animal = animal
     self.animal_imaging_path = self.path_imaging / "sub-{}".format(self.animal)
@@ -125,9 +331,7 @@ class Preprocess():
     self.animal_ij_path = self.path_proc_ij / "sub-{}".format(self.animal)
     self.animal_s2p_path = self.path_proc_s2p / "sub-{}".format(self.animal)
         
-    for path in [self.animal_imaging_path, self.animal_behav_path, self.animal_ij_path, self.animal_s2p_path]:
-        if not os.path.isdir(path):
-            os.makedirs(path, exist_ok=True)
+    self.make_dirs([self.animal_imaging_path, self.animal_behav_path, self.animal_ij_path, self.animal_s2p_path])
 
   def define_session_paths(self):
     self.ses_imaging_path = self.animal_imaging_path / self.ses_path
@@ -136,19 +340,44 @@ class Preprocess():
     self.ses_s2p_path = self.animal_s2p_path / self.ses_path
 
     self.remote = self.config_data["remote"]
-    self.imaging_file_remote = os.path.join(self.remote, self.row["folder"].item(), self.row["scanimagefile"].item())
+    self.imaging_file_remote = os.path.join(self.remote, self.row["folder"], self.row["scanimagefile"])
     self.imaging_file_local = self.ses_imaging_path / f"sub-{self.animal}_ses-{self.day}_2p.tif"
 
-    self.event_file_remote = os.path.join(self.remote, "bonsai", self.row["eventfile"].item())
+    self.event_file_remote = os.path.join(self.remote, "bonsai", self.row["eventfile"])
     self.event_file_local = self.ses_behav_path / f"sub-{self.animal}_ses-{self.day}_events.csv"
 
-    self.frame_file_remote = os.path.join(self.remote, "bonsai", self.row["framefile"].item())
+    self.frame_file_remote = os.path.join(self.remote, "bonsai", self.row["framefile"])
     self.frame_file_local = self.ses_behav_path / f"sub-{self.animal}_ses-{self.day}_frames.csv"
 
-    self.final_ses_s2p_path = self.project_dir / "processeddata" / "proc_s2p" / f"sub-{self.animal}" / f"ses-{self.day}"
+    # where the session's suite2p folder ends up, with alignment, frame QC and trials next to it,
+    # on the fast disk suite2p is copied back here and otherwise it is written here directly
+    if self.use_fast_dir:
+        self.final_ses_s2p_path = self.project_dir / "processeddata" / "proc_s2p" / f"sub-{self.animal}" / f"ses-{self.day}"
+    else:
+        self.final_ses_s2p_path = self.ses_s2p_path
+
+    # kept in the project dir so it survives clearing the fast disk
+    self.manifest = SessionManifest(self.project_dir / "manifest" / f"sub-{self.animal}" / f"{self.ses_path}.json",
+                                    catalog=self.get_catalog())
+
+  def session_key(self):
+    return f"sub-{self.animal}/{self.ses_path}"
+
+  def session_disk_bytes(self):
+    # estimated space a session needs on the fast disk, from staging session_disk_factor and default_tiff_gb
+    settings = self.config_data.get("staging", {})
+    if os.path.isfile(self.imaging_file_local):
+        tiff_bytes = os.path.getsize(self.imaging_file_local)
+    else:
+        tiff_bytes = settings.get("default_tiff_gb", 40) * GB
+    return int(tiff_bytes * settings.get("session_disk_factor", 2))
 
   def do_suite2p_files_exist(self):
-    if os.path.isdir(self.final_ses_s2p_path):
+    # sessions processed before manifests were kept count as done only if suite2p finished,
+    # a folder holding an interrupted prep is processed again
+    catalog = self.get_catalog()
+    exists = catalog.dir_state(self.final_ses_s2p_path)[0] if catalog is not None else os.path.isdir(self.final_ses_s2p_path)
+    if exists and self.suite2p_finished():
         if not self.check_existing_files(self.final_ses_s2p_path):
             self.logger.info("Suite2p analysis files exist. If you want to re-analyze then either use the overwrite option or delete suite2p analysis files.")
             return True
@@ -157,118 +386,829 @@ class Preprocess():
     else:
         return False
 
+  def suite2p_finished(self):
+    # True if a plane in the session's suite2p folder has suite2p's ROIs and classification
+    planes = (self.final_ses_s2p_path / "suite2p").glob("plane*")
+    return any(os.path.isfile(plane / "stat.npy") and os.path.isfile(plane / "iscell.npy") for plane in planes)
+
   def check_existing_files(self, path_to_check):
     # returns True if it's fine to go ahead and perform analysis
-    if len(os.listdir(path_to_check)) > 0:
-        if self.overwrite == False:
-            self.logger.info(f"Files found in {path_to_check}. If you want to re-download or re-analyze then run the command again with the -o option.")
-            return False
-        else:
-            i = input("Overwrite option is selected. Do you want to analyze again? (y/N)")
-            if i != "y":
-                return False
-            else:
-                return True
-    else:
-        return True
+    catalog = self.get_catalog()
+    n_entries = catalog.dir_state(path_to_check)[1] if catalog is not None else len(os.listdir(path_to_check))
+    if n_entries > 0 and not self.overwrite:
+        self.logger.info(f"Files found in {path_to_check}. If you want to re-download or re-analyze then run the command again with the --overwrite option.")
+        return False
+    return True
+
+  def get_prep_settings(self):
+    # prep options from config, falling back on the old imagej settings for projection and planes
+    prep_settings = self.config_data.get("prep_settings", {})
+    imagej_settings = self.config_data.get("imagej_settings", {})
+
+    settings = {
+        "zplanes": int(prep_settings.get("zplanes", imagej_settings.get("zplanes", 3))),
+        "projection": parse_projection(prep_settings.get("projection", imagej_settings.get("projection", "max"))),
+        "extra_projections": [parse_projection(p) for p in prep_settings.get("extra_projections", [])],
+        "chunk_size": prep_settings.get("chunk_size", 1800),
+        "spatial_bin": int(prep_settings.get("spatial_bin", 1)),
+        "temporal_bin": int(prep_settings.get("temporal_bin", 1)),
+        "output": prep_settings.get("output", "tif"),
+        "compression": prep_settings.get("compression"),
+        "compression_level": prep_settings.get("compression_level", 3),
+        "streaming": prep_settings.get("streaming", True),
+        "n_workers": prep_settings.get("n_workers", 1),
+    }
+    # checked here so a bad config stops the run before any session starts
+    raw_per_frame = settings["zplanes"] * settings["temporal_bin"]
+    if min(settings["zplanes"], settings["spatial_bin"], settings["temporal_bin"]) < 1:
+        raise ValueError("zplanes, spatial_bin and temporal_bin in prep_settings must be at least 1")
+    if settings["chunk_size"] % raw_per_frame != 0:
+        raise ValueError(f"chunk_size ({settings['chunk_size']}) in prep_settings must be divisible by zplanes x temporal_bin ({raw_per_frame})")
+    return settings
+
+  def check_settings(self):
+    # reads the config sections that are checked, so a bad value stops the run before any session starts
+    self.get_prep_settings()
+
+  def get_qc_settings(self):
+    # frame quality checks done during prep, can be changed with frame_qc in config
+    settings = self.config_data.get("frame_qc", {})
+    return {
+        "enabled": settings.get("enabled", True),
+        "stride": settings.get("stride", 4),
+        "saturation_value": settings.get("saturation_value", None),
+        "blank_fraction": settings.get("blank_fraction", 0.2),
+        "jump_mads": settings.get("jump_mads", 10),
+        "max_saturated_fraction": settings.get("max_saturated_fraction", 0.1),
+        "write_bad_frames": settings.get("write_bad_frames", False),
+        "max_bad_fraction": settings.get("max_bad_fraction", 0.2),
+        "skip_bad_sessions": settings.get("skip_bad_sessions", False),
+    }
+
+  def prep_binning(self):
+    # raw frames per z-projection and binning of the suite2p input, as recorded when prep last
+    # ran so frames are counted as in the files suite2p read, or from the config before that
+    recorded = (self.manifest.stages.get("prep_for_s2p") or {}).get("params", {})
+    settings = self.get_prep_settings()
+    return {key: recorded.get(key, settings[key]) for key in ["zplanes", "spatial_bin", "temporal_bin"]}
+
+  def get_alignment_settings(self):
+    # columns holding the timestamps in the Bonsai event and frame files, by position or name
+    settings = self.config_data.get("behav_alignment", {})
+    return {
+        "event_time_column": settings.get("event_time_column", 0),
+        "frame_time_column": settings.get("frame_time_column", 0),
+    }
+
+  def get_dff_settings(self):
+    # neuropil subtraction and dF/F baseline, windows in seconds, can be changed with dff in config
+    settings = self.config_data.get("dff", {})
+    return {
+        "neuropil_coefficient": settings.get("neuropil_coefficient", 0.7),
+        "baseline": settings.get("baseline", "maximin"),
+        "window_seconds": settings.get("window_seconds", 60),
+        "sigma_seconds": settings.get("sigma_seconds", 10),
+        "percentile": settings.get("percentile", 8),
+        "min_baseline": settings.get("min_baseline", 1.0),
+    }
+
+  def get_trial_settings(self):
+    # peri-event windows cut from the traces, can be changed with trials in config
+    settings = self.config_data.get("trials", {})
+    return {
+        "trace": settings.get("trace", "dff"),
+        "pre_seconds": settings.get("pre_seconds", 2),
+        "post_seconds": settings.get("post_seconds", 5),
+        "event_column": settings.get("event_column", None),
+        "event_values": settings.get("event_values", None),
+        "out_of_range": settings.get("out_of_range", "nan"),
+        "only_cells": settings.get("only_cells", True),
+    }
+
+  def get_suite2p_ops(self):
+    # ops that differ from suite2p's defaults, can be changed with suite2p_ops in config
+    ops = {"anatomical_only": 3, "diameter": 20, "reg_tif": True}
+    ops.update(self.config_data.get("suite2p_ops", {}))
+    return ops
+
+  def requested_stages(self, get_data=False, get_behav=False, prep_for_s2p=False, imagej_z=False, do_suite2p=False,
+                       align_behav=False, compute_dff=False, extract_trials=False):
+    flags = {"get_data": get_data, "get_behav": get_behav, "prep_for_s2p": prep_for_s2p,
+             "imagej_zproject": imagej_z, "align_behav": align_behav, "run_suite2p": do_suite2p,
+             "compute_dff": compute_dff, "extract_trials": extract_trials, "copy_from_fast_disk": self.use_fast_dir}
+    return [stage for stage in STAGES if flags[stage]]
+
+  def stage_params(self, stage):
+    # parameters that change the outputs of a stage
+    if stage == "prep_for_s2p":
+        settings = self.get_prep_settings()
+        params = {key: settings[key] for key in ["zplanes", "projection", "extra_projections", "chunk_size", "output",
+                                                 "compression", "compression_level", "spatial_bin", "temporal_bin"]}
+        params["frame_qc"] = self.get_qc_settings()
+        return params
+    if stage == "run_suite2p":
+        return self.get_suite2p_ops()
+    if stage == "align_behav":
+        return dict(self.get_alignment_settings(), **self.prep_binning())
+    if stage == "compute_dff":
+        # the frame rate comes from suite2p's ops, which are part of its inputs
+        return self.get_dff_settings()
+    if stage == "extract_trials":
+        return self.get_trial_settings()
+    return {}
+
+  def stage_outputs(self, stage):
+    # files and folders written by a stage
+    if stage == "get_data":
+        return [self.imaging_file_local]
+    if stage == "get_behav":
+        return [self.event_file_local, self.frame_file_local]
+    if stage == "align_behav":
+        return [self.final_ses_s2p_path / "behav_alignment.npz"]
+    if stage == "prep_for_s2p":
+        outputs = [self.ses_ij_path]
+        if self.get_prep_settings()["output"] == "binary":
+            plane_path = self.ses_s2p_path / "suite2p" / "plane0"
+            outputs += [plane_path / "data.bin", plane_path / "ops.npy"]
+        qc_settings = self.get_qc_settings()
+        if qc_settings["enabled"]:
+            outputs.append(self.final_ses_s2p_path / "frame_qc.csv")
+            if qc_settings["write_bad_frames"]:
+                outputs.append(self.ses_s2p_path / "bad_frames.npy")
+        return outputs
+    if stage == "run_suite2p":
+        return [self.ses_s2p_path / "suite2p"]
+    if stage == "compute_dff":
+        # written next to F.npy in each plane by traces.compute_plane_traces
+        return [plane_path / name for plane_path in sorted((self.ses_s2p_path / "suite2p").glob("plane*"))
+                for name in ["Fcorr.npy", "dff.npy"]]
+    if stage == "extract_trials":
+        return [self.final_ses_s2p_path / name for name in ["trials.npy", "trials_info.npz"]]
+    if stage == "copy_from_fast_disk":
+        return [self.final_ses_s2p_path / "suite2p"]
+    return []
+
+  def in_place_outputs(self, stage):
+    # outputs of a stage that a later stage rewrites in place, suite2p registers the binary
+    # written by prep in data.bin and saves its own ops.npy over prep's
+    if stage == "prep_for_s2p" and self.get_prep_settings()["output"] == "binary":
+        plane_path = self.ses_s2p_path / "suite2p" / "plane0"
+        return [plane_path / "data.bin", plane_path / "ops.npy"]
+    return []
+
+  def stage_inputs(self, stage):
+    # remote files for downloads, otherwise the recorded outputs of the stage before
+    if stage == "get_data":
+        # a new file uploaded to the same remote path changes its size or md5
+        size, md5 = self.get_storage().stat(f"{self.imaging_file_remote}.tif")
+        recorded = (self.manifest.stages.get("get_data") or {}).get("inputs") or {}
+        # downloads recorded before sizes were kept, or a remote that can't be reached now,
+        # are taken to be unchanged
+        if recorded.get("remote") == self.imaging_file_remote and (size is None or "size" not in recorded):
+            return recorded
+        return {"remote": self.imaging_file_remote, "size": size, "md5": md5}
+    if stage == "get_behav":
+        return {"remote": [self.event_file_remote, self.frame_file_remote]}
+    if stage == "align_behav":
+        outputs = self.manifest.outputs("get_behav")
+        return {"get_behav": outputs if outputs is not None else file_records(self.stage_outputs("get_behav"))}
+    if stage == "compute_dff":
+        return {"suite2p": self.suite2p_traces()}
+    if stage == "extract_trials":
+        inputs = {}
+        for upstream in ["compute_dff", "align_behav"]:
+            outputs = self.manifest.outputs(upstream)
+            inputs[upstream] = outputs if outputs is not None else file_records(self.stage_outputs(upstream))
+        return inputs
+    if stage in STAGE_CHAIN[1:]:
+        upstream = STAGE_CHAIN[STAGE_CHAIN.index(stage) - 1]
+        outputs = self.manifest.outputs(upstream)
+        if outputs is None:
+            outputs = file_records(self.stage_outputs(upstream))
+        return {upstream: outputs}
+    return {}
+
+  def suite2p_traces(self):
+    # records of the F.npy and Fneu.npy files in ses_s2p_path, from whichever stage last wrote them there
+    folder = self.ses_s2p_path / "suite2p"
+    traces = {}
+    for stage in ["run_suite2p", "copy_from_fast_disk"]:
+        for record in self.manifest.outputs(stage) or []:
+            path = Path(record["path"])
+            if path.name in ("F.npy", "Fneu.npy") and folder in path.parents:
+                traces[record["path"]] = record
+    if not traces:
+        return file_records(sorted(folder.glob("plane*/F.npy")) + sorted(folder.glob("plane*/Fneu.npy")))
+    return [traces[path] for path in sorted(traces)]
+
+  def outputs_exist(self, stage):
+    # True if the stage's recorded outputs are where this run expects them and still on disk,
+    # using the catalog's last check of those files when there is one
+    if not self.manifest.outputs_expected(stage, self.stage_outputs(stage)):
+        return False
+    catalog = self.get_catalog()
+    if catalog is None:
+        return self.manifest.outputs_exist(stage)
+    outputs = self.manifest.outputs(stage)
+    present = catalog.outputs_present(self.session_key(), stage, outputs)
+    if present is None:
+        present = self.manifest.outputs_exist(stage)
+        catalog.record_outputs(self.session_key(), stage, outputs, present,
+                               finished=self.manifest.stages[stage].get("finished"))
+    return present
+
+  def plan_stages(self, requested):
+    """Works out which of the requested stages need to run using the session manifest.
+
+    A stage runs if it has no record, its inputs or parameters changed, or anything before
+    it in the chain (download -> prep -> suite2p -> copy back) changed. A stage whose record
+    is up to date but whose outputs are missing (e.g. intermediates deleted) only runs again
+    if a later stage needs them or it is the last stage requested. With overwrite every
+    requested stage runs.
+
+    Args:
+        requested (list): Stage names, from requested_stages.
+
+    Returns:
+        list: Stages to run, in order.
+    """
+    if self.overwrite:
+        return list(requested)
+
+    fresh = {}
+    chain_fresh = True
+    for stage in STAGE_CHAIN:
+        if stage in requested or stage in self.manifest.stages:
+            chain_fresh = chain_fresh and self.manifest.is_fresh(stage, self.stage_inputs(stage), self.stage_params(stage))
+        fresh[stage] = chain_fresh
+
+    planned = set()
+    downstream_runs = False
+    requested_chain = [stage for stage in STAGE_CHAIN if stage in requested]
+    for stage in reversed(requested_chain):
+        needed = downstream_runs or stage == requested_chain[-1]
+        if not fresh[stage] or (needed and not self.outputs_exist(stage)):
+            planned.add(stage)
+            downstream_runs = True
+
+    # stages outside the chain rerun whenever the stage they read from runs
+    for stage, upstream in [("get_behav", []), ("align_behav", ["get_behav"]), ("compute_dff", ["run_suite2p"]),
+                            ("extract_trials", ["compute_dff", "align_behav"])]:
+        if stage in requested and (any(u in planned for u in upstream) or not (
+                self.manifest.is_fresh(stage, self.stage_inputs(stage), self.stage_params(stage))
+                and self.outputs_exist(stage))):
+            planned.add(stage)
+
+    # new traces on the fast disk have to be copied back
+    if "compute_dff" in planned and "copy_from_fast_disk" in requested:
+        planned.add("copy_from_fast_disk")
+
+    if "imagej_zproject" in requested:
+        planned.add("imagej_zproject")
+
+    return [stage for stage in requested if stage in planned]
+
+  def run_stage(self, stage):
+    # runs one stage and records it in the manifest and its time, bytes and memory in the
+    # metrics file, returns False if it failed
+    # the old record goes first, so a download records the remote file as it is now
+    self.manifest.invalidate(stage)
+    inputs = self.stage_inputs(stage)
+    params = self.stage_params(stage)
+
+    # kept here as the copy back records the stage from its own thread
+    manifest, outputs, metrics = self.manifest, self.stage_outputs(stage), self.metrics
+    in_place = {str(path) for path in self.in_place_outputs(stage)}
+    catalog, session = self.get_catalog(), self.session_key()
+    if metrics is not None:
+        token = metrics.start(stage, animal=self.animal, date=self.date, session=self.ses_path)
+    # downloads have no local inputs
+    input_bytes = sum(r["size"] for records in inputs.values() if isinstance(records, list) for r in records) \
+        if stage not in ("get_data", "get_behav") else None
+
+    def record(ok=True):
+        records = file_records(outputs) if ok else []
+        # only checked for existence later, see manifest.output_unchanged
+        records = [dict(r, in_place=True) if r["path"] in in_place else r for r in records]
+        if ok and (stage in STAGE_CHAIN or stage in ("get_behav", "align_behav", "compute_dff", "extract_trials")):
+            manifest.record(stage, inputs, params, records)
+            if catalog is not None:
+                catalog.record_outputs(session, stage, records, finished=manifest.stages[stage]["finished"])
+        elif not ok and stage == "copy_from_fast_disk":
+            manifest.record_failure(stage, "copy back from fast disk failed")
+        if metrics is not None:
+            metrics.finish(token, ok, input_bytes=input_bytes, output_bytes=sum(r["size"] for r in records))
+
+    if stage == "copy_from_fast_disk":
+        return self.copy_from_fast_disk(on_done=record) is not False
+    try:
+        ok = getattr(self, stage)() is not False
+    except BaseException:
+        record(False)
+        raise
+    record(ok)
+    return ok
+
+  def session_dirs(self):
+    return [self.ses_imaging_path, self.ses_behav_path, self.ses_ij_path, self.ses_s2p_path]
 
   def make_session_dirs(self):
-    for path in [self.ses_imaging_path, self.ses_behav_path, self.ses_ij_path, self.ses_s2p_path]:
-        if not os.path.isdir(path):
-            os.makedirs(path, exist_ok=True)
+    self.make_dirs(self.session_dirs())
 
   def get_behav(self):
     self.logger.info("Downloading behavioral data...")
-    self.path_to_azcopy = self.config_data["path_to_azcopy"]
 
-    subprocess.call("{} cp {} {}".format(self.path_to_azcopy, self.event_file_remote, self.event_file_local), shell=True)
-    # subprocess.call("{} cp {} {}".format(path_to_azcopy, frame_file_remote, frame_file_local), shell=True)
-    # subprocess.call("{} cp {} {}".format(path_to_azcopy, lick_file_remote, lick_file_local), shell=True)
+    # lick files are not downloaded yet
+    results = self.get_storage().copy_batch([(self.event_file_remote, self.event_file_local),
+                                             (self.frame_file_remote, self.frame_file_local)])
+    failed = [r for r in results if not r.ok]
+    if failed:
+        self.logger.debug(f"Failed to get behavioral data: {[r.message for r in failed]}")
+        return False
+
+  def get_behav_batch(self):
+    """Downloads behavioral data for all planned sessions that need it in one batched transfer.
+
+    Each file that arrives is recorded in its session's manifest, so the per-session
+    get_behav stage is not needed afterwards.
 
+    Returns:
+        list: TransferResult for each file.
+    """
+    pairs, sessions = [], []
+    for animal, date in self.sessions:
+        self.define_animal_paths(animal)
+        if not self.check_valid_combo(animal, date):
+            continue
+        session = copy.copy(self)
+        session.define_session_paths()
+        if session.plan_stages(["get_behav"]):
+            session.make_session_dirs()
+            pairs += [(session.event_file_remote, session.event_file_local),
+                      (session.frame_file_remote, session.frame_file_local)]
+            sessions.append(session)
+
+    self.logger.info(f"Downloading behavioral data for {len(sessions)} sessions...")
+    if not pairs:
+        return []
+    if self.metrics is not None:
+        token = self.metrics.start("get_behav_batch", sessions=len(sessions))
+    results = self.get_storage().copy_batch(pairs)
+
+    # an event file and a frame file for each session
+    for session, session_results in zip(sessions, zip(results[::2], results[1::2])):
+        failed = [r for r in session_results if not r.ok]
+        if not failed:
+            session.manifest.record("get_behav", session.stage_inputs("get_behav"), {},
+                                    file_records(session.stage_outputs("get_behav")))
+        else:
+            self.logger.warning(f"Failed to get behavioral data for {session.animal}, {session.date}: {[r.message for r in failed]}")
+
+    failed = [r for r in results if not r.ok]
+    self.logger.info(f"Downloaded {len(results) - len(failed)} of {len(results)} behavioral files")
+    if self.metrics is not None:
+        output_bytes = sum(os.path.getsize(r.local) for r in results if r.ok)
+        self.metrics.finish(token, not failed, output_bytes=output_bytes)
+    return results
   
-  def get_data(self):
-    if not self.check_existing_files(self.ses_imaging_path):
-        return
+  def align_behav(self):
+    """Finds the imaging frame of every behavioural event and saves them, with the frame times,
+    to behav_alignment.npz in the session's suite2p folder.
+
+    Frames are counted as suite2p sees them, after z-projection and dropping leftover frames.
+    Event file columns are saved as column_<name>, events outside the recording have frame -1.
+    """
+    from behav_alignment import read_timestamps, align_events, column_arrays
+
+    missing = [f for f in (self.event_file_local, self.frame_file_local) if not os.path.isfile(f)]
+    if missing:
+        self.logger.warning(f"Can't align behavior, files are missing: {missing}")
+        return False
+
+    settings = self.get_alignment_settings()
+    binning = self.prep_binning()
+    try:
+        events, event_times = read_timestamps(self.event_file_local, settings["event_time_column"])
+        _, frame_times = read_timestamps(self.frame_file_local, settings["frame_time_column"])
+    except ValueError as e:
+        self.logger.warning(f"Can't align behavior: {e}")
+        return False
+
+    # the tiff is the most reliable frame count, the frame file can have extra rows
+    n_raw_frames = None
+    if os.path.isfile(self.imaging_file_local):
+        with TiffStack(self.imaging_file_local) as im:
+            n_raw_frames = len(im)
+        if n_raw_frames != len(frame_times):
+            self.logger.warning(f"Frame file has {len(frame_times)} rows but the tiff has {n_raw_frames} frames")
 
+    try:
+        aligned = align_events(event_times, frame_times, zplanes=binning["zplanes"],
+                               temporal_bin=binning["temporal_bin"], n_raw_frames=n_raw_frames)
+    except ValueError as e:
+        self.logger.warning(f"Can't align behavior: {e}")
+        return False
+
+    self.make_dirs([self.final_ses_s2p_path])
+    np.savez(self.final_ses_s2p_path / "behav_alignment.npz", event_times=event_times, frame_times=frame_times,
+             **binning, **aligned, **column_arrays(events))
+    outside = int((aligned["event_frames"] < 0).sum())
+    self.logger.info(f"Aligned {len(event_times)} events to {len(aligned['volume_times'])} frames, {outside} outside the recording")
+
+  def get_data(self):
     self.logger.info("Downloading imaging data...")
-    self.path_to_azcopy = self.config_data["path_to_azcopy"]
     print(self.imaging_file_remote)
 
-    azcopy_command = '{} cp "{}.tif" "{}"'.format(self.path_to_azcopy, self.imaging_file_remote, self.imaging_file_local)
-    self.logger.info(f"Trying this... {azcopy_command}")
-    # subprocess.call("{} cp {}.tif {}".format(self.path_to_azcopy, self.imaging_file_remote, self.imaging_file_local), shell=True)
-
-    subprocess.call(azcopy_command, shell=True)
-    if not os.path.exists(self.imaging_file_local):
-        self.logger.debug("Failed to get file using azcopy. Check azcopy log.")
+    # verified against the remote size, retried and resumed from partial files
+    result = self.get_storage().download(f"{self.imaging_file_remote}.tif", self.imaging_file_local)
+    if not result.ok:
+        self.logger.warning(f"Failed to get imaging data after {result.attempts} attempts: {result.message}")
+        self.manifest.record_failure("get_data", result.message, attempts=result.attempts)
+        return False
 
   def prep_for_s2p(self):
-     # get path to image
-
-     # load image
-     im = imageio.imread(self.imaging_file_local)
+     prep_settings = self.get_prep_settings()
+     zplanes = prep_settings["zplanes"]
+     projection = prep_settings["projection"]
+     extra_projections = prep_settings["extra_projections"]
+     spatial_bin, temporal_bin = prep_settings["spatial_bin"], prep_settings["temporal_bin"]
+     # raw frames in each frame written
+     raw_per_frame = zplanes * temporal_bin
+
+     # load image, either lazily (only the frames in each chunk are read) or all at once
+     if prep_settings["streaming"]:
+         im = TiffStack(self.imaging_file_local)
+     else:
+         im = imageio.imread(self.imaging_file_local)
 
      # adjust for remainder
-     im = remove_leftover_frames(im)
+     im = remove_leftover_frames(im, zplanes=raw_per_frame)
+
+     # either save tiff chunks for suite2p to convert, write suite2p's binary directly or
+     # write every projection into one chunked zarr or hdf5 store
+     chunk_size = prep_settings["chunk_size"]
+     output = prep_settings["output"]
+
+     # finished chunks are recorded so an interrupted prep carries on where it stopped, except
+     # for hdf5 where a write cut short can leave the whole file unreadable
+     progress = None
+     if output != "hdf5":
+         progress = PrepProgress(self.ses_ij_path / ".prep_progress",
+                                 {"input": file_record(self.imaging_file_local), "params": self.stage_params("prep_for_s2p")})
+     resume = progress is not None and progress.resuming
+     if resume:
+         for part in self.ses_ij_path.rglob("*.part"):
+             part.unlink()
+     else:
+         # files from an earlier prep, e.g. the extra chunks of a smaller chunk_size, would
+         # otherwise be read by suite2p along with the new ones
+         for path in self.ses_ij_path.iterdir():
+             if path.name == ".prep_progress":
+                 continue
+             if path.is_dir():
+                 shutil.rmtree(path)
+             else:
+                 path.unlink()
+         self.forget_session_files([self.ses_ij_path])
+
+     if output == "binary":
+         self.logger.info(f"Writing suite2p binary to {self.ses_s2p_path}")
+         writers = {projection: Suite2pBinaryWriter(self.ses_s2p_path, frames_per_chunk=chunk_size // raw_per_frame,
+                                                    halve=im.dtype == np.uint16, resume=resume)}
+     elif output in STORE_NAMES:
+         store = ChunkedStore(self.ses_ij_path / STORE_NAMES[output], output,
+                              compression=prep_settings["compression"], level=prep_settings["compression_level"],
+                              resume=resume)
+         self.logger.info(f"Writing projections to {store.path}")
+         attrs = {"zplanes": zplanes, "spatial_bin": spatial_bin, "temporal_bin": temporal_bin, "raw_dtype": str(im.dtype)}
+         writers = {stat: store.writer(stat, len(im) // raw_per_frame, chunk_size // raw_per_frame, dict(attrs, projection=stat))
+                    for stat in dict.fromkeys([projection] + extra_projections)}
+     else:
+         writers = {projection: TiffChunkWriter(self.ses_ij_path)}
+
+     # other projections are kept as tiff chunks in their own folder, e.g. proc_ij/.../mean
+     for extra in extra_projections:
+         if extra not in writers:
+             os.makedirs(self.ses_ij_path / extra, exist_ok=True)
+             writers[extra] = TiffChunkWriter(self.ses_ij_path / extra)
+
+     # frame quality is measured on the raw frames as each chunk is read
+     qc_settings = self.get_qc_settings()
+     qc = None
+     if qc_settings["enabled"]:
+         from frame_qc import FrameQC
+         saturation = qc_settings["saturation_value"]
+         if saturation is None:
+             saturation = np.iinfo(im.dtype).max if np.issubdtype(im.dtype, np.integer) else np.inf
+         qc = FrameQC(len(im), zplanes, saturation, stride=qc_settings["stride"])
+
+     self.logger.info(f"Projecting {zplanes} planes with {list(writers)}")
+     if spatial_bin > 1 or temporal_bin > 1:
+         self.logger.info(f"Binning {spatial_bin}x{spatial_bin} pixels and {temporal_bin} frames")
 
      # process_in_chunks
-     process_in_chunks(im, self.ses_ij_path)
+     process_in_chunks(im, self.ses_ij_path,
+                       chunk_size=chunk_size,
+                       n_workers=prep_settings["n_workers"],
+                       writers=writers,
+                       zplanes=zplanes,
+                       spatial_bin=spatial_bin,
+                       temporal_bin=temporal_bin,
+                       qc=qc,
+                       progress=progress)
+
+     if isinstance(im, TiffStack):
+         im.close()
+     if progress is not None:
+         progress.clear()
+
+     if qc is not None:
+         return self.save_frame_qc(qc, raw_per_frame, qc_settings)
+
+  def save_frame_qc(self, qc, raw_per_frame, qc_settings):
+    """Saves the frame QC table of the session to frame_qc.csv in its suite2p folder and, with
+    write_bad_frames, the suite2p frames holding bad raw frames to bad_frames.npy, where
+    suite2p looks for it.
+
+    Returns:
+        bool: False if the session has too many bad frames and skip_bad_sessions is set.
+    """
+    from frame_qc import bad_suite2p_frames
+
+    thresholds = {key: qc_settings[key] for key in ["blank_fraction", "jump_mads", "max_saturated_fraction"]}
+    table = qc.table(raw_per_frame, **thresholds)
+    self.make_dirs([self.final_ses_s2p_path, self.ses_s2p_path])
+    table.to_csv(self.final_ses_s2p_path / "frame_qc.csv", index=False)
+
+    bad_frames = bad_suite2p_frames(table)
+    if qc_settings["write_bad_frames"]:
+        # suite2p reads bad_frames.npy from the first data_path, which is proc_ij for tiff and
+        # hdf5 input and save_path0 in the ops.npy of a binary written by prep (binary and zarr)
+        np.save(self.ses_s2p_path / "bad_frames.npy", bad_frames)
+        np.save(self.ses_ij_path / "bad_frames.npy", bad_frames)
+        self.logger.info(f"Suite2p will skip the {len(bad_frames)} frames in bad_frames.npy")
+
+    counts = {name: int(table[f"{name}_frame"].sum()) for name in ["blank", "jump", "saturated"]}
+    n_frames = table["suite2p_frame"].nunique() if len(table) else 0
+    bad_fraction = len(bad_frames) / max(n_frames, 1)
+    self.logger.info(f"Frame QC: {len(bad_frames)} of {n_frames} frames bad ({counts})")
+    if bad_fraction > qc_settings["max_bad_fraction"]:
+        message = f"{bad_fraction:.0%} of frames are bad, see {self.final_ses_s2p_path / 'frame_qc.csv'}"
+        self.logger.warning(f"{self.animal}, {self.date}: {message}")
+        if qc_settings["skip_bad_sessions"]:
+            self.manifest.record_failure("prep_for_s2p", message, retryable=False)
+            return False
 
   def imagej_zproject(self):
     print("Processing with imageJ is deprecated. Use older version of process2p to use this option. Use prep_for_s2p instead.")
 
   def run_suite2p(self):
-    if not self.check_existing_files(self.ses_s2p_path):
-        return
+    # ses_s2p_path already holds data.bin when the prep step wrote suite2p's binary
+    prep_settings = self.get_prep_settings()
+    output = prep_settings["output"]
+    binary_input = output in ("binary", "zarr")
+    if output == "zarr":
+        # suite2p can't read zarr so its binary is written from the store, a chunk at a time
+        self.logger.info("Writing suite2p binary from zarr store")
+        store_to_binary(self.ses_ij_path / STORE_NAMES["zarr"], prep_settings["projection"], self.ses_s2p_path)
+
+    if binary_input:
+        db = {'input_format': 'binary', 'data_path': []}
+    elif output == "hdf5":
+        db = {'input_format': 'h5', 'data_path': [self.ses_ij_path],
+              'h5py': [str(self.ses_ij_path / STORE_NAMES["hdf5"])], 'h5py_key': prep_settings["projection"]}
+    else:
+        db = {'data_path': [self.ses_ij_path]}
+
     self.logger.info("Processing with suite2p...")
-    db = {'data_path': [self.ses_ij_path]}
-    ops = default_ops()
-    ops["save_path0"] = str(self.ses_s2p_path)
-    ops["anatomical_only"] = 3
-    ops["diameter"] = 20
-    ops["reg_tif"] = True
+    ops = {"save_path0": str(self.ses_s2p_path)}
+    ops.update(self.get_suite2p_ops())
+    if binary_input and self.delete_intermediates:
+        ops["delete_bin"] = True
+
+    use_worker = worker_settings(self.config_data)["enabled"]
+    if not use_worker:
+        from suite2p import default_ops, run_s2p
 
     try:
-        run_s2p(ops=ops,db=db)
+        if use_worker:
+            # a long-lived worker that already has suite2p and the cellpose model loaded
+            Suite2pClient(self.config_data, self.logger).run_s2p(ops, db)
+        else:
+            full_ops = default_ops()
+            full_ops.update(ops)
+            run_s2p(ops=full_ops,db=db)
     except:
         self.logger.warning("Suite2p has failed. Continuing to next session.")
         shutil.rmtree(self.ses_ij_path)
+        self.forget_session_files([self.ses_ij_path])
         subprocess.call("trash-empty", shell=True)
-        return
+        return False
     
     if self.delete_intermediates:
         self.logger.info("Delete intermediates selected so removing {}".format(self.ses_ij_path))
         shutil.rmtree(self.ses_ij_path)
+    if self.delete_intermediates or ops.get("delete_bin"):
+        # the prep outputs are gone, and with delete_bin so is suite2p's data.bin
+        self.forget_session_files([self.ses_ij_path])
 
-  def copy_from_fast_disk(self):
-    os.makedirs(self.final_ses_s2p_path, exist_ok=True)
+  def compute_dff(self):
+    """Writes neuropil-corrected fluorescence (Fcorr.npy) and dF/F (dff.npy) for every ROI
+    next to suite2p's F.npy in each plane, with the settings from get_dff_settings.
+    """
+    from traces import compute_plane_traces, plane_rate
 
-    subprocess.call("cp {} {} -r".format(self.ses_s2p_path / "suite2p",
-                                         self.final_ses_s2p_path), shell=True)
+    plane_paths = sorted(p.parent for p in (self.ses_s2p_path / "suite2p").glob("plane*/F.npy"))
+    if not plane_paths:
+        self.logger.warning(f"No suite2p traces in {self.ses_s2p_path}, can't compute dF/F")
+        return False
 
-    self.logger.info("Removing files from fast disk {}")
-    shutil.rmtree(self.path_processed)
-    shutil.rmtree(self.path_raw)
+    settings = self.get_dff_settings()
+    self.logger.info(f"Computing dF/F with a {settings['baseline']} baseline for {len(plane_paths)} planes...")
+    for plane_path in plane_paths:
+        # suite2p's default frame rate is 10 Hz
+        fs = plane_rate(plane_path, self.get_suite2p_ops().get("fs", 10.0))
+        try:
+            compute_plane_traces(plane_path, settings, fs)
+        except ValueError as e:
+            self.logger.warning(f"Can't compute dF/F: {e}")
+            return False
 
+  def trace_files(self, name):
+    # a trace file (e.g. dff.npy) of each plane, from the last compute_dff run, or from the
+    # project dir when the fast disk copy is gone
+    paths = [Path(r["path"]) for r in self.manifest.outputs("compute_dff") or [] if Path(r["path"]).name == name]
+    if paths and all(p.is_file() for p in paths):
+        return paths
+    return sorted((self.final_ses_s2p_path / "suite2p").glob(f"plane*/{name}"))
+
+  def extract_trials(self):
+    """Cuts a window around every behavioural event out of the traces of every cell and writes
+    them to trials.npy (cells x trials x time) and trials_info.npz in the session's suite2p
+    folder, see trials.extract_session_trials. Needs align_behav and compute_dff.
+    """
+    from trials import extract_session_trials
+    from traces import plane_rate
+    from roi_matching import select_rois
+
+    settings = self.get_trial_settings()
+    trace_paths = self.trace_files(f"{settings['trace']}.npy")
+    alignment_path = self.final_ses_s2p_path / "behav_alignment.npz"
+    if not trace_paths or not alignment_path.is_file():
+        self.logger.warning(f"Can't extract trials for {self.animal}, {self.date}, run align_behav and compute_dff first")
+        return False
+
+    cell_ids = [select_rois(path.parent, np.load(path, mmap_mode="r").shape[0], settings["only_cells"]) for path in trace_paths]
+    fs = plane_rate(trace_paths[0].parent, self.get_suite2p_ops().get("fs", 10.0))
+    self.make_dirs([self.final_ses_s2p_path])
+    try:
+        n_cells, n_trials, n_time = extract_session_trials(trace_paths, cell_ids, alignment_path,
+                                                           self.final_ses_s2p_path, settings, fs)
+    except ValueError as e:
+        self.logger.warning(f"Can't extract trials: {e}")
+        return False
+    self.logger.info(f"Extracted {n_trials} trials of {n_time} frames for {n_cells} cells")
+
+  def export_trials(self, out_folder):
+    """Joins the trial tensors of all planned sessions into one cohort table, see
+    trials.export_cohort. Sessions without an up to date trial tensor are left out.
+
+    Args:
+        out_folder (Str or Path object): Folder for trials.npy, trials.csv and time.npy.
+
+    Returns:
+        DataFrame: One row per session, cell and trial.
+    """
+    from trials import export_cohort
+
+    sessions = []
+    for animal, date in self.sessions:
+        self.define_animal_paths(animal)
+        if not self.check_valid_combo(animal, date):
+            continue
+        self.define_session_paths()
+        if self.manifest.is_fresh("extract_trials", self.stage_inputs("extract_trials"), self.stage_params("extract_trials")) \
+                and self.outputs_exist("extract_trials"):
+            sessions.append((animal, str(date), self.ses_path, self.final_ses_s2p_path))
+        else:
+            self.logger.warning(f"No up to date trials for {animal}, {date}, leaving it out of the export")
+
+    self.logger.info(f"Exporting trials of {len(sessions)} sessions to {out_folder}")
+    return export_cohort(sessions, out_folder)
+
+  def copy_from_fast_disk(self, on_done=None):
+    # copied in the background so the next session can start, the session's files stay on
+    # the fast disk until the staging manager needs the space
+    return self.staging.copy_back(self.session_key(), self.ses_s2p_path / "suite2p",
+                                  self.final_ses_s2p_path / "suite2p", on_done=on_done)
+
+  def process_session(self, **stages):
+    # runs the selected stages for the session set by check_valid_combo, skipping ones already done
+    # returns the name of the stage that failed or None
+    self.define_session_paths()
+
+    # sessions processed before manifests were kept are skipped if they have suite2p files
+    if not self.manifest.stages and self.do_suite2p_files_exist():
+        return
+
+    requested = self.requested_stages(**stages)
+    planned = self.plan_stages(requested)
+    skipped = [stage for stage in requested if stage not in planned]
+    if skipped:
+        self.logger.info(f"Skipping stages that are already complete: {skipped}")
+    if planned:
+        self.logger.info("Now analysing {}, {}".format(self.animal, self.date))
+    self.make_session_dirs()
+    if self.staging is not None and planned:
+        self.staging.reserve(self.session_key(), self.session_disk_bytes(), self.session_dirs())
+
+    failed_stage = None
+    for stage in planned:
+        if not self.run_stage(stage) and stage in STAGE_CHAIN:
+            self.logger.warning(f"{stage} failed for {self.animal}, {self.date}. Skipping the rest of this session.")
+            failed_stage = stage
+            break
+
+    # sessions that did not start a copy back can be evicted when space is needed
+    if self.staging is not None:
+        self.staging.release(self.session_key())
+    if planned:
+        self.empty_trash()
+
+    return failed_stage
+
+  def empty_trash(self):
     self.logger.info("Emptying trash...")
-    subprocess.call("trash-empty", shell=True)
+    try:
+        subprocess.call("trash-empty", shell=True)
+    except OSError:
+        print("trash-empty command does not work on windows")
+
+  def session_status(self, **stages):
+    """Reports the stages of the session set by check_valid_combo without running anything.
+
+    Only the session manifest and the files it recorded are read, so no processing modules
+    are imported.
+
+    Returns:
+        dict: "stages" maps each stage with a record to "done", "stale" (its inputs,
+            parameters or an earlier stage changed) or "failed", and "pending" lists the
+            requested stages that process_session would run.
+    """
+    self.define_session_paths()
+    if not self.manifest.stages and self.do_suite2p_files_exist():
+        return {"stages": {"run_suite2p": "done"}, "pending": []}
+
+    states = {}
+    fresh = True
+    for stage in STAGES:
+        if stage in self.manifest.failures:
+            states[stage] = "failed"
+        elif stage in self.manifest.stages:
+            if stage in STAGE_CHAIN:
+                # anything after a changed stage is stale as well
+                fresh = fresh and self.manifest.is_fresh(stage, self.stage_inputs(stage), self.stage_params(stage))
+                states[stage] = "done" if fresh else "stale"
+            else:
+                states[stage] = "done" if self.manifest.is_fresh(stage, self.stage_inputs(stage), self.stage_params(stage)) else "stale"
+    return {"stages": states, "pending": self.plan_stages(self.requested_stages(**stages))}
+
+def index_metafile(metadata):
+    """Adds session strings to every row of the metafile at once and indexes rows by (animal, date).
+
+    The session string is ses-<day>-<yyyymmdd>, e.g. ses-001-20230201, and is NaN for rows
+    whose date (dd/mm/yyyy) or day can't be read.
+
+    Args:
+        metadata (DataFrame): Metafile with animal, date and day columns.
+
+    Returns:
+        metadata (DataFrame): Copy with ses_path and day_str columns added.
+        session_index (dict): Maps (animal, date) as strings to the row positions for that pair.
+    """
+    metadata = metadata.copy()
+    dates = pd.to_datetime(metadata["date"], format="%d/%m/%Y", errors="coerce")
+    days = pd.to_numeric(metadata["day"], errors="coerce")
+
+    ses_path = "ses-" + days.astype("Int64").astype(str).str.zfill(3) + "-" + dates.dt.strftime("%Y%m%d")
+    metadata["ses_path"] = ses_path.where(dates.notna() & days.notna())
+    metadata["day_str"] = metadata["day"].astype(str).str.zfill(3)
 
-def get_session_string_from_df(row):
-    day = str(int(row['day'].item())).zfill(3)
-    date_prefix = "ses-{}".format(day)
-    date_obj = datetime.strptime(row["date"].item(), "%d/%m/%Y")
-    date_suffix = date_obj.strftime("%Y%m%d")
-    return date_prefix + "-" + date_suffix
+    session_index = metadata.groupby([metadata["animal"].astype(str), metadata["date"].astype(str)], sort=False).indices
+
+    return metadata, session_index
 
 
     
-def setup_logger(project_dir):
+def setup_logger(project_dir, log_name=None):
     """Sets up logging by creating a logger object and making a directory if needed.
 
     Use by calling logger.info() or logger.debug()
 
     Args:
         project_dir (Str or Path object): Path to folder where log directory will be created.
+        log_name (Str, optional): Added to the name of the log file, e.g. to give each
+            session run by the scheduler its own log. Defaults to None.
 
     Returns:
         logger: Object allowing lines to be added to log. 
@@ -279,10 +1219,13 @@ def setup_logger(project_dir):
     logdir = project_dir / "log"
     
     if not os.path.isdir(logdir):
-        os.mkdir(logdir)
+        os.makedirs(logdir, exist_ok=True)
 
     ## setting up logger
-    logfile = logdir / "{}.log".format(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    logfile_stem = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    if log_name is not None:
+        logfile_stem += "_" + str(log_name).replace("/", "-")
+    logfile = logdir / "{}.log".format(logfile_stem)
 
     logger = logging.getLogger(logfile.as_posix())
     logger.setLevel(level=logging.DEBUG)
@@ -311,32 +1254,465 @@ def setup_logger(project_dir):
 
     return logger
 
-def process_in_chunks(im, savefilepath, chunk_size=1800):
-    
-    if chunk_size % 3 != 0:
-        print("chunk_size must be divisible by 3. Exiting.")
-        return
+class TiffStack():
+    """Lazy, read-only stack of the frames in a multi-page tiff.
+
+    Slicing along the first axis returns another TiffStack without touching the disk,
+    frames are only read when the stack is converted to an array (e.g. np.asarray).
+    The file is memory-mapped when possible (uncompressed, contiguous tiffs) and
+    otherwise read page by page, so memory use depends on the size of each slice
+    and not on the length of the recording.
+
+    Args:
+        path (Str or Path object): Path to tiff file.
+    """
+    def __init__(self, path, _parent=None, _start=0, _stop=None):
+        if _parent is None:
+            self.path = Path(path)
+            self._tif = tifffile.TiffFile(self.path)
+            page = self._tif.pages[0]
+            self.frame_shape = page.shape
+            self.dtype = page.dtype
+            self._nframes = len(self._tif.pages)
+            self._memmap = self._try_memmap()
+        else:
+            self.path = _parent.path
+            self._tif = _parent._tif
+            self.frame_shape = _parent.frame_shape
+            self.dtype = _parent.dtype
+            self._nframes = _parent._nframes
+            self._memmap = _parent._memmap
+
+        self._start = _start
+        self._stop = self._nframes if _stop is None else _stop
+
+    def _try_memmap(self):
+        try:
+            mm = tifffile.memmap(self.path, mode="r")
+        except ValueError:
+            return None
+        mm = mm.reshape(-1, *self.frame_shape)
+        if len(mm) != self._nframes:
+            return None
+        return mm
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.frame_shape)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+
+        if isinstance(key, slice) and key.step in (None, 1) and all(r == slice(None) for r in rest):
+            start, stop, _ = key.indices(len(self))
+            stop = max(start, stop)
+            return TiffStack(None, _parent=self, _start=self._start + start, _stop=self._start + stop)
+
+        return np.asarray(self)[(key,) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        if len(self) == 0:
+            im = np.empty(self.shape, dtype=self.dtype)
+        elif self._memmap is not None:
+            im = np.array(self._memmap[self._start:self._stop])
+        else:
+            im = self._tif.asarray(key=range(self._start, self._stop))
+            im = im.reshape(self.shape)
+
+        if dtype is not None:
+            im = im.astype(dtype, copy=False)
+        return im
+
+    def close(self):
+        self._memmap = None
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def process_in_chunks(im, savefilepath, chunk_size=1800, n_workers=1, writers=None, zplanes=3, spatial_bin=1,
+                      temporal_bin=1, qc=None, progress=None):
+    """Z-projects frames in chunks and saves each chunk.
+
+    Chunks are read in order on the calling thread and handed to a pool of n_workers
+    threads that project and write them, so projection and tiff encoding of several
+    chunks happen at once. At most n_workers chunks are held in memory at a time.
+    Output files are the same whatever the number of workers.
+
+    Args:
+        im (array or TiffStack): Frames to process, first axis is frames.
+        savefilepath (Str or Path object): Folder to save chunk_{i}.tif files in.
+        chunk_size (int, optional): Number of raw frames per chunk. Defaults to 1800.
+        n_workers (int, optional): Number of chunks to process in parallel. Defaults to 1.
+        writers (dict, optional): Maps each projection to compute ("max", "mean", "std"
+            or "sum") to an object with write(i, frames) and close() methods that saves
+            it. All projections are computed from a single read of each chunk. Defaults
+            to a max projection saved by a TiffChunkWriter in savefilepath.
+        zplanes (int, optional): Number of z planes per volume. Defaults to 3.
+        spatial_bin (int, optional): Averages blocks of spatial_bin x spatial_bin pixels of
+            the projected frames, see bin_frames. Defaults to 1.
+        temporal_bin (int, optional): Averages this many consecutive projected frames.
+            Defaults to 1.
+        qc (FrameQC, optional): Measures every raw frame as its chunk is processed.
+            Defaults to None.
+        progress (PrepProgress, optional): Marks each chunk done once written. Chunks it
+            already has are skipped (their raw frames aren't read) and writers with a
+            skip(i, shape) method are told about them. Defaults to None.
+    """
+    if writers is None:
+        writers = {"max": TiffChunkWriter(savefilepath)}
+
+    if chunk_size % (zplanes * temporal_bin) != 0:
+        raise ValueError(f"chunk_size must be divisible by {zplanes * temporal_bin}")
     
     print(f"Processing with chunk_size={chunk_size}")
     
-    print(len(im))
     # Calculate the number of chunks
     num_chunks = len(im) // chunk_size + (len(im) % chunk_size > 0)
-    print(num_chunks)
+    print(f"{len(im)} frames in {num_chunks} chunks")
     
-    for i in range(num_chunks):
-        start = i * chunk_size
-        end = (i + 1) * chunk_size
-        chunk = im[start:end,:,:]
-
-        im2save = np.max(reshape_array(chunk), axis=1)
-        print(im2save.shape)
-        
-        output_filename = f"{savefilepath}/chunk_{i}.tif"
-        imageio.mimwrite(output_filename, im2save, format='TIFF')
-        
+    done = [i for i in range(num_chunks) if progress is not None and progress.done(i)]
+    if done:
+        print(f"Resuming, {len(done)} of {num_chunks} chunks already written")
+    # projected and binned frame shape, for chunks that are skipped
+    frame_shape = (im.shape[1] // spatial_bin, im.shape[2] // spatial_bin)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        pending = deque()
+        previous = None
+        for i in range(num_chunks):
+            start = i * chunk_size
+            end = (i + 1) * chunk_size
+            if i in done:
+                n_out = (min(end, len(im)) - start) // (zplanes * temporal_bin)
+                for writer in writers.values():
+                    if hasattr(writer, "skip"):
+                        writer.skip(i, (n_out,) + frame_shape)
+                if qc is not None:
+                    qc.restore(start, progress.load(i))
+                previous = None
+                continue
+
+            chunk = np.asarray(im[start:end,:,:])
+            if qc is not None and previous is None and start > 0:
+                # only the last volume of a skipped chunk is read again
+                previous = np.asarray(im[start - zplanes:start,:,:])
+
+            pending.append(executor.submit(project_and_save_chunk, chunk, i, writers, zplanes, spatial_bin, temporal_bin,
+                                           qc, start, previous, progress))
+            # the frame-to-frame jump of the next chunk's first volume needs the last one of this chunk
+            previous = chunk[-zplanes:].copy() if qc is not None else None
+
+            # wait for the oldest chunk so only n_workers chunks are in memory at once
+            if len(pending) >= n_workers:
+                pending.popleft().result()
+
+        for future in pending:
+            future.result()
+
+    for writer in writers.values():
+        writer.close()
     print("Finished saving chunks")
 
+def project_and_save_chunk(chunk, i, writers, zplanes=3, spatial_bin=1, temporal_bin=1, qc=None, start=0, previous=None,
+                           progress=None):
+    if qc is not None:
+        qc.measure(start, chunk, previous)
+    projections = project_chunk(chunk, zplanes=zplanes, stats=writers.keys())
+
+    for stat, writer in writers.items():
+        frames = bin_frames(projections[stat], spatial_bin, temporal_bin)
+        writer.write(i, frames)
+
+    if progress is not None:
+        progress.mark(i, **(qc.values(start, len(chunk)) if qc is not None else {}))
+
+def bin_frames(frames, spatial_bin=1, temporal_bin=1):
+    """Averages blocks of spatial_bin x spatial_bin pixels and of temporal_bin frames, keeping
+    the dtype (integer frames are rounded).
+
+    As in project_chunk, each offset within a block is a strided view that is added into one
+    float32 accumulator in place, which is much faster than a mean over the block axes.
+    Rows, columns and frames that don't fill a whole block are dropped, e.g. 2x2 binning of
+    513 x 512 frames gives 256 x 256 frames.
+
+    Args:
+        frames (array): Frames with shape (nframes, y, x).
+        spatial_bin (int, optional): Pixels per block side. Defaults to 1.
+        temporal_bin (int, optional): Frames per block. Defaults to 1.
+
+    Returns:
+        array: Frames with shape (nframes // temporal_bin, y // spatial_bin, x // spatial_bin).
+    """
+    if spatial_bin == 1 and temporal_bin == 1:
+        return frames
+    nframes, y, x = frames.shape
+    t, b = temporal_bin, spatial_bin
+    frames = frames[:nframes - nframes % t, :y - y % b, :x - x % b]
+    blocks = frames.reshape(nframes // t, t, y // b, b, x // b, b)
+    binned = np.zeros((nframes // t, y // b, x // b), dtype=np.float32)
+    for i in range(t):
+        for j in range(b):
+            for k in range(b):
+                np.add(binned, blocks[:, i, :, j, :, k], out=binned)
+    np.divide(binned, t * b * b, out=binned)
+    if frames.dtype.kind in "iu":
+        return np.rint(binned, out=binned).astype(frames.dtype)
+    return binned.astype(frames.dtype, copy=False)
+
+PROJECTIONS = ("max", "mean", "std", "sum")
+
+# names used by imageJ's Z Project (and imagej_settings in old config files)
+PROJECTION_ALIASES = {
+    "max intensity": "max",
+    "average intensity": "mean",
+    "average": "mean",
+    "avg": "mean",
+    "standard deviation": "std",
+    "sum slices": "sum",
+}
+
+def parse_projection(name):
+    projection = name.strip("[] ").lower()
+    projection = PROJECTION_ALIASES.get(projection, projection)
+    if projection not in PROJECTIONS:
+        raise ValueError(f"Unknown projection {name}. Options are {PROJECTIONS}")
+    return projection
+
+def project_chunk(chunk, zplanes=3, stats=("max",)):
+    """Computes one or more z-projections of a chunk in a single pass over its planes.
+
+    Planes are folded into accumulators one at a time with in-place ufuncs, so no
+    temporary the size of the whole chunk is allocated. Max keeps the input dtype,
+    mean, std (population, ddof=0) and sum are float32.
+
+    Args:
+        chunk (array): Frames with shape (nframes, y, x), nframes divisible by zplanes.
+        zplanes (int, optional): Number of z planes per volume. Defaults to 3.
+        stats (iterable, optional): Projections to compute from PROJECTIONS. Defaults to ("max",).
+
+    Returns:
+        dict: Projected frames with shape (nframes / zplanes, y, x) for each stat.
+    """
+    stats = set(stats)
+    if stats - set(PROJECTIONS):
+        raise ValueError(f"Unknown projections {stats - set(PROJECTIONS)}. Options are {PROJECTIONS}")
+    volumes = reshape_array(chunk, zplanes=zplanes)
+    projections = {}
+
+    if "max" in stats:
+        projections["max"] = volumes[:, 0].copy()
+        for plane in range(1, zplanes):
+            np.maximum(projections["max"], volumes[:, plane], out=projections["max"])
+
+    if stats & {"mean", "std", "sum"}:
+        total = volumes[:, 0].astype(np.float32)
+        for plane in range(1, zplanes):
+            np.add(total, volumes[:, plane], out=total)
+
+        if "sum" in stats:
+            projections["sum"] = total if not stats & {"mean", "std"} else total.copy()
+
+        if stats & {"mean", "std"}:
+            mean = total
+            np.divide(mean, zplanes, out=mean)
+            if "std" in stats:
+                # second pass over the planes summing squared deviations from the mean, as
+                # E[x^2] - E[x]^2 in float32 cancels to 0 for bright pixels with little variation
+                squares = np.zeros_like(mean)
+                scratch = np.empty_like(mean)
+                for plane in range(zplanes):
+                    np.subtract(volumes[:, plane], mean, out=scratch, dtype=np.float32)
+                    np.multiply(scratch, scratch, out=scratch)
+                    np.add(squares, scratch, out=squares)
+                np.divide(squares, zplanes, out=squares)
+                projections["std"] = np.sqrt(squares, out=squares)
+            if "mean" in stats:
+                projections["mean"] = mean
+
+    return projections
+
+class TiffChunkWriter():
+    """Saves each projected chunk as savefilepath/chunk_{i}.tif for suite2p to read.
+
+    Chunks are written to chunk_{i}.tif.part and renamed once on disk, so an interrupted
+    write never leaves a truncated chunk_{i}.tif for suite2p to pick up.
+    """
+    def __init__(self, savefilepath):
+        self.savefilepath = savefilepath
+
+    def write(self, i, frames):
+        output_filename = f"{self.savefilepath}/chunk_{i}.tif"
+        part_filename = f"{output_filename}.part"
+        with open(part_filename, "wb") as f:
+            imageio.mimwrite(f, frames, format='TIFF')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part_filename, output_filename)
+
+    def skip(self, i, shape):
+        # chunk_{i}.tif is already complete from an earlier run
+        pass
+
+    def close(self):
+        pass
+
+class PrepProgress():
+    """Records which chunks of process_in_chunks are completely written, so a prep that was
+    interrupted (e.g. the VM was pre-empted) resumes from the chunks still missing.
+
+    Each finished chunk gets a marker file chunk_{i}.npz, written under a temporary name and
+    renamed once every writer has its frames on disk, so a marker only exists for a complete
+    chunk. The marker also keeps the chunk's frame QC, so its raw frames don't need to be
+    read again. progress.json holds a key for the input file and prep parameters, and
+    markers left by a run with another key are deleted.
+
+    Args:
+        folder (Str or Path object): Folder for the progress files, e.g. proc_ij/.../.prep_progress.
+        key (dict): Anything that changes the chunks, e.g. the raw file record and prep parameters.
+    """
+    def __init__(self, folder, key):
+        self.folder = Path(folder)
+        self.key = params_hash(key)
+        header = self.folder / "progress.json"
+        if header.is_file():
+            with open(header) as f:
+                if json.load(f).get("key") != self.key:
+                    self.clear()
+        os.makedirs(self.folder, exist_ok=True)
+        self.resuming = any(self.folder.glob("chunk_*.npz"))
+        if not header.is_file():
+            with open(header, "w") as f:
+                json.dump({"key": self.key}, f)
+
+    def done(self, i):
+        return (self.folder / f"chunk_{i}.npz").is_file()
+
+    def mark(self, i, **arrays):
+        tmp_path = self.folder / f"tmp_chunk_{i}.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.folder / f"chunk_{i}.npz")
+
+    def load(self, i):
+        with np.load(self.folder / f"chunk_{i}.npz") as f:
+            return dict(f)
+
+    def clear(self):
+        # called once prep finished, or when the chunks were written with other settings
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+class Suite2pBinaryWriter():
+    """Writes projected chunks straight into suite2p's raw binary format.
+
+    Frames go to save_path0/suite2p/plane0/data.bin as int16 (uint16 data is halved,
+    as suite2p does when converting tiffs) and close() writes a matching ops.npy,
+    so suite2p can be run with input_format='binary' without converting tiffs.
+    Chunks can be written in any order, chunk i starts at frame i * frames_per_chunk.
+
+    Args:
+        save_path0 (Str or Path object): suite2p save_path0 for the session.
+        frames_per_chunk (int): Number of projected frames in every chunk but the last.
+        halve (bool, optional): Divide frames by 2 before converting to int16. Defaults
+            to halving only uint16 frames, pass True for float projections of uint16 data.
+    """
+    def __init__(self, save_path0, frames_per_chunk, halve=None, resume=False):
+        self.save_path0 = Path(save_path0)
+        self.plane_path = self.save_path0 / "suite2p" / "plane0"
+        os.makedirs(self.plane_path, exist_ok=True)
+
+        self.reg_file = self.plane_path / "data.bin"
+        self.frames_per_chunk = frames_per_chunk
+        self.halve = halve
+        self.nframes = 0
+        self.frame_shape = None
+        self.frame_sum = None
+        self._lock = threading.Lock()
+        # chunks written by an interrupted run are kept when resuming
+        self._fid = open(self.reg_file, "r+b" if resume and self.reg_file.is_file() else "wb")
+
+    def write(self, i, frames):
+        if self.halve or (self.halve is None and frames.dtype == np.uint16):
+            frames = frames // 2
+        if frames.dtype.kind == "f":
+            frames = np.clip(np.rint(frames), -32768, 32767)
+        frames = frames.astype(np.int16, copy=False)
+        frame_sum = frames.sum(axis=0, dtype=np.float64)
+
+        with self._lock:
+            if self.frame_shape is None:
+                self.frame_shape = frames.shape[1:]
+                self.frame_sum = np.zeros(self.frame_shape, dtype=np.float64)
+            self.frame_sum += frame_sum
+            self.nframes = max(self.nframes, i * self.frames_per_chunk + len(frames))
+
+            self._fid.seek(i * self.frames_per_chunk * frames[0].nbytes)
+            self._fid.write(np.ascontiguousarray(frames).tobytes())
+            # on disk before the chunk is marked as done
+            self._fid.flush()
+            os.fsync(self._fid.fileno())
+
+    def skip(self, i, shape):
+        # chunk i is already in data.bin from an earlier run, its frames are read back for meanImg
+        nframes, Ly, Lx = shape
+        offset = i * self.frames_per_chunk * Ly * Lx * 2
+        frames = np.fromfile(self.reg_file, dtype=np.int16, count=nframes * Ly * Lx, offset=offset)
+        frame_sum = frames.reshape(nframes, Ly, Lx).sum(axis=0, dtype=np.float64)
+        with self._lock:
+            if self.frame_shape is None:
+                self.frame_shape = (Ly, Lx)
+                self.frame_sum = np.zeros(self.frame_shape, dtype=np.float64)
+            self.frame_sum += frame_sum
+            self.nframes = max(self.nframes, i * self.frames_per_chunk + nframes)
+
+    def close(self):
+        self._fid.close()
+        if self.frame_shape is None:
+            return
+
+        Ly, Lx = self.frame_shape
+        ops = {
+            "input_format": "binary",
+            "save_path0": str(self.save_path0),
+            "save_folder": "suite2p",
+            "save_path": str(self.plane_path),
+            "fast_disk": str(self.save_path0),
+            "ops_path": str(self.plane_path / "ops.npy"),
+            "reg_file": str(self.reg_file),
+            # suite2p keeps the data_path of an existing binary's ops.npy and looks for
+            # bad_frames.npy in its first folder
+            "data_path": [str(self.save_path0)],
+            "nplanes": 1,
+            "nchannels": 1,
+            "Ly": Ly,
+            "Lx": Lx,
+            "nframes": self.nframes,
+            "frames_per_file": np.array([self.nframes]),
+            "frames_per_folder": np.array([self.nframes]),
+            "meanImg": (self.frame_sum / self.nframes).astype(np.float32),
+        }
+        np.save(self.plane_path / "ops.npy", ops)
+
+def store_to_binary(path, name, save_path0):
+    """Copies a projection from a zarr or hdf5 store into suite2p's binary, one store chunk
+    at a time. uint16 data is halved as when prep writes the binary directly."""
+    array = open_store_array(path, name)
+    frames_per_chunk = array.chunks[0]
+    halve = array.attrs.get("raw_dtype", str(array.dtype)) == "uint16"
+    writer = Suite2pBinaryWriter(save_path0, frames_per_chunk, halve=halve)
+    for i, start in enumerate(range(0, array.shape[0], frames_per_chunk)):
+        writer.write(i, array[start:start + frames_per_chunk])
+    writer.close()
+    if hasattr(array, "file"):
+        array.file.close()
+
 def remove_leftover_frames(im, zplanes=3):
     rem = im.shape[0] % zplanes
 
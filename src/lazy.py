@@ -0,0 +1,23 @@
+### Deferred imports so commands that only plan or report on sessions don't load the processing stack
+import importlib
+
+class LazyModule():
+    """Stands in for a module that is imported the first time one of its attributes is used,
+    e.g. np = LazyModule("numpy") then np.zeros(3). Safe to first use from several threads
+    as importlib's module locks make the import happen once.
+
+    Args:
+        name (str): Module to import.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name} ({state})>"
@@ -0,0 +1,133 @@
+### Per-session record of which stages have finished, with their inputs, parameters and outputs
+import os
+import json
+import hashlib
+from pathlib import Path
+from datetime import datetime
+
+# stages where each one uses the outputs of the one before
+STAGE_CHAIN = ["get_data", "prep_for_s2p", "run_suite2p", "copy_from_fast_disk"]
+
+def file_record(path):
+    """Returns size and mtime of a file so changes to it can be spotted, or None if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {"path": str(path), "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+def file_records(paths):
+    """Returns file_record for each file in paths, walking into any folders."""
+    records = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            records += [file_record(f) for f in sorted(path.rglob("*")) if f.is_file()]
+        elif path.exists():
+            records.append(file_record(path))
+    return records
+
+def output_unchanged(record):
+    """Returns True if a recorded output is still on disk as recorded. Outputs marked in_place
+    are rewritten by a later stage (e.g. suite2p registering the binary prep wrote), so they
+    only have to exist."""
+    if record.get("in_place"):
+        return os.path.isfile(record["path"])
+    return file_record(record["path"]) == record
+
+def params_hash(params):
+    """Returns a short hash of a dict of parameters (values that can't be stored in json are hashed as strings)."""
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+class SessionManifest():
+    """Json file recording, for each stage of one session, the inputs it was run on, a hash of
+    its parameters and the files it wrote. A stage whose record still matches does not need to
+    be run again.
+
+    Args:
+        path (Str or Path object): Path to the json file, created when the first stage is recorded.
+        catalog (ProjectCatalog, optional): Catalog holding a copy of the manifest, read instead
+            of the file when it has one. Defaults to None.
+    """
+    def __init__(self, path, catalog=None):
+        self.path = Path(path)
+        self.catalog = catalog
+        contents = catalog.get_manifest(self.path) if catalog is not None else None
+        if contents is None and self.path.is_file():
+            with open(self.path) as f:
+                contents = json.load(f)
+            if catalog is not None:
+                catalog.put_manifest(self.path, contents)
+        contents = contents or {}
+        self.stages = contents.get("stages", {})
+        self.failures = contents.get("failures", {})
+
+    def outputs(self, stage):
+        # recorded outputs of a stage or None if it has no record
+        if stage not in self.stages:
+            return None
+        return self.stages[stage]["outputs"]
+
+    def is_fresh(self, stage, inputs, params):
+        # True if the stage was last run with these inputs and parameters
+        record = self.stages.get(stage)
+        if record is None:
+            return False
+        return record["inputs"] == inputs and record["params_hash"] == params_hash(params)
+
+    def outputs_expected(self, stage, expected):
+        # True if the stage has a record and every output is inside the expected paths
+        # (e.g. not left on the fast disk by another run), without touching the disk
+        record = self.stages.get(stage)
+        if record is None:
+            return False
+        expected = [Path(p) for p in expected]
+        return all(any(Path(o["path"]) == p or p in Path(o["path"]).parents for p in expected) for o in record["outputs"])
+
+    def outputs_exist(self, stage, expected=None):
+        # True if every output of the stage is still on disk unchanged and, if expected
+        # paths are given, inside them
+        record = self.stages.get(stage)
+        if record is None:
+            return False
+        if expected is not None and not self.outputs_expected(stage, expected):
+            return False
+        outputs = record["outputs"]
+        return len(outputs) > 0 and all(output_unchanged(o) for o in outputs)
+
+    def record(self, stage, inputs, params, outputs):
+        self.stages[stage] = {
+            "inputs": inputs,
+            "params": json.loads(json.dumps(params, sort_keys=True, default=str)),
+            "params_hash": params_hash(params),
+            "outputs": outputs,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+        }
+        self.failures.pop(stage, None)
+        self.save()
+
+    def record_failure(self, stage, message, attempts=1, retryable=True):
+        # failed stages are kept so schedulers can decide whether to try the session again
+        self.failures[stage] = {
+            "message": message,
+            "attempts": attempts,
+            "retryable": retryable,
+            "failed": datetime.now().isoformat(timespec="seconds"),
+        }
+        self.save()
+
+    def invalidate(self, stage):
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        # write to a temporary file first so an interrupted run never leaves half a manifest
+        os.makedirs(self.path.parent, exist_ok=True)
+        tmp_path = self.path.with_suffix(".json.tmp")
+        contents = {"stages": self.stages, "failures": self.failures}
+        with open(tmp_path, "w") as f:
+            json.dump(contents, f, indent=2)
+        os.replace(tmp_path, self.path)
+        if self.catalog is not None:
+            self.catalog.put_manifest(self.path, contents)
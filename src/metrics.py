@@ -0,0 +1,140 @@
+### Per-stage timing, bytes moved and peak memory, written to a json-lines file for each run
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # windows, peak memory falls back to None
+    resource = None
+
+MB = 1024 ** 2
+
+def current_rss():
+    """Returns resident memory of this process in bytes, or None if it can't be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def process_peak_rss():
+    """Returns the peak resident memory of this process so far in bytes, or None."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def io_counters():
+    """Returns (bytes read, bytes written) by this process through read/write calls, which
+    includes files on network shares, or (None, None) where /proc is not available."""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+class StageMetrics():
+    """Records wall time, bytes and peak memory of each stage to a json-lines file.
+
+    Peak memory is sampled every interval seconds by a background thread while any stage
+    is running. It is the memory of the whole process, so stages overlapping in --pipeline
+    mode share their peaks, as do the process-wide io counters. input_bytes and
+    output_bytes are the sizes of the files the stage read and wrote.
+
+    Args:
+        path (Str or Path object): Json-lines file, appended to so worker processes of a
+            run can share it.
+        interval (float, optional): Seconds between memory samples. Defaults to 0.2.
+    """
+    def __init__(self, path, interval=0.2):
+        self.path = str(path)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = {}
+        self._next_id = 0
+        self._sampler = None
+
+    def start(self, stage, **fields):
+        # returns a token passed to finish
+        read, written = io_counters()
+        with self._lock:
+            token = self._next_id
+            self._next_id += 1
+            self._active[token] = {"stage": stage, **fields, "start": time.time(), "perf": time.perf_counter(),
+                                   "io_read": read, "io_write": written, "peak_rss": current_rss() or 0}
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        return token
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                rss = current_rss() or 0
+                for record in self._active.values():
+                    record["peak_rss"] = max(record["peak_rss"], rss)
+            time.sleep(self.interval)
+
+    def finish(self, token, ok=True, input_bytes=None, output_bytes=None):
+        """Ends a stage and appends its record to the metrics file."""
+        read, written = io_counters()
+        with self._lock:
+            record = self._active.pop(token)
+        seconds = time.perf_counter() - record.pop("perf")
+        peak = max(record.pop("peak_rss"), current_rss() or 0) or process_peak_rss()
+
+        record.update({
+            "start": datetime.fromtimestamp(record["start"]).isoformat(timespec="seconds"),
+            "seconds": round(seconds, 3),
+            "ok": ok,
+            "input_bytes": input_bytes,
+            "output_bytes": output_bytes,
+            "io_read": read - record["io_read"] if read is not None else None,
+            "io_write": written - record["io_write"] if written is not None else None,
+            "peak_rss_mb": round(peak / MB, 1) if peak else None,
+            "pid": os.getpid(),
+        })
+        self.write(record)
+        return record
+
+    def write(self, record):
+        # one write call per line so lines from several processes don't interleave
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def summary(self):
+        """Returns a table of time, bytes and peak memory for each stage in this run. MB/s is
+        the larger of the bytes read and written over the stage's total time."""
+        stages = {}
+        for record in self.read():
+            stages.setdefault(record["stage"], []).append(record)
+
+        lines = [f"{'stage':<20} {'runs':>5} {'failed':>6} {'total s':>9} {'mean s':>8} {'GB in':>8} {'GB out':>8}"
+                 f" {'MB/s':>8} {'peak MB':>8}"]
+        for stage, records in stages.items():
+            seconds = sum(r["seconds"] for r in records)
+            input_bytes = sum(r["input_bytes"] or 0 for r in records)
+            output_bytes = sum(r["output_bytes"] or 0 for r in records)
+            rate = max(input_bytes, output_bytes) / MB / seconds if seconds else 0
+            peaks = [r["peak_rss_mb"] for r in records if r["peak_rss_mb"] is not None]
+            lines.append(f"{stage:<20} {len(records):>5} {sum(not r['ok'] for r in records):>6} {seconds:>9.1f}"
+                         f" {seconds / len(records):>8.1f} {input_bytes / 1024 ** 3:>8.2f} {output_bytes / 1024 ** 3:>8.2f}"
+                         f" {rate:>8.1f} {(max(peaks) if peaks else 0):>8.0f}")
+        return "\n".join(lines)
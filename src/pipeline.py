@@ -0,0 +1,133 @@
+### Overlaps downloading, prepping and suite2p for consecutive sessions
+import copy
+import queue
+import threading
+
+class SessionPipeline():
+    """Runs sessions as a producer/consumer pipeline so that downloading the next sessions
+    happens while the current one is prepped and run through suite2p.
+
+    Each stage (download, prep, suite2p) has its own thread and works through the sessions
+    in order, handing them on through bounded queues of size prefetch. When a fast disk is
+    used, downloads also wait until the staging manager has room for the session.
+
+    Options are read from the pipeline section of the config file: prefetch (defaults to 1).
+
+    Args:
+        preprocess (Preprocess): Object with sessions planned and paths defined.
+        stages (dict): Stages to run, same keyword arguments as Preprocess.process_session.
+        prefetch (int, optional): Overrides prefetch in the config. Defaults to None.
+    """
+    def __init__(self, preprocess, stages, prefetch=None):
+        self.preprocess = preprocess
+        self.stages = stages
+        self.logger = preprocess.logger
+
+        settings = preprocess.config_data.get("pipeline", {})
+        self.prefetch = max(1, prefetch or settings.get("prefetch", 1))
+        self.failed = []
+
+    def sessions(self):
+        # yields a copy of preprocess for each session that needs processing
+        preprocess = self.preprocess
+        for animal, date in preprocess.sessions:
+            preprocess.define_animal_paths(animal)
+            if not preprocess.check_valid_combo(animal, date):
+                continue
+            session = copy.copy(preprocess)
+            session.define_session_paths()
+            if not session.manifest.stages and session.do_suite2p_files_exist():
+                continue
+
+            # stages already complete according to the session manifest are skipped
+            session.planned = session.plan_stages(session.requested_stages(**self.stages))
+            if not session.planned:
+                session.logger.info(f"All stages complete for {animal}, {date}")
+                continue
+            session.logger.info("Now analysing {}, {}".format(animal, date))
+            session.make_session_dirs()
+            yield session
+
+    def run_step(self, session, stage, required=True):
+        # runs a planned stage, returns False and records the session as failed if it fails
+        if stage not in session.planned:
+            return True
+        try:
+            ok = session.run_stage(stage)
+        except Exception as e:
+            self.logger.warning(f"{stage} failed for {session.animal}, {session.date}: {e!r}")
+            ok = False
+        if not ok and required:
+            self.logger.warning(f"Skipping the rest of {session.animal}, {session.date}.")
+            self.failed.append((session.animal, session.date, stage))
+        return ok
+
+    def finish(self, session):
+        # no-op for sessions already copying back
+        if session.staging is not None:
+            session.staging.release(session.session_key())
+        session.empty_trash()
+
+    def download_stage(self, out_queue):
+        try:
+            for session in self.sessions():
+                if session.staging is not None:
+                    session.staging.reserve(session.session_key(), session.session_disk_bytes(), session.session_dirs())
+
+                ok = self.run_step(session, "get_data") and self.run_step(session, "get_behav")
+
+                if ok:
+                    out_queue.put(session)
+                else:
+                    self.finish(session)
+        finally:
+            # always let the later stages know there is nothing more coming
+            out_queue.put(None)
+
+    def prep_stage(self, in_queue, out_queue):
+        while True:
+            session = in_queue.get()
+            if session is None:
+                break
+            ok = self.run_step(session, "prep_for_s2p") and self.run_step(session, "imagej_zproject")
+            # suite2p doesn't need the alignment, so it runs even if this fails
+            if ok:
+                self.run_step(session, "align_behav", required=False)
+
+            if ok:
+                out_queue.put(session)
+            else:
+                self.finish(session)
+        out_queue.put(None)
+
+    def suite2p_stage(self, in_queue):
+        while True:
+            session = in_queue.get()
+            if session is None:
+                break
+            if self.run_step(session, "run_suite2p"):
+                # the traces are copied back with the rest of the suite2p folder
+                self.run_step(session, "compute_dff", required=False)
+                self.run_step(session, "extract_trials", required=False)
+                self.run_step(session, "copy_from_fast_disk")
+            self.finish(session)
+
+    def run(self):
+        self.logger.info(f"Running pipeline with prefetch={self.prefetch}")
+        prep_queue = queue.Queue(maxsize=self.prefetch)
+        suite2p_queue = queue.Queue(maxsize=self.prefetch)
+
+        threads = [
+            threading.Thread(target=self.download_stage, args=(prep_queue,), name="download"),
+            threading.Thread(target=self.prep_stage, args=(prep_queue, suite2p_queue), name="prep"),
+            threading.Thread(target=self.suite2p_stage, args=(suite2p_queue,), name="suite2p"),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.preprocess.staging is not None:
+            self.preprocess.staging.wait()
+
+        self.logger.info(f"Pipeline finished, {len(self.failed)} steps failed: {self.failed}")
+        return self.failed
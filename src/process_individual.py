@@ -7,6 +7,8 @@ import json
 import subprocess
 
 from helper_fx import Preprocess, setup_logger
+from scheduler import SessionScheduler
+from pipeline import SessionPipeline
 
 # figure out better way of doing command line arguments
 @click.command()
@@ -15,19 +17,30 @@ from helper_fx import Preprocess, setup_logger
 @click.option("--animals", "-a", type=str, default="", help="List of animals to be processed")
 @click.option("--dates", "-d", type=str, default="", help="List of dates to be processed")
 @click.option("--use-fast-dir", "-f", type=bool, is_flag=True, help="Path to fast directory, important when using with a VM and file share to speed up")
-@click.option("--overwrite", type=bool, is_flag=True, help="Choose if you want the option to overwrite files")
+@click.option("--overwrite", type=bool, is_flag=True, help="Reruns all selected stages even if the session manifest says they are complete")
 @click.option("--get-behav", "-b", type=bool, is_flag=True, help="To download behavioral data from Azure")
 @click.option("--get-data", "-g", type=bool, is_flag=True, help="To download imaging data from Azure")
 @click.option("--prep-for-s2p", "-p", type=bool, is_flag=True, help="To prep for suite2p (zproject and chunking)")
 @click.option("--imagej-z", "-i", type=bool, is_flag=True, help="Processes with image j and does z projection")
 @click.option("--do-suite2p", "-s", type=bool, is_flag=True, help="Runs suite2p on processed tifs")
+@click.option("--align-behav", "-A", type=bool, is_flag=True, help="Finds the imaging frame of each behavioral event")
+@click.option("--compute-dff", "-D", type=bool, is_flag=True, help="Computes neuropil-corrected traces and dF/F from the suite2p output")
+@click.option("--extract-trials", "-T", type=bool, is_flag=True, help="Cuts the traces of every cell around each behavioral event")
 @click.option("--delete_intermediates", "-X", type=bool, is_flag=True, help="When selected, will delete raw data and imageJ files")
-def run_processing(config_file, get_metafile, animals, dates, use_fast_dir, overwrite, get_behav, get_data, prep_for_s2p, imagej_z, do_suite2p, delete_intermediates):
+@click.option("--jobs", "-j", type=int, default=1, help="Number of sessions to process at once in separate processes (limited by scheduler memory_gb in config)")
+@click.option("--pipeline", "-P", type=bool, is_flag=True, help="Downloads the next sessions while the current one is prepped and run through suite2p")
+@click.option("--prefetch", type=int, default=None, help="Number of sessions to queue between pipeline stages (overrides pipeline prefetch in config)")
+@click.option("--suite2p-worker", "-w", type=bool, is_flag=True, help="Runs suite2p in a long-lived worker process that keeps suite2p and the cellpose model loaded (started if not running)")
+@click.option("--reconcile-catalog", type=bool, is_flag=True, help="Checks the project catalog against the disk before planning, e.g. after deleting or moving files by hand")
+@click.option("--dry-run", type=bool, is_flag=True, help="Shows the sessions that would be processed and exits")
+def run_processing(config_file, get_metafile, animals, dates, use_fast_dir, overwrite, get_behav, get_data, prep_for_s2p, imagej_z, do_suite2p, align_behav, compute_dff, extract_trials, delete_intermediates, jobs, pipeline, prefetch, suite2p_worker, reconcile_catalog, dry_run):
 
     # finds and opens config file
     print(f"The config file is {config_file}")
     f = open(config_file)
     config_data = json.load(f)
+    if suite2p_worker:
+        config_data.setdefault("suite2p_worker", {})["enabled"] = True
 
     # Initializes class
     preprocess = Preprocess(config_data, use_fast_dir, overwrite, delete_intermediates)
@@ -38,6 +51,13 @@ def run_processing(config_file, get_metafile, animals, dates, use_fast_dir, over
     # Sets up logger and make directory if needed
     preprocess.set_logger()
 
+    # Records time, bytes and memory of each stage in a metrics file next to the log
+    preprocess.set_metrics()
+
+    # Folders, manifests and stage outputs are looked up in the catalog instead of on disk
+    if reconcile_catalog:
+        preprocess.reconcile_catalog()
+
     # Gets metafile if requested
     if get_metafile:
         preprocess.get_metafile()
@@ -51,46 +71,53 @@ def run_processing(config_file, get_metafile, animals, dates, use_fast_dir, over
     # Parses dates
     preprocess.parse_dates(dates)
 
+    # Stops on settings that would only fail once a session reaches the stage using them
+    preprocess.check_settings()
+
+    # Finds the sessions to run and reports missing or duplicated rows before starting
+    preprocess.plan_sessions()
+    if dry_run:
+        preprocess.show_sessions()
+        return
+
     # Sets up paths and directories
     preprocess.define_root()
     preprocess.define_nwb_paths()
 
-    for animal in preprocess.animals:
-        preprocess.define_animal_paths(animal)
-        for date in preprocess.dates:
-            print(f"{animal}, {date}")
-            if not preprocess.check_valid_combo(animal, date):
-                continue
+    stages = dict(get_data=get_data, get_behav=get_behav, prep_for_s2p=prep_for_s2p,
+                  imagej_z=imagej_z, do_suite2p=do_suite2p, align_behav=align_behav,
+                  compute_dff=compute_dff, extract_trials=extract_trials)
 
-            # define paths and check if suite2p files already exist
-            preprocess.define_session_paths()
-            if preprocess.do_suite2p_files_exist():
-               continue
-            preprocess.make_session_dirs()
-               
-            if get_data:
-               preprocess.get_data()
+    # behavioral files are small so all sessions are fetched in one batch up front
+    if get_behav:
+        preprocess.get_behav_batch()
+        stages["get_behav"] = False
 
-            if get_behav:
-               preprocess.get_behav()
+    # runs several sessions at once in separate processes
+    if jobs > 1:
+        scheduler = SessionScheduler(preprocess, stages, max_jobs=jobs)
+        scheduler.run()
 
-            if prep_for_s2p:
-                preprocess.prep_for_s2p()
+    # overlaps downloads with prep and suite2p
+    elif pipeline:
+        session_pipeline = SessionPipeline(preprocess, stages, prefetch=prefetch)
+        session_pipeline.run()
 
-            if imagej_z:
-               preprocess.imagej_zproject()
+    else:
+        for animal, date in preprocess.sessions:
+            print(f"{animal}, {date}")
+            preprocess.define_animal_paths(animal)
+            if not preprocess.check_valid_combo(animal, date):
+                continue
 
-            if do_suite2p:
-               preprocess.run_suite2p()
+            # define paths, check if suite2p files already exist and run selected stages
+            preprocess.process_session(**stages)
 
-            if use_fast_dir:
-               preprocess.copy_from_fast_disk()
+        # waits for suite2p files still being copied back from the fast disk
+        if preprocess.staging is not None:
+            preprocess.staging.wait()
 
-            preprocess.logger.info("Emptying trash...")
-            try:
-                subprocess.call("trash-empty", shell=True)
-            except:
-                print("trash-empty command does not work on windows")
+    preprocess.logger.info("Stage metrics for this run:\n" + preprocess.metrics.summary())
 
 if __name__ == "__main__":
     print("processing stuff")
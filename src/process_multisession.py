@@ -14,7 +14,7 @@ from helper_fx import Preprocess, setup_logger
 @click.option("--animals", "-a", type=str, default="", help="List of animals to be processed")
 @click.option("--dates", "-d", type=str, default="", help="List of dates to be processed")
 @click.option("--use-fast-dir", "-f", type=bool, is_flag=True, help="Path to fast directory, important when using with a VM and file share to speed up")
-@click.option("--overwrite", type=bool, is_flag=True, help="Choose if you want the option to overwrite files")
+@click.option("--overwrite", type=bool, is_flag=True, help="Builds a new reference and registers every session again")
 @click.option("--delete_intermediates", "-X", type=bool, is_flag=True, help="When selected, will delete raw data and imageJ files")
 def run_processing(config_file, get_metafile, animals, dates, use_fast_dir, overwrite, delete_intermediates):
     print("run")
@@ -52,16 +52,23 @@ def run_processing(config_file, get_metafile, animals, dates, use_fast_dir, over
         preprocess.logger.info("Exiting as only one date given. Script is designed to look at 2 or more sessions")
         sys.exit(2)
 
+    # Finds the sessions in the metafile for this animal
+    preprocess.plan_sessions()
+
     # Sets up paths and directories
     preprocess.define_root()
     preprocess.define_nwb_paths()
-    preprocess.define_multisession_paths() # need to define multiple paths for rawdata and imagej data using dates
-
+    preprocess.define_animal_paths(preprocess.animals[0])
+    preprocess.define_multisession_paths()
 
-# need to decide on file structure
-# function to create 
-# then look for existing registered tiffs
+    # Registers each session's mean image to a common reference, reusing cached transforms
+    transforms = preprocess.register_sessions()
+    if not transforms:
+        preprocess.logger.info("Exiting as no sessions could be registered")
+        return
 
+    # Tracks ROIs across the registered sessions, reusing cached session pair matches
+    preprocess.match_rois(transforms)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+### Registers suite2p mean images from sessions of one animal to a common reference
+import os
+import json
+from pathlib import Path
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from manifest import file_record, params_hash
+
+def taper(shape, fraction=0.1):
+    """2d window that fades the image edges to zero so they don't dominate the correlation."""
+    windows = []
+    for n in shape:
+        edge = max(1, int(n * fraction))
+        window = np.ones(n, dtype=np.float32)
+        ramp = 0.5 - 0.5 * np.cos(np.pi * np.arange(edge) / edge)
+        window[:edge], window[-edge:] = ramp, ramp[::-1]
+        windows.append(window)
+    return windows[0][:, None] * windows[1][None, :]
+
+def phase_correlate(reference, images, max_shift=None, smooth_sigma=1.15):
+    """Finds the shifts that align images to reference by phase correlation.
+
+    All images (and, for non-rigid blocks, their references) are correlated in one batched
+    FFT. The peak is refined to subpixel precision with a parabola through its neighbours.
+
+    Args:
+        reference (array): (..., Ly, Lx) reference, broadcast against images.
+        images (array): (..., Ly, Lx) images to align.
+        max_shift (int, optional): Largest shift searched in pixels. Defaults to half the image.
+        smooth_sigma (float, optional): Gaussian smoothing of the correlation in pixels. Defaults to 1.15.
+
+    Returns:
+        shifts (array): (..., 2) shift (dy, dx) to apply to each image.
+        peaks (array): (...) height of the correlation peak, higher for a better match.
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    images = np.asarray(images, dtype=np.float32)
+    Ly, Lx = images.shape[-2:]
+    window = taper((Ly, Lx))
+
+    def spectrum(x):
+        return np.fft.rfft2((x - x.mean(axis=(-2, -1), keepdims=True)) * window)
+
+    # whitened cross power, smoothed with a gaussian (as suite2p does) so the frequencies
+    # with almost no power don't swamp the peak
+    cross = spectrum(reference) * np.conj(spectrum(images))
+    cross /= np.abs(cross) + 1e-6
+    ky = np.fft.fftfreq(Ly)[:, None]
+    kx = np.fft.rfftfreq(Lx)[None, :]
+    cross *= np.exp(-2 * (np.pi * smooth_sigma) ** 2 * (ky ** 2 + kx ** 2))
+    corr = np.fft.fftshift(np.fft.irfft2(cross, s=(Ly, Lx)), axes=(-2, -1))
+
+    # only look for peaks within max_shift of zero shift
+    cy, cx = Ly // 2, Lx // 2
+    if max_shift is not None:
+        yy, xx = np.ogrid[:Ly, :Lx]
+        corr = np.where((np.abs(yy - cy) <= max_shift) & (np.abs(xx - cx) <= max_shift), corr, -np.inf)
+
+    flat = corr.reshape(corr.shape[:-2] + (-1,))
+    best = flat.argmax(axis=-1)
+    py, px = np.unravel_index(best, (Ly, Lx))
+    peaks = np.take_along_axis(flat, best[..., None], axis=-1)[..., 0]
+
+    def refine(minus, centre, plus):
+        minus, plus = np.where(np.isfinite(minus), minus, centre), np.where(np.isfinite(plus), plus, centre)
+        denom = minus - 2 * centre + plus
+        return np.where(denom < 0, 0.5 * (minus - plus) / np.where(denom < 0, denom, 1), 0)
+
+    def at(y, x):
+        return np.take_along_axis(flat, (np.clip(y, 0, Ly - 1) * Lx + np.clip(x, 0, Lx - 1))[..., None], axis=-1)[..., 0]
+
+    dy = py - cy + refine(at(py - 1, px), peaks, at(py + 1, px))
+    dx = px - cx + refine(at(py, px - 1), peaks, at(py, px + 1))
+    return np.stack([dy, dx], axis=-1), peaks
+
+def shift_images(images, shifts):
+    """Shifts each image by (dy, dx) with a Fourier phase ramp, so subpixel shifts don't blur."""
+    images = np.asarray(images, dtype=np.float32)
+    Ly, Lx = images.shape[-2:]
+    ky = np.fft.fftfreq(Ly)[:, None]
+    kx = np.fft.rfftfreq(Lx)[None, :]
+    shifts = np.asarray(shifts, dtype=np.float64)
+    ramp = np.exp(-2j * np.pi * (ky * shifts[..., 0, None, None] + kx * shifts[..., 1, None, None]))
+    return np.fft.irfft2(np.fft.rfft2(images) * ramp, s=(Ly, Lx)).astype(np.float32)
+
+def block_starts(n, block_size):
+    # block starts with half a block of overlap, the last block ends at the edge
+    block_size = min(block_size, n)
+    count = max(1, int(np.ceil(2 * n / block_size)) - 1)
+    return np.linspace(0, n - block_size, count).astype(int), block_size
+
+def nonrigid_shifts(reference, image, block_size=128, max_shift=10, min_peak=0.05):
+    """Shifts of overlapping blocks of image against the same blocks of reference, all
+    blocks correlated in one batch. Blocks with a weak peak take the median shift.
+
+    Returns:
+        shifts (array): (ny, nx, 2) shift of each block.
+        centres (tuple): y and x centres of the blocks.
+    """
+    ys, by = block_starts(image.shape[0], block_size)
+    xs, bx = block_starts(image.shape[1], block_size)
+    windows = np.lib.stride_tricks.sliding_window_view
+    ref_blocks = windows(reference, (by, bx))[ys][:, xs]
+    img_blocks = windows(image, (by, bx))[ys][:, xs]
+
+    shifts, peaks = phase_correlate(ref_blocks, img_blocks, max_shift=max_shift)
+    weak = peaks < min_peak
+    if weak.any() and not weak.all():
+        shifts[weak] = np.median(shifts[~weak], axis=0)
+    elif weak.all():
+        shifts[:] = 0
+    return shifts, (ys + by / 2, xs + bx / 2)
+
+def dense_field(block_shifts, centres, shape):
+    """Interpolates block shifts to a (2, Ly, Lx) shift for every pixel."""
+    iy = np.interp(np.arange(shape[0]), centres[0], np.arange(len(centres[0])))
+    ix = np.interp(np.arange(shape[1]), centres[1], np.arange(len(centres[1])))
+    coords = np.meshgrid(iy, ix, indexing="ij")
+    return np.stack([ndimage.map_coordinates(block_shifts[..., k], coords, order=1, mode="nearest") for k in range(2)])
+
+def apply_transform(image, transform):
+    """Applies a transform from SessionRegistration (rigid shift, then block shifts) to an image."""
+    out = shift_images(image, transform["shift"])
+    if "block_shifts" in transform:
+        field = dense_field(transform["block_shifts"], (transform["centres_y"], transform["centres_x"]), out.shape)
+        yy, xx = np.mgrid[:out.shape[0], :out.shape[1]]
+        out = ndimage.map_coordinates(out, [yy - field[0], xx - field[1]], order=1, mode="nearest")
+    return out
+
+def transform_points(points, transform):
+    """Maps (n, 2) pixel coordinates (y, x) of a session into the reference."""
+    points = np.asarray(points, dtype=np.float64) + transform["shift"]
+    if "block_shifts" in transform:
+        centres = (transform["centres_y"], transform["centres_x"])
+        iy = np.interp(points[:, 0], centres[0], np.arange(len(centres[0])))
+        ix = np.interp(points[:, 1], centres[1], np.arange(len(centres[1])))
+        points = points + np.stack([ndimage.map_coordinates(transform["block_shifts"][..., k], [iy, ix],
+                                                            order=1, mode="nearest") for k in range(2)], axis=1)
+    return points
+
+class SessionRegistration():
+    """Registers one animal's sessions to a common reference image and caches the results.
+
+    The reference is built once from every session available the first time (the images are
+    aligned to the first session and averaged, repeated reference_iterations times), then
+    kept in reference.npy. Each session's transform is stored in transforms/<session>.npz
+    with a record of the ops.npy it came from, so a later run only registers new sessions
+    or ones whose suite2p output changed. Registered images are saved in registered/.
+
+    Options are read from the registration section of the config file: image (ops key of
+    the image to register, defaults to meanImg), max_shift (defaults to 50), nonrigid
+    (defaults to false), block_size (defaults to 128), nonrigid_max_shift (defaults to 10)
+    and reference_iterations (defaults to 3).
+
+    Args:
+        path (Str or Path object): Folder for the reference, transforms and registered images.
+        config_data (dict): Config.
+        logger: Logger from setup_logger.
+    """
+    def __init__(self, path, config_data, logger):
+        self.path = Path(path)
+        self.logger = logger
+        settings = config_data.get("registration", {})
+        self.image_key = settings.get("image", "meanImg")
+        self.max_shift = settings.get("max_shift", 50)
+        self.nonrigid = settings.get("nonrigid", False)
+        self.block_size = settings.get("block_size", 128)
+        self.nonrigid_max_shift = settings.get("nonrigid_max_shift", 10)
+        self.reference_iterations = settings.get("reference_iterations", 3)
+
+        self.reference_params = {"image": self.image_key, "max_shift": self.max_shift,
+                                 "reference_iterations": self.reference_iterations}
+        self.params = dict(self.reference_params, nonrigid=self.nonrigid, block_size=self.block_size,
+                           nonrigid_max_shift=self.nonrigid_max_shift)
+        for folder in ["transforms", "registered"]:
+            os.makedirs(self.path / folder, exist_ok=True)
+
+    def load_image(self, ops_path):
+        return np.asarray(np.load(ops_path, allow_pickle=True).item()[self.image_key], dtype=np.float32)
+
+    def load_reference(self):
+        # cached reference and its id, or None if missing or made with other settings
+        info_path = self.path / "reference.json"
+        if not info_path.is_file():
+            return None, None
+        with open(info_path) as f:
+            info = json.load(f)
+        if info["params_hash"] != params_hash(self.reference_params):
+            self.logger.info("Registration settings changed, building a new reference")
+            return None, None
+        return np.load(self.path / "reference.npy"), info["id"]
+
+    def build_reference(self, images):
+        # sessions with another image size than the first are left out, run skips them
+        shape = next(iter(images.values())).shape
+        sessions = [s for s in images if images[s].shape == shape]
+        stack = np.stack([images[s] for s in sessions])
+        reference = stack[0]
+        for _ in range(self.reference_iterations):
+            shifts, _ = phase_correlate(reference, stack, max_shift=self.max_shift)
+            reference = shift_images(stack, shifts).mean(axis=0)
+
+        reference_id = params_hash({"sessions": sessions, "created": datetime.now().isoformat()})
+        np.save(self.path / "reference.npy", reference)
+        with open(self.path / "reference.json", "w") as f:
+            json.dump({"id": reference_id, "sessions": sessions, "params": self.reference_params,
+                       "params_hash": params_hash(self.reference_params)}, f, indent=2)
+        self.logger.info(f"Built registration reference from {len(sessions)} sessions")
+        return reference, reference_id
+
+    def cached_transform(self, session, source, reference_id):
+        # transform from an earlier run if it was made from the same ops.npy, settings and reference
+        path = self.path / "transforms" / f"{session}.npz"
+        if not path.is_file():
+            return None
+        transform = dict(np.load(path))
+        info = json.loads(str(transform.pop("info")))
+        if info != {"source": source, "params_hash": params_hash(self.params), "reference": reference_id}:
+            return None
+        return transform
+
+    def run(self, ops_files, rebuild=False):
+        """Registers every session in ops_files (session name to suite2p ops.npy path).
+
+        Args:
+            ops_files (dict): Sessions to register.
+            rebuild (bool, optional): Builds a new reference and registers every session again.
+
+        Returns:
+            dict: Transform of each session, with shift, peak and for non-rigid registration
+                block_shifts, centres_y and centres_x. Empty if there are no sessions.
+        """
+        images = {}
+        for session, ops_path in ops_files.items():
+            images[session] = self.load_image(ops_path)
+        if not images:
+            self.logger.warning("No sessions with suite2p output to register")
+            return {}
+
+        reference, reference_id = (None, None) if rebuild else self.load_reference()
+        if reference is None:
+            reference, reference_id = self.build_reference(images)
+
+        transforms, to_register = {}, []
+        for session, image in images.items():
+            if image.shape != reference.shape:
+                self.logger.warning(f"Skipping {session}, image is {image.shape} but the reference is {reference.shape}")
+                continue
+            cached = self.cached_transform(session, file_record(ops_files[session]), reference_id)
+            if cached is not None:
+                transforms[session] = cached
+            else:
+                to_register.append(session)
+        self.logger.info(f"Registering {len(to_register)} sessions, {len(transforms)} already registered")
+
+        if to_register:
+            stack = np.stack([images[s] for s in to_register])
+            shifts, peaks = phase_correlate(reference, stack, max_shift=self.max_shift)
+            for session, shift, peak in zip(to_register, shifts, peaks):
+                transform = {"shift": shift, "peak": peak}
+                if self.nonrigid:
+                    block_shifts, centres = nonrigid_shifts(reference, shift_images(images[session], shift),
+                                                            block_size=self.block_size,
+                                                            max_shift=self.nonrigid_max_shift)
+                    transform.update(block_shifts=block_shifts, centres_y=centres[0], centres_x=centres[1])
+
+                info = {"source": file_record(ops_files[session]), "params_hash": params_hash(self.params),
+                        "reference": reference_id}
+                np.savez(self.path / "transforms" / f"{session}.npz", info=json.dumps(info), **transform)
+                np.save(self.path / "registered" / f"{session}.npy", apply_transform(images[session], transform))
+                transforms[session] = transform
+
+        self.save_summary(transforms)
+        return transforms
+
+    def save_summary(self, transforms):
+        rows = []
+        for session, transform in sorted(transforms.items()):
+            row = {"session": session, "dy": float(transform["shift"][0]), "dx": float(transform["shift"][1]),
+                   "peak": float(transform["peak"])}
+            if "block_shifts" in transform:
+                row["max_block_shift"] = float(np.abs(transform["block_shifts"]).max())
+            rows.append(row)
+        pd.DataFrame(rows).to_csv(self.path / "registration.csv", index=False)
@@ -0,0 +1,229 @@
+### Tracks suite2p ROIs across sessions of one animal once the sessions are registered
+import os
+import json
+import hashlib
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+
+from manifest import file_record, params_hash
+from registration import transform_points
+
+def transform_hash(transform):
+    # changes whenever the registration of a session changes
+    sha = hashlib.sha1()
+    for key in sorted(transform):
+        sha.update(key.encode())
+        sha.update(np.ascontiguousarray(transform[key], dtype=np.float64).tobytes())
+    return sha.hexdigest()[:16]
+
+def select_rois(plane_path, n_rois, only_cells=True):
+    # suite2p indices of the ROIs to match, those classed as cells in iscell.npy if only_cells
+    roi_ids = np.arange(n_rois)
+    iscell_path = Path(plane_path) / "iscell.npy"
+    if only_cells and iscell_path.is_file():
+        roi_ids = roi_ids[np.load(iscell_path)[:, 0] > 0.5]
+    return roi_ids
+
+def load_rois(plane_path, only_cells=True):
+    """Loads ROI pixels from suite2p's stat.npy.
+
+    Returns:
+        roi_ids (array): suite2p index of each ROI kept.
+        pixels (list): (n, 2) y, x pixels of each ROI kept.
+    """
+    stat = np.load(Path(plane_path) / "stat.npy", allow_pickle=True)
+    roi_ids = select_rois(plane_path, len(stat), only_cells)
+    pixels = [np.stack([stat[i]["ypix"], stat[i]["xpix"]], axis=1) for i in roi_ids]
+    return roi_ids, pixels
+
+class SessionROIs():
+    """ROI masks of one session moved into the reference, as a sparse ROI x pixel matrix,
+    with their centroids in a KD-tree.
+
+    Args:
+        roi_ids (array): suite2p index of each ROI.
+        pixels (list): (n, 2) pixels of each ROI in the session.
+        transform (dict): Registration transform of the session.
+        shape (tuple): Ly, Lx of the reference.
+    """
+    def __init__(self, roi_ids, pixels, transform, shape):
+        self.roi_ids = np.asarray(roi_ids)
+        Ly, Lx = shape
+        owner = np.repeat(np.arange(len(pixels)), [len(p) for p in pixels])
+        points = np.concatenate(pixels) if pixels else np.zeros((0, 2))
+
+        # every pixel of every ROI moved in one call, pixels landing outside the reference are dropped
+        moved = np.rint(transform_points(points, transform)).astype(np.int64)
+        inside = (moved[:, 0] >= 0) & (moved[:, 0] < Ly) & (moved[:, 1] >= 0) & (moved[:, 1] < Lx)
+        owner, moved = owner[inside], moved[inside]
+
+        self.masks = sparse.csr_matrix((np.ones(len(owner), dtype=np.float32), (owner, moved[:, 0] * Lx + moved[:, 1])),
+                                       shape=(len(pixels), Ly * Lx))
+        self.masks.data[:] = 1  # pixels rounded onto the same spot count once
+        self.sizes = np.asarray(self.masks.sum(axis=1)).ravel()
+
+        counts = np.maximum(np.bincount(owner, minlength=len(pixels)), 1)
+        self.centroids = np.stack([np.bincount(owner, moved[:, k], minlength=len(pixels)) / counts for k in range(2)], axis=1)
+        self.tree = cKDTree(self.centroids)
+
+def match_pair(a, b, max_distance=10, min_overlap=0.3):
+    """Matches ROIs of two sessions one to one.
+
+    Candidate pairs are ROIs with centroids within max_distance, found with the KD-trees, and
+    are scored by the Jaccard overlap of their masks, computed for all candidates at once.
+    The best one to one assignment above min_overlap is kept.
+
+    Returns:
+        roi_a, roi_b (array): suite2p indices of matched ROIs.
+        score (array): Jaccard overlap of each match.
+    """
+    candidates = a.tree.sparse_distance_matrix(b.tree, max_distance, output_type="ndarray")
+    empty = np.zeros(0, dtype=np.int64)
+    if len(candidates) == 0:
+        return empty, empty, np.zeros(0)
+    i, j = candidates["i"], candidates["j"]
+
+    intersection = np.asarray(a.masks[i].multiply(b.masks[j]).sum(axis=1)).ravel()
+    union = a.sizes[i] + b.sizes[j] - intersection
+    score = np.where(union > 0, intersection / np.maximum(union, 1), 0)
+    keep = score >= min_overlap
+    i, j, score = i[keep], j[keep], score[keep]
+    if len(i) == 0:
+        return empty, empty, np.zeros(0)
+
+    # assignment only over the ROIs that have a candidate
+    rows, i_local = np.unique(i, return_inverse=True)
+    cols, j_local = np.unique(j, return_inverse=True)
+    cost = np.zeros((len(rows), len(cols)))
+    cost[i_local, j_local] = -score
+    r, c = linear_sum_assignment(cost)
+    matched = cost[r, c] < 0
+    r, c = r[matched], c[matched]
+    return a.roi_ids[rows[r]], b.roi_ids[cols[c]], -cost[r, c]
+
+class ROIMatcher():
+    """Builds a table of which ROI is the same cell in each session of one animal.
+
+    Each pair of sessions is matched with match_pair and cached in matches/<a>__<b>.npz with
+    a record of the stat.npy files and registration it came from, so adding a session only
+    matches the new pairs. Matches from all pairs, best first, are joined into cells as long
+    as a cell never gets two ROIs from the same session.
+
+    Options are read from the roi_matching section of the config file: max_distance
+    (centroid distance in pixels, defaults to 10), min_overlap (Jaccard overlap, defaults to
+    0.3), only_cells (use ROIs suite2p classed as cells, defaults to true) and match_to
+    ("all" sessions or the "previous" one, defaults to "all").
+
+    Args:
+        path (Str or Path object): Folder for the cached matches and cell table.
+        config_data (dict): Config.
+        logger: Logger from setup_logger.
+    """
+    def __init__(self, path, config_data, logger):
+        self.path = Path(path)
+        self.logger = logger
+        settings = config_data.get("roi_matching", {})
+        self.max_distance = settings.get("max_distance", 10)
+        self.min_overlap = settings.get("min_overlap", 0.3)
+        self.only_cells = settings.get("only_cells", True)
+        self.match_to = settings.get("match_to", "all")
+        self.params = {"max_distance": self.max_distance, "min_overlap": self.min_overlap, "only_cells": self.only_cells}
+        os.makedirs(self.path / "matches", exist_ok=True)
+
+    def pairs(self, sessions):
+        if self.match_to == "previous":
+            return list(zip(sessions[:-1], sessions[1:]))
+        return list(itertools.combinations(sessions, 2))
+
+    def run(self, plane_paths, transforms, shape):
+        """Matches ROIs across sessions.
+
+        Args:
+            plane_paths (dict): suite2p plane0 folder of each session.
+            transforms (dict): Registration transform of each session.
+            shape (tuple): Ly, Lx of the registration reference.
+
+        Returns:
+            DataFrame: One row per cell with the suite2p ROI index in each session (-1 if absent).
+        """
+        sessions = sorted(s for s in plane_paths if s in transforms)
+        sources = {s: {"stat": file_record(Path(plane_paths[s]) / "stat.npy"),
+                       "iscell": file_record(Path(plane_paths[s]) / "iscell.npy"),
+                       "transform": transform_hash(transforms[s])} for s in sessions}
+        roi_ids, rois = {}, {}
+
+        def session_rois(session):
+            if session not in rois:
+                ids, pixels = load_rois(plane_paths[session], only_cells=self.only_cells)
+                rois[session] = SessionROIs(ids, pixels, transforms[session], shape)
+            return rois[session]
+
+        matches, new_pairs = [], 0
+        for a, b in self.pairs(sessions):
+            cache = self.path / "matches" / f"{a}__{b}.npz"
+            info = {"a": sources[a], "b": sources[b], "params_hash": params_hash(self.params)}
+            cached = np.load(cache) if cache.is_file() else None
+            if cached is not None and json.loads(str(cached["info"])) == info:
+                roi_a, roi_b, score = cached["roi_a"], cached["roi_b"], cached["score"]
+            else:
+                roi_a, roi_b, score = match_pair(session_rois(a), session_rois(b), self.max_distance, self.min_overlap)
+                np.savez(cache, info=json.dumps(info), roi_a=roi_a, roi_b=roi_b, score=score)
+                new_pairs += 1
+            matches.append(pd.DataFrame({"session_a": a, "roi_a": roi_a, "session_b": b, "roi_b": roi_b, "score": score}))
+        self.logger.info(f"Matched {new_pairs} new session pairs, {len(matches) - new_pairs} from cache")
+
+        for session in sessions:
+            if session in rois:
+                roi_ids[session] = rois[session].roi_ids
+            else:
+                n_rois = len(np.load(Path(plane_paths[session]) / "stat.npy", allow_pickle=True))
+                roi_ids[session] = select_rois(plane_paths[session], n_rois, self.only_cells)
+
+        table = self.cell_table(roi_ids, pd.concat(matches, ignore_index=True) if matches else None)
+        table.to_csv(self.path / "cell_identity.csv", index=False)
+        self.logger.info(f"Found {len(table)} cells, {(table['n_sessions'] > 1).sum()} in more than one session")
+        return table
+
+    def cell_table(self, roi_ids, matches):
+        # union-find over (session, roi), joining the best matches first and never putting
+        # two ROIs of one session in the same cell. ROIs without a match are cells of their own
+        sessions = list(roi_ids)
+        parent, members = {}, {}
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        def add(node):
+            if node not in parent:
+                parent[node] = node
+                members[node] = {node[0]: node[1]}
+
+        for session, ids in roi_ids.items():
+            for roi in ids:
+                add((session, int(roi)))
+
+        if matches is not None and len(matches):
+            matches = matches.sort_values("score", ascending=False)
+            for a, ra, b, rb in zip(matches["session_a"], matches["roi_a"], matches["session_b"], matches["roi_b"]):
+                na, nb = (a, int(ra)), (b, int(rb))
+                root_a, root_b = find(na), find(nb)
+                if root_a == root_b or set(members[root_a]) & set(members[root_b]):
+                    continue
+                parent[root_b] = root_a
+                members[root_a].update(members.pop(root_b))
+
+        cells = [members[root] for root in members if find(root) == root]
+        table = pd.DataFrame([{s: cell.get(s, -1) for s in sessions} for cell in cells], columns=sessions)
+        table["n_sessions"] = (table[sessions] >= 0).sum(axis=1)
+        table = table.sort_values("n_sessions", ascending=False, kind="stable").reset_index(drop=True)
+        table.insert(0, "cell_id", np.arange(len(table)))
+        return table
@@ -0,0 +1,177 @@
+### Runs independent (animal, date) sessions in a pool of processes without oversubscribing RAM
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from helper_fx import Preprocess, setup_logger
+
+GB = 1024 ** 3
+
+def total_memory():
+    """Returns physical memory in bytes, or None if it cannot be found (e.g. on Windows)."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def estimate_session_memory(tiff_bytes, config_data):
+    """Estimates peak memory in bytes needed to process one session.
+
+    Stages run one after the other so the estimate is the largest of the prep step and
+    suite2p. When streaming, prep only holds a few chunks of frames in memory; otherwise
+    the whole tiff is loaded.
+
+    Args:
+        tiff_bytes (int): Size of the raw imaging tiff.
+        config_data (dict): Config, using prep_settings and scheduler sections.
+
+    Returns:
+        int: Estimated memory in bytes.
+    """
+    prep_settings = config_data.get("prep_settings", {})
+    scheduler_settings = config_data.get("scheduler", {})
+
+    frame_bytes = scheduler_settings.get("frame_bytes", 512 * 512 * 2)
+    chunk_bytes = prep_settings.get("chunk_size", 1800) * frame_bytes
+    # each worker holds a raw chunk plus its projections
+    prep_bytes = 2 * chunk_bytes * (prep_settings.get("n_workers", 1) + 1)
+    if prep_settings.get("streaming", True):
+        prep_bytes = min(prep_bytes, 2 * tiff_bytes)
+    else:
+        prep_bytes += tiff_bytes
+
+    suite2p_bytes = scheduler_settings.get("suite2p_memory_gb", 8) * GB
+    base_bytes = scheduler_settings.get("base_memory_gb", 1) * GB
+
+    return base_bytes + max(prep_bytes, suite2p_bytes)
+
+def run_session_job(config_data, use_fast_dir, overwrite, delete_intermediates, animal, date, stages, metrics_path=None):
+    """Processes one session in a worker process with its own Preprocess object and log file.
+    Stage metrics are appended to the run's metrics file at metrics_path."""
+    preprocess = Preprocess(config_data, use_fast_dir, overwrite, delete_intermediates)
+    preprocess.set_project_dir()
+    preprocess.logger = setup_logger(preprocess.project_dir, log_name=f"sub-{animal}_{date}")
+    if metrics_path is not None:
+        preprocess.set_metrics(metrics_path)
+
+    try:
+        preprocess.read_metafile()
+        preprocess.define_root()
+        preprocess.define_nwb_paths()
+        preprocess.define_animal_paths(animal)
+        if not preprocess.check_valid_combo(animal, date):
+            return "skipped"
+
+        failed_stage = preprocess.process_session(**stages)
+        # the copy back runs in the background and has to finish before the worker returns
+        if preprocess.staging is not None and not preprocess.staging.wait() and failed_stage is None:
+            failed_stage = "copy_from_fast_disk"
+    except BaseException:
+        preprocess.logger.exception(f"Processing failed for {animal}, {date}")
+        raise
+
+    if failed_stage is None:
+        return "done"
+
+    # failures recorded in the manifest as retryable (e.g. downloads) can be run again
+    failure = preprocess.manifest.failures.get(failed_stage, {})
+    if failure.get("retryable"):
+        return f"retry:{failed_stage}"
+    return f"failed:{failed_stage}"
+
+class SessionScheduler():
+    """Runs sessions in a process pool, only starting a session when its memory estimate
+    fits in the remaining budget. One session failing does not stop the others.
+
+    Options are read from the scheduler section of the config file: memory_gb (defaults
+    to physical memory), session_retries (times a session with a retryable failure, such as
+    a failed download, is queued again, defaults to 1), plus base_memory_gb,
+    suite2p_memory_gb, default_tiff_gb and frame_bytes used by estimate_session_memory.
+
+    Args:
+        preprocess (Preprocess): Object with sessions planned and paths defined.
+        stages (dict): Keyword arguments passed on to Preprocess.process_session.
+        max_jobs (int): Maximum number of sessions to run at once.
+    """
+    def __init__(self, preprocess, stages, max_jobs):
+        self.preprocess = preprocess
+        self.stages = stages
+        self.max_jobs = max_jobs
+        self.logger = preprocess.logger
+
+        scheduler_settings = preprocess.config_data.get("scheduler", {})
+        if "memory_gb" in scheduler_settings:
+            self.memory_budget = scheduler_settings["memory_gb"] * GB
+        else:
+            self.memory_budget = total_memory()
+        self.default_tiff_bytes = scheduler_settings.get("default_tiff_gb", 40) * GB
+        self.session_retries = scheduler_settings.get("session_retries", 1)
+
+    def plan_jobs(self):
+        # returns (animal, date, memory estimate) for each valid session
+        preprocess = self.preprocess
+        jobs = []
+        for animal, date in preprocess.sessions:
+            preprocess.define_animal_paths(animal)
+            if not preprocess.check_valid_combo(animal, date):
+                continue
+            preprocess.define_session_paths()
+            if os.path.isfile(preprocess.imaging_file_local):
+                tiff_bytes = os.path.getsize(preprocess.imaging_file_local)
+            else:
+                tiff_bytes = self.default_tiff_bytes
+            jobs.append((animal, date, estimate_session_memory(tiff_bytes, preprocess.config_data)))
+        return jobs
+
+    def run(self):
+        pending = self.plan_jobs()
+        self.logger.info(f"Scheduling {len(pending)} sessions with up to {self.max_jobs} jobs"
+                         f" and a memory budget of {self.memory_budget / GB if self.memory_budget else 'unlimited'} GB")
+
+        preprocess = self.preprocess
+        running = {}
+        results = {}
+        retries = {}
+        reserved = 0
+
+        with ProcessPoolExecutor(max_workers=self.max_jobs) as executor:
+            while pending or running:
+                # start every pending job that fits, always allowing one job so nothing stalls
+                for job in list(pending):
+                    animal, date, memory = job
+                    if len(running) >= self.max_jobs:
+                        break
+                    if running and self.memory_budget and reserved + memory > self.memory_budget:
+                        continue
+
+                    future = executor.submit(run_session_job, preprocess.config_data, preprocess.use_fast_dir,
+                                             preprocess.overwrite, preprocess.delete_intermediates,
+                                             animal, date, self.stages,
+                                             preprocess.metrics.path if preprocess.metrics else None)
+                    running[future] = job
+                    reserved += memory
+                    pending.remove(job)
+                    self.logger.info(f"Started {animal}, {date} (estimated {memory / GB:.1f} GB)")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    animal, date, memory = running.pop(future)
+                    reserved -= memory
+                    try:
+                        results[(animal, date)] = future.result()
+                        self.logger.info(f"Finished {animal}, {date}: {results[(animal, date)]}")
+                    except BaseException as e:
+                        results[(animal, date)] = "failed"
+                        self.logger.warning(f"Session {animal}, {date} failed: {e!r}. Check its log file.")
+
+                    # queue retryable failures again at the end
+                    if results[(animal, date)].startswith("retry:"):
+                        retries[(animal, date)] = retries.get((animal, date), 0) + 1
+                        if retries[(animal, date)] <= self.session_retries:
+                            self.logger.info(f"Queueing {animal}, {date} again after {results[(animal, date)]}")
+                            pending.append((animal, date, memory))
+                        else:
+                            results[(animal, date)] = "failed:" + results[(animal, date)].split(":", 1)[1]
+
+        failed = [key for key, status in results.items() if status.startswith("failed")]
+        self.logger.info(f"Scheduler finished {len(results)} sessions, {len(failed)} failed: {failed}")
+        return results
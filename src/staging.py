@@ -0,0 +1,208 @@
+### Manages space on the fast disk: per-session usage, LRU eviction and background copy-back
+import os
+import json
+import time
+import shutil
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from transfer import file_md5
+
+try:
+    import fcntl
+except ImportError:  # windows, state is then only locked within a process
+    fcntl = None
+
+GB = 1024 ** 3
+
+def folder_bytes(paths):
+    total = 0
+    for path in paths:
+        path = Path(path)
+        if path.is_file():
+            total += path.stat().st_size
+        elif path.is_dir():
+            total += sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+    return total
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+def copy_file_checksummed(src, dst, verify=True):
+    # copies to a temporary name and only renames once the checksums match
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.tmp"
+    shutil.copyfile(src, tmp)
+    if verify and file_md5(src) != file_md5(tmp):
+        os.remove(tmp)
+        raise IOError(f"Checksum mismatch copying {src} to {dst}")
+    os.replace(tmp, dst)
+
+class StagingManager():
+    """Keeps track of the sessions held on the fast disk against a capacity budget.
+
+    Sessions stay on the fast disk after they finish, so a rerun can reuse their files, and
+    are only evicted (least recently used first) when space is needed for a new session.
+    Results are copied back to the project dir in the background by a pool of threads,
+    checking each file's md5, and a session can't be evicted until its copy-back succeeded.
+    State is kept in staging.json on the fast disk so it carries over between runs and is
+    shared by processes run with --jobs.
+
+    Options are read from the staging section of the config file: capacity_gb (defaults to
+    the space used by staged sessions plus the free space on the disk), parallelism (files
+    copied back at once, defaults to 8) and verify_copy (defaults to true).
+
+    Args:
+        root (Str or Path object): Fast disk folder.
+        config_data (dict): Config.
+        logger: Logger from setup_logger.
+    """
+    def __init__(self, root, config_data, logger):
+        self.root = Path(root)
+        self.logger = logger
+        self.state_file = self.root / "staging.json"
+        os.makedirs(self.root, exist_ok=True)
+
+        settings = config_data.get("staging", {})
+        self.verify = settings.get("verify_copy", True)
+        if "capacity_gb" in settings:
+            self.capacity = settings["capacity_gb"] * GB
+        else:
+            self.capacity = shutil.disk_usage(self.root).free + sum(s["bytes"] for s in self.read_state().values())
+
+        self._condition = threading.Condition()
+        self._copy_executor = ThreadPoolExecutor(max_workers=2)
+        self._file_executor = ThreadPoolExecutor(max_workers=settings.get("parallelism", 8))
+        self._copies = []
+        # called with the key and paths of each evicted session
+        self.on_evict = None
+
+    @contextmanager
+    def locked_state(self):
+        # yields the state dict and saves it afterwards, locking against other processes
+        with self._condition:
+            with open(self.root / "staging.lock", "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                state = self.read_state()
+                yield state
+                tmp = self.state_file.with_suffix(".json.tmp")
+                with open(tmp, "w") as f:
+                    json.dump(state, f, indent=2)
+                os.replace(tmp, self.state_file)
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read_state(self):
+        if self.state_file.is_file():
+            with open(self.state_file) as f:
+                return json.load(f)
+        return {}
+
+    def evictable(self, entry):
+        # finished sessions, or ones left active by a process that has since stopped
+        if entry["state"] == "done":
+            return True
+        return entry["state"] in ("active", "copying") and not process_alive(entry.get("pid", 0))
+
+    def busy(self, state):
+        # True if sessions of this process are running or copying back, so space will free up
+        return any(s["state"] in ("active", "copying") and s.get("pid") == os.getpid() for s in state.values())
+
+    def evict(self, state, needed):
+        # removes finished sessions, least recently used first, until needed bytes are free
+        used = sum(s["bytes"] for s in state.values())
+        done = sorted([k for k, s in state.items() if self.evictable(s)], key=lambda k: state[k]["last_used"])
+        for key in done:
+            if used + needed <= self.capacity:
+                break
+            self.logger.info(f"Evicting {key} from fast disk to free {state[key]['bytes'] / GB:.1f} GB")
+            for path in state[key]["paths"]:
+                shutil.rmtree(path, ignore_errors=True)
+            if self.on_evict is not None:
+                self.on_evict(key, state[key]["paths"])
+            used -= state[key]["bytes"]
+            del state[key]
+        return used + needed <= self.capacity
+
+    def reserve(self, key, nbytes, paths):
+        """Marks a session as in use, evicting finished sessions until nbytes fit.
+
+        Files the session already has on the fast disk count towards nbytes, so a session
+        kept from an earlier run only needs the difference. Waits while other sessions in
+        this process are running or copying back. If the session still doesn't fit it goes
+        ahead anyway with a warning.
+        """
+        while True:
+            with self.locked_state() as state:
+                staged = state.pop(key, {}).get("bytes", 0)
+                fits = self.evict(state, max(nbytes, staged))
+                if fits or not self.busy(state):
+                    if not fits:
+                        self.logger.warning(f"{key} may not fit on the fast disk ({nbytes / GB:.1f} GB needed)")
+                    state[key] = {"paths": [str(p) for p in paths], "bytes": max(nbytes, staged),
+                                  "state": "active", "last_used": time.time(), "pid": os.getpid()}
+                    return
+            with self._condition:
+                self._condition.wait(timeout=30)
+
+    def set_state(self, key, new_state, measure=False, only_from=None):
+        with self.locked_state() as state:
+            if key not in state or (only_from is not None and state[key]["state"] != only_from):
+                return
+            state[key]["state"] = new_state
+            state[key]["last_used"] = time.time()
+            if measure:
+                state[key]["bytes"] = folder_bytes(state[key]["paths"])
+            self._condition.notify_all()
+
+    def release(self, key):
+        # session stopped without copying back, its files can be evicted when space is needed
+        self.set_state(key, "done", measure=True, only_from="active")
+
+    def copy_back(self, key, src, dst, on_done=None):
+        """Copies src folder to dst in the background and marks the session done once every
+        file arrived with a matching checksum. on_done, if given, is called from the copy
+        thread with True or False before the returned future resolves.
+
+        Returns:
+            Future: Resolves to True if the copy succeeded.
+        """
+        self.set_state(key, "copying", measure=True)
+        future = self._copy_executor.submit(self._copy_tree, key, Path(src), Path(dst), on_done)
+        self._copies.append(future)
+        return future
+
+    def _copy_tree(self, key, src, dst, on_done=None):
+        files = [f for f in src.rglob("*") if f.is_file()]
+        self.logger.info(f"Copying {len(files)} files from {src} to {dst} in the background")
+        futures = [self._file_executor.submit(copy_file_checksummed, f, dst / f.relative_to(src), self.verify) for f in files]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+
+        if errors:
+            # kept on the fast disk (not evictable) so the results are not lost
+            self.logger.warning(f"Copy back of {key} failed: {errors[0]!r}")
+            self.set_state(key, "failed")
+            ok = False
+        else:
+            self.logger.info(f"Finished copying {key} back to {dst}")
+            self.set_state(key, "done")
+            ok = True
+
+        if on_done is not None:
+            on_done(ok)
+        return ok
+
+    def wait(self):
+        # waits for all background copies to finish, returns True if they all succeeded
+        results = [future.result() for future in self._copies]
+        self._copies = []
+        return all(results)
@@ -0,0 +1,78 @@
+### Shows which sessions and stages are done or pending without loading the processing stack
+import sys
+import json
+import logging
+import contextlib
+
+import click
+
+from helper_fx import Preprocess, STAGES
+
+@click.command()
+@click.option("--config-file", "-c", type=str, default="config.json", help="A file containing config options")
+@click.option("--animals", "-a", type=str, default="all", help="List of animals to check, or all")
+@click.option("--dates", "-d", type=str, default="all", help="List of dates to check, or all")
+@click.option("--use-fast-dir", "-f", type=bool, is_flag=True, help="Checks the stages of a run with --use-fast-dir")
+@click.option("--get-behav", "-b", type=bool, is_flag=True, help="Checks the behavioral download")
+@click.option("--get-data", "-g", type=bool, is_flag=True, help="Checks the imaging download")
+@click.option("--prep-for-s2p", "-p", type=bool, is_flag=True, help="Checks the prep for suite2p")
+@click.option("--do-suite2p", "-s", type=bool, is_flag=True, help="Checks suite2p")
+@click.option("--align-behav", "-A", type=bool, is_flag=True, help="Checks the behavior alignment")
+@click.option("--compute-dff", "-D", type=bool, is_flag=True, help="Checks the dF/F traces")
+@click.option("--extract-trials", "-T", type=bool, is_flag=True, help="Checks the trial tensors")
+@click.option("--reconcile", type=bool, is_flag=True, help="Checks the project catalog against the disk first")
+@click.option("--json", "as_json", type=bool, is_flag=True, help="Prints one json object per session instead of a table")
+def show_status(config_file, animals, dates, use_fast_dir, get_behav, get_data, prep_for_s2p, do_suite2p, align_behav, compute_dff, extract_trials, reconcile, as_json):
+    # the same stages as process_individual.py, with none given meaning download, prep and suite2p
+    stages = dict(get_data=get_data, get_behav=get_behav, prep_for_s2p=prep_for_s2p, do_suite2p=do_suite2p,
+                  align_behav=align_behav, compute_dff=compute_dff,
+                  extract_trials=extract_trials)
+    if not any(stages.values()):
+        stages.update(get_data=True, prep_for_s2p=True, do_suite2p=True)
+
+    with open(config_file) as f:
+        config_data = json.load(f)
+
+    # only warnings are shown and messages from planning go to stderr, so stdout is just the status
+    logger = logging.getLogger("process2p_status")
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler(stream=sys.stderr))
+
+    results = []
+    with contextlib.redirect_stdout(sys.stderr):
+        preprocess = Preprocess(config_data, use_fast_dir, False, False)
+        # paths are worked out but no folders, catalog entries or staging state are written
+        preprocess.read_only = True
+        preprocess.set_project_dir()
+        preprocess.logger = logger
+        if reconcile:
+            preprocess.reconcile_catalog()
+        preprocess.read_metafile()
+        preprocess.parse_animals(animals)
+        preprocess.parse_dates(dates)
+        preprocess.plan_sessions()
+        preprocess.define_root()
+        preprocess.define_nwb_paths()
+
+        for animal, date in preprocess.sessions:
+            preprocess.define_animal_paths(animal)
+            if not preprocess.check_valid_combo(animal, date):
+                continue
+            status = preprocess.session_status(**stages)
+            results.append({"animal": animal, "date": str(date), "session": preprocess.ses_path, **status})
+
+    if as_json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    columns = [stage for stage in STAGES if stage != "imagej_zproject"]
+    print(f"{'animal':<10} {'date':<11} {'session':<18} " + " ".join(f"{c:<20}" for c in columns) + " pending")
+    for result in results:
+        states = " ".join(f"{result['stages'].get(c, '-'):<20}" for c in columns)
+        print(f"{result['animal']:<10} {result['date']:<11} {result['session']:<18} {states} {','.join(result['pending']) or '-'}")
+    pending = sum(bool(r["pending"]) for r in results)
+    print(f"{len(results)} sessions, {pending} with pending stages")
+
+if __name__ == "__main__":
+    show_status()
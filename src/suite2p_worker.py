@@ -0,0 +1,301 @@
+### Long-lived suite2p process that keeps suite2p, torch and the cellpose model loaded between sessions
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import secrets
+import importlib
+import threading
+import traceback
+from pathlib import Path
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, answer_challenge, deliver_challenge
+
+import click
+
+def worker_settings(config_data):
+    """Reads the suite2p_worker section of the config file.
+
+    Options are enabled (send run_suite2p to the worker, defaults to false), host (defaults
+    to 127.0.0.1), port (defaults to 6011), authkey (defaults to None, see worker_authkey),
+    start (start a worker if none is running, defaults to true), start_timeout (seconds to
+    wait for a new worker, defaults to 300) and idle_minutes (a worker with no jobs for this
+    long exits, defaults to 60).
+    """
+    settings = config_data.get("suite2p_worker", {})
+    return {
+        "enabled": settings.get("enabled", False),
+        "address": (settings.get("host", "127.0.0.1"), settings.get("port", 6011)),
+        "authkey": settings.get("authkey", None),
+        "start": settings.get("start", True),
+        "start_timeout": settings.get("start_timeout", 300),
+        "idle_minutes": settings.get("idle_minutes", 60),
+    }
+
+def worker_authkey(config_data):
+    """Returns the key clients and the worker prove they know before any job is unpickled.
+
+    This is the authkey of the config if set, otherwise a random key kept in
+    log/suite2p_worker.key of the project folder, which only the user can read. The file is
+    created by whichever of the worker and its first client runs first.
+    """
+    authkey = worker_settings(config_data)["authkey"]
+    if authkey:
+        return authkey.encode()
+    path = Path(config_data["path_to_project_dir"]) / "log" / "suite2p_worker.key"
+    os.makedirs(path.parent, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # made by another process, which may still be writing it
+        for _ in range(50):
+            key = path.read_bytes()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{path} is empty, delete it to make a new key")
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def cached_factory(cls):
+    # returns cls(...) made once for each set of arguments, so the model weights are loaded once
+    instances = {}
+    lock = threading.Lock()
+
+    def factory(*args, **kwargs):
+        key = repr((args, sorted(kwargs.items())))
+        with lock:
+            if key not in instances:
+                instances[key] = cls(*args, **kwargs)
+            return instances[key]
+    factory.cached = True
+    return factory
+
+def cache_cellpose_models():
+    """Makes the cellpose models suite2p builds for anatomical detection load only once.
+
+    suite2p creates a new cellpose model for every session. Its constructors are replaced,
+    where suite2p looks them up, with ones that reuse the model made for the same arguments.
+    Returns False if cellpose is not installed.
+    """
+    try:
+        from cellpose import models
+    except ImportError:
+        return False
+    modules = [models]
+    try:
+        modules.append(importlib.import_module("suite2p.detection.anatomical"))
+    except ImportError:
+        pass
+    for module in modules:
+        for name in ("Cellpose", "CellposeModel"):
+            cls = getattr(module, name, None)
+            if cls is not None and not getattr(cls, "cached", False):
+                setattr(module, name, cached_factory(cls))
+    return True
+
+class Suite2pWorker():
+    """Runs suite2p jobs sent over a local socket, one at a time, in this process.
+
+    suite2p, torch and cellpose are imported once when the worker starts and the cellpose
+    model is kept after the first session that uses it, so their start-up cost is paid once
+    per cohort. Each connection sends one job and waits for its reply, so several
+    process_individual.py runs (or --jobs workers) can share a worker and queue for it.
+    Connections are authenticated and read in their own thread, so a client that never
+    sends anything can't hold up the others.
+
+    Args:
+        config_data (dict): Config, using the suite2p_worker section.
+        logger: Logger from setup_logger.
+    """
+    def __init__(self, config_data, logger):
+        self.settings = worker_settings(config_data)
+        self.authkey = worker_authkey(config_data)
+        self.logger = logger
+        self.jobs = queue.Queue()
+        self.jobs_done = 0
+
+        start = time.perf_counter()
+        from suite2p import default_ops, run_s2p
+        self.default_ops = default_ops()
+        self.run_s2p = run_s2p
+        warm = cache_cellpose_models()
+        self.logger.info(f"Loaded suite2p{' and cellpose' if warm else ''} in {time.perf_counter() - start:.1f} s")
+
+    def accept(self, listener):
+        # reads each connection in its own thread, the listener has no authkey so accept doesn't
+        # wait for the handshake
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                continue
+            threading.Thread(target=self.receive, args=(conn,), daemon=True).start()
+
+    def receive(self, conn, timeout=60):
+        # checks the client's key, as Listener does, before unpickling its message and handing it
+        # to the main thread, which runs jobs in order
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+            if not conn.poll(timeout):
+                raise TimeoutError
+            message = conn.recv()
+        except (OSError, EOFError, AuthenticationError):
+            conn.close()
+            return
+        self.jobs.put((conn, message))
+
+    def run_job(self, message):
+        ops = copy.deepcopy(self.default_ops)
+        ops.update(message["ops"])
+        start = time.perf_counter()
+        self.logger.info(f"Running suite2p for {ops.get('save_path0')}")
+        try:
+            self.run_s2p(ops=ops, db=message["db"])
+        except Exception:
+            self.logger.warning(f"Suite2p failed for {ops.get('save_path0')}")
+            return {"ok": False, "error": traceback.format_exc()}
+        finally:
+            self.jobs_done += 1
+        seconds = time.perf_counter() - start
+        self.logger.info(f"Finished suite2p for {ops.get('save_path0')} in {seconds:.0f} s")
+        return {"ok": True, "seconds": seconds}
+
+    def serve(self):
+        listener = Listener(self.settings["address"])
+        threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+        self.logger.info(f"Suite2p worker {os.getpid()} listening on {self.settings['address']}")
+
+        idle = self.settings["idle_minutes"] * 60
+        while True:
+            try:
+                conn, message = self.jobs.get(timeout=idle)
+            except queue.Empty:
+                self.logger.info(f"No jobs for {self.settings['idle_minutes']} minutes, stopping")
+                break
+
+            job = message.get("job")
+            if job == "run_s2p":
+                reply = self.run_job(message)
+            elif job == "ping":
+                reply = {"ok": True, "pid": os.getpid(), "jobs_done": self.jobs_done, "queued": self.jobs.qsize()}
+            elif job == "stop":
+                reply = {"ok": True}
+            else:
+                reply = {"ok": False, "error": f"Unknown job {job}"}
+
+            try:
+                conn.send(reply)
+                conn.close()
+            except OSError:
+                self.logger.warning("Client went away before its reply was sent")
+            if job == "stop":
+                self.logger.info("Stopping suite2p worker")
+                break
+        listener.close()
+
+class Suite2pClient():
+    """Sends suite2p jobs to a Suite2pWorker, starting one in the background if needed.
+
+    Args:
+        config_data (dict): Config, using the suite2p_worker section.
+        config_file (Str or Path object, optional): Config file passed to a worker started
+            by the client. Defaults to None, in which case the config is written next to the
+            worker's log.
+        logger: Logger from setup_logger.
+    """
+    def __init__(self, config_data, logger, config_file=None):
+        self.config_data = config_data
+        self.settings = worker_settings(config_data)
+        self.authkey = worker_authkey(config_data)
+        self.config_file = config_file
+        self.logger = logger
+
+    def request(self, message):
+        conn = Client(self.settings["address"], authkey=self.authkey)
+        try:
+            conn.send(message)
+            return conn.recv()
+        finally:
+            conn.close()
+
+    def ping(self):
+        try:
+            return self.request({"job": "ping"})
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        except AuthenticationError:
+            raise ConnectionError(f"The suite2p worker on {self.settings['address']} has a different authkey, "
+                                  "stop it or set the same authkey in the config") from None
+
+    def start_worker(self):
+        import subprocess
+        config_file = self.config_file
+        if config_file is None:
+            log_dir = Path(self.config_data["path_to_project_dir"]) / "log"
+            os.makedirs(log_dir, exist_ok=True)
+            config_file = log_dir / "suite2p_worker_config.json"
+            with open(config_file, "w") as f:
+                json.dump(self.config_data, f, indent=2)
+
+        # detached so it outlives this run and serves the next one
+        self.logger.info("Starting a suite2p worker")
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--config-file", str(config_file)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.time() + self.settings["start_timeout"]
+        while time.time() < deadline:
+            if self.ping() is not None:
+                return
+            time.sleep(1)
+        raise TimeoutError(f"Suite2p worker did not start within {self.settings['start_timeout']} s")
+
+    def ensure_worker(self):
+        status = self.ping()
+        if status is None:
+            if not self.settings["start"]:
+                raise ConnectionError(f"No suite2p worker on {self.settings['address']}. Start one with suite2p_worker.py")
+            self.start_worker()
+            status = self.ping()
+        return status
+
+    def run_s2p(self, ops, db):
+        """Runs suite2p in the worker with ops (changes from suite2p's defaults) and db, raising
+        RuntimeError with the worker's traceback if suite2p fails."""
+        self.ensure_worker()
+        reply = self.request({"job": "run_s2p", "ops": ops, "db": db})
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def stop(self):
+        if self.ping() is not None:
+            self.request({"job": "stop"})
+
+@click.command()
+@click.option("--config-file", "-c", type=str, default="config.json", help="Config file, using its path_to_project_dir and suite2p_worker section")
+@click.option("--stop", type=bool, is_flag=True, help="Stops the worker running on the configured port")
+@click.option("--status", type=bool, is_flag=True, help="Shows whether a worker is running and how many jobs it has done")
+def run_worker(config_file, stop, status):
+    from helper_fx import setup_logger
+
+    with open(config_file) as f:
+        config_data = json.load(f)
+    logger = setup_logger(Path(config_data["path_to_project_dir"]), log_name="suite2p_worker")
+
+    if stop or status:
+        client = Suite2pClient(config_data, logger, config_file=config_file)
+        state = client.ping()
+        logger.info(f"Suite2p worker: {state if state else 'not running'}")
+        if stop and state:
+            client.stop()
+        return
+
+    Suite2pWorker(config_data, logger).serve()
+
+if __name__ == "__main__":
+    run_worker()
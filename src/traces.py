@@ -0,0 +1,110 @@
+### Neuropil-corrected fluorescence and dF/F for every suite2p ROI at once
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import gaussian_filter1d, maximum_filter1d, minimum_filter1d
+
+TRACE_FILES = ["Fcorr.npy", "dff.npy"]
+
+def maximin_baseline(F, window, sigma):
+    """Baseline of each row as in suite2p: gaussian smoothing, then a sliding minimum and a
+    sliding maximum. Each filter takes the same time whatever the window size.
+
+    Args:
+        F (array): ROIs x frames.
+        window (int): Window in frames.
+        sigma (float): Smoothing in frames, 0 for none.
+    """
+    baseline = gaussian_filter1d(F, sigma, axis=1) if sigma > 0 else F
+    baseline = minimum_filter1d(baseline, window, axis=1)
+    return maximum_filter1d(baseline, window, axis=1)
+
+def percentile_baseline(F, window, percentile, step=None):
+    """Sliding percentile of each row, computed every step frames and interpolated in between.
+
+    The windows are views into F, so the cost is window / step times that of a single
+    percentile of the trace instead of one percentile per frame.
+
+    Args:
+        F (array): ROIs x frames.
+        window (int): Window in frames.
+        percentile (float): Percentile of each window, e.g. 8.
+        step (int, optional): Frames between computed windows. Defaults to window // 10.
+    """
+    n_frames = F.shape[1]
+    window = min(window, n_frames)
+    step = max(1, step or window // 10)
+    half = window // 2
+    padded = np.pad(F, ((0, 0), (half, window - 1 - half)), mode="reflect" if n_frames > 1 else "edge")
+    centers = np.arange(0, n_frames, step)
+    if centers[-1] != n_frames - 1:
+        centers = np.append(centers, n_frames - 1)
+    # window i of the padded trace is centred on frame i, a few rows at a time as
+    # np.percentile copies the windows it is given
+    windows = sliding_window_view(padded, window, axis=1)
+    rows = max(1, 2 ** 24 // (len(centers) * window))
+    coarse = np.concatenate([np.percentile(windows[i:i + rows, centers], percentile, axis=2)
+                             for i in range(0, F.shape[0], rows)]) if len(F) else np.zeros((0, len(centers)))
+
+    # the same linear interpolation for every row
+    frames = np.arange(n_frames)
+    right = np.clip(np.searchsorted(centers, frames), 1, len(centers) - 1) if len(centers) > 1 else np.zeros(n_frames, int)
+    left = np.maximum(right - 1, 0)
+    span = np.maximum(centers[right] - centers[left], 1)
+    weight = (frames - centers[left]) / span
+    return coarse[:, left] * (1 - weight) + coarse[:, right] * weight
+
+def baseline(F, settings, fs):
+    # baseline of each row with the method and windows (in seconds) in settings
+    window = max(1, int(round(settings["window_seconds"] * fs)))
+    if settings["baseline"] == "maximin":
+        return maximin_baseline(F, window, settings["sigma_seconds"] * fs)
+    if settings["baseline"] == "percentile":
+        return percentile_baseline(F, window, settings["percentile"])
+    raise ValueError(f"Unknown baseline method {settings['baseline']}")
+
+def plane_rate(plane_path, default_fs):
+    # frame rate of a plane from suite2p's ops, falling back to default_fs
+    ops_path = Path(plane_path) / "ops.npy"
+    if ops_path.is_file():
+        return float(np.load(ops_path, allow_pickle=True).item().get("fs", default_fs))
+    return default_fs
+
+def compute_plane_traces(plane_path, settings, fs, chunk_rois=256):
+    """Writes Fcorr.npy (F - neuropil_coefficient * Fneu) and dff.npy ((Fcorr - F0) / F0)
+    for every ROI of one suite2p plane.
+
+    Both are float32 ROIs x frames .npy files, like F.npy, so they can be opened with
+    np.load(mmap_mode="r"). F and Fneu are read and the results written a block of ROIs at a
+    time so memory stays bounded for long recordings. The baseline F0 is clipped to
+    min_baseline so ROIs with little fluorescence left after neuropil subtraction don't blow up.
+
+    Args:
+        plane_path (Str or Path object): suite2p plane folder with F.npy and Fneu.npy.
+        settings (dict): neuropil_coefficient, baseline, window_seconds, sigma_seconds,
+            percentile and min_baseline.
+        fs (float): Frame rate in Hz.
+        chunk_rois (int, optional): ROIs per block. Defaults to 256.
+
+    Returns:
+        list: Paths of the files written.
+    """
+    plane_path = Path(plane_path)
+    F = np.load(plane_path / "F.npy", mmap_mode="r")
+    Fneu = np.load(plane_path / "Fneu.npy", mmap_mode="r")
+    if F.shape != Fneu.shape:
+        raise ValueError(f"F.npy {F.shape} and Fneu.npy {Fneu.shape} don't match in {plane_path}")
+
+    paths = [plane_path / name for name in TRACE_FILES]
+    Fcorr_out, dff_out = [np.lib.format.open_memmap(p, mode="w+", dtype=np.float32, shape=F.shape) for p in paths]
+    for start in range(0, F.shape[0], chunk_rois):
+        block = slice(start, start + chunk_rois)
+        Fcorr = np.asarray(F[block], dtype=np.float32) - settings["neuropil_coefficient"] * np.asarray(Fneu[block], dtype=np.float32)
+        F0 = np.maximum(baseline(Fcorr, settings, fs), settings["min_baseline"])
+        Fcorr_out[block] = Fcorr
+        dff_out[block] = (Fcorr - F0) / F0
+    Fcorr_out.flush()
+    dff_out.flush()
+    del Fcorr_out, dff_out
+    return paths
@@ -0,0 +1,239 @@
+### Storage backends used to download data, copying many files in one batched, concurrent job
+import os
+import re
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# result for each file in a batch, ok is False with a message if the file did not arrive
+TransferResult = namedtuple("TransferResult", ["remote", "local", "ok", "message", "attempts"], defaults=[1])
+
+def get_backend(config_data, logger=None):
+    """Returns the storage backend set in the storage section of the config file.
+
+    "backend" can be "azcopy" (default, uses path_to_azcopy) or "local" (remote paths are
+    folders on this machine, e.g. for tests or an on-prem mirror). "parallelism" sets how
+    many files are transferred at once. "retries", "backoff_seconds" and "verify_md5" are
+    used by download.
+    """
+    storage = config_data.get("storage", {})
+    backend = storage.get("backend", "azcopy")
+    options = {
+        "parallelism": storage.get("parallelism", 16),
+        "retries": storage.get("retries", 3),
+        "backoff": storage.get("backoff_seconds", 5),
+        "verify_md5": storage.get("verify_md5", False),
+        "logger": logger,
+    }
+
+    if backend == "azcopy":
+        return AzCopyBackend(config_data["path_to_azcopy"], **options)
+    elif backend == "local":
+        return LocalBackend(**options)
+    else:
+        raise ValueError(f"Unknown storage backend {backend}. Options are azcopy or local")
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            md5.update(block)
+    return md5.digest()
+
+def verify_file(path, size=None, md5=None):
+    """Checks a downloaded file against the remote size and md5 (hex or base64, as Azure
+    reports it) when they are known. Returns (ok, message)."""
+    if not os.path.isfile(path):
+        return False, "file missing after transfer"
+    local_size = os.path.getsize(path)
+    if size is not None and local_size != size:
+        return False, f"size is {local_size} bytes, expected {size}"
+    if size is None and local_size == 0:
+        return False, "file is empty"
+    if md5 is not None:
+        digest = file_md5(path)
+        if md5 not in (digest.hex(), base64.b64encode(digest).decode()):
+            return False, "md5 does not match remote"
+    return True, ""
+
+class StorageBackend():
+    """Base class for storage backends. Subclasses implement copy_batch, and stat and fetch
+    for verified downloads."""
+    def __init__(self, parallelism=16, retries=3, backoff=5, verify_md5=False, logger=None):
+        self.parallelism = parallelism
+        self.retries = retries
+        self.backoff = backoff
+        self.verify_md5 = verify_md5
+        self.logger = logger
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+        else:
+            print(message)
+
+    def copy(self, remote, local):
+        # copies a single file, returns its TransferResult
+        return self.copy_batch([(remote, local)])[0]
+
+    def copy_batch(self, pairs):
+        """Copies each (remote, local) pair and returns a TransferResult for each, in order."""
+        raise NotImplementedError
+
+    def stat(self, remote):
+        """Returns (size, md5) of a remote file, either is None when it can't be found."""
+        return None, None
+
+    def fetch(self, remote, part):
+        """Copies remote to the local file part, carrying on from an earlier partial copy where possible."""
+        raise NotImplementedError
+
+    def download(self, remote, local):
+        """Downloads one large file, verified against the remote size (and md5 if verify_md5).
+
+        Data goes to local + ".part" first and is only renamed to local once verified, so a
+        truncated file never looks like a finished download. Failed attempts are retried
+        with exponential backoff and resume from the partial file.
+
+        Returns:
+            TransferResult: With the number of attempts made.
+        """
+        size, md5 = self.stat(remote)
+        part = f"{local}.part"
+        os.makedirs(os.path.dirname(str(local)), exist_ok=True)
+
+        message = ""
+        for attempt in range(1, self.retries + 2):
+            try:
+                self.fetch(remote, part)
+                ok, message = verify_file(part, size, md5 if self.verify_md5 else None)
+            except Exception as e:
+                ok, message = False, repr(e)
+
+            if ok:
+                os.replace(part, local)
+                return TransferResult(remote, local, True, "", attempt)
+
+            self.log(f"Attempt {attempt} to download {remote} failed: {message}")
+            # a partial file larger than the remote one can't be resumed
+            if size is not None and os.path.isfile(part) and os.path.getsize(part) >= size:
+                os.remove(part)
+            if attempt <= self.retries:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        return TransferResult(remote, local, False, message, attempt)
+
+class LocalBackend(StorageBackend):
+    """Copies files between folders on this machine with a pool of threads."""
+    def stat(self, remote):
+        try:
+            return os.path.getsize(remote), None
+        except OSError:
+            return None, None
+
+    def fetch(self, remote, part):
+        # appends whatever is missing from the partial file
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        with open(remote, "rb") as src, open(part, "ab") as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+
+    def copy_one(self, remote, local):
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            shutil.copyfile(remote, local)
+            return TransferResult(remote, local, True, "")
+        except OSError as e:
+            return TransferResult(remote, local, False, str(e))
+
+    def copy_batch(self, pairs):
+        self.log(f"Copying {len(pairs)} files with {self.parallelism} threads")
+        with ThreadPoolExecutor(max_workers=max(1, self.parallelism)) as executor:
+            return list(executor.map(lambda pair: self.copy_one(*pair), pairs))
+
+class AzCopyBackend(StorageBackend):
+    """Copies files with azcopy, running one azcopy job per remote folder.
+
+    Files are listed with --list-of-files so a single azcopy process (and TLS session) fetches
+    them all, with AZCOPY_CONCURRENCY_VALUE set to parallelism. Files land in a staging folder
+    next to their destination and are then moved to their local names.
+    """
+    def __init__(self, path_to_azcopy, **kwargs):
+        super().__init__(**kwargs)
+        self.path_to_azcopy = str(path_to_azcopy)
+
+    def stat(self, remote):
+        # azcopy list reports the size in bytes and, if stored on the blob, its md5
+        try:
+            output = subprocess.run([self.path_to_azcopy, "list", str(remote), "--machine-readable",
+                                     "--properties=ContentMD5"], capture_output=True, text=True).stdout
+        except OSError:
+            return None, None
+        size = re.search(r"Content Length: (\d+)", output)
+        md5 = re.search(r"ContentMD5: (\S+)", output)
+        return (int(size.group(1)) if size else None), (md5.group(1) if md5 else None)
+
+    def fetch(self, remote, part):
+        # azcopy keeps a plan for each job, so an interrupted job is resumed with its job id
+        job_file = f"{part}.job"
+        if os.path.isfile(job_file):
+            with open(job_file) as f:
+                job_id = f.read().strip()
+            self.log(f"Resuming azcopy job {job_id}")
+            if subprocess.call([self.path_to_azcopy, "jobs", "resume", job_id]) == 0:
+                os.remove(job_file)
+                return
+            os.remove(job_file)
+
+        process = subprocess.Popen([self.path_to_azcopy, "cp", str(remote), str(part), "--check-md5=FailIfDifferent"],
+                                   stdout=subprocess.PIPE, text=True)
+        for line in process.stdout:
+            print(line, end="")
+            job_id = re.search(r"Job ([0-9a-fA-F-]{36})", line)
+            if job_id and not os.path.isfile(job_file):
+                with open(job_file, "w") as f:
+                    f.write(job_id.group(1))
+        if process.wait() == 0 and os.path.isfile(job_file):
+            os.remove(job_file)
+
+    def copy_batch(self, pairs):
+        # group files by remote folder as azcopy lists files relative to one source
+        groups = {}
+        for remote, local in pairs:
+            folder, name = str(remote).rsplit("/", 1)
+            groups.setdefault(folder, []).append((name, remote, local))
+
+        env = dict(os.environ, AZCOPY_CONCURRENCY_VALUE=str(self.parallelism))
+        results = {}
+        for folder, files in groups.items():
+            locals_ = [str(local) for _, _, local in files]
+            staging_root = os.path.commonpath([os.path.dirname(local) for local in locals_])
+            os.makedirs(staging_root, exist_ok=True)
+            staging = tempfile.mkdtemp(prefix=".azcopy_", dir=staging_root)
+            try:
+                list_file = os.path.join(staging, "files.txt")
+                with open(list_file, "w") as f:
+                    f.write("\n".join(name for name, _, _ in files))
+
+                self.log(f"Copying {len(files)} files from {folder} with azcopy")
+                subprocess.call([self.path_to_azcopy, "cp", folder, staging, f"--list-of-files={list_file}"], env=env)
+
+                for name, remote, local in files:
+                    # azcopy may or may not nest files in a folder named after the source
+                    candidates = [os.path.join(staging, name), os.path.join(staging, os.path.basename(folder), name)]
+                    found = [c for c in candidates if os.path.isfile(c)]
+                    if found:
+                        os.makedirs(os.path.dirname(str(local)), exist_ok=True)
+                        shutil.move(found[0], local)
+                        results[(remote, local)] = TransferResult(remote, local, True, "")
+                    else:
+                        results[(remote, local)] = TransferResult(remote, local, False, "not copied by azcopy, check azcopy log")
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        return [results[(remote, local)] for remote, local in pairs]
@@ -0,0 +1,165 @@
+### Cuts peri-event windows out of suite2p traces as cells x trials x time tensors
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+TRIAL_FILES = ["trials.npy", "trials_info.npz"]
+
+def window_offsets(pre_seconds, post_seconds, fs):
+    # frames of the window relative to the event frame, which is at offset 0
+    return np.arange(-int(round(pre_seconds * fs)), int(round(post_seconds * fs)) + 1)
+
+def trial_indices(event_frames, offsets, n_frames):
+    """Frame of every sample of every trial at once.
+
+    Returns:
+        index (array): trials x time frames, clipped into the recording so they can be used
+            for indexing.
+        inside (array): trials x time, False for samples before the start or after the end
+            of the recording, and for events that fell outside it (frame -1).
+    """
+    event_frames = np.asarray(event_frames, dtype=np.int64)
+    index = event_frames[:, None] + offsets[None, :]
+    inside = (index >= 0) & (index < n_frames) & (event_frames[:, None] >= 0)
+    return np.clip(index, 0, max(n_frames - 1, 0)), inside
+
+def gather_trials(traces, index, inside, rows=None, chunk_cells=256, out=None):
+    """Gathers the windows of all trials from every cell with one fancy index per block of cells.
+
+    Args:
+        traces (array): ROIs x frames, e.g. a memory-mapped dff.npy.
+        index (array): trials x time frames, from trial_indices.
+        inside (array): trials x time, samples outside it are NaN.
+        rows (array, optional): ROIs to gather. Defaults to all of them.
+        chunk_cells (int, optional): Cells read at a time. Defaults to 256.
+        out (array, optional): cells x trials x time array to fill, e.g. a memory-mapped .npy.
+            Defaults to a new float32 array.
+
+    Returns:
+        array: cells x trials x time.
+    """
+    rows = np.arange(traces.shape[0]) if rows is None else np.asarray(rows)
+    if out is None:
+        out = np.empty((len(rows),) + index.shape, dtype=np.float32)
+    for start in range(0, len(rows), chunk_cells):
+        block = np.asarray(traces[rows[start:start + chunk_cells]], dtype=np.float32)
+        out[start:start + chunk_cells] = np.where(inside, block[:, index], np.nan)
+    return out
+
+def select_events(alignment, event_column=None, event_values=None):
+    # positions of the events to cut trials around, those whose event_column is in event_values if given
+    n_events = len(alignment["event_frames"])
+    if event_column is None or not event_values:
+        return np.arange(n_events)
+    if f"column_{event_column}" not in alignment:
+        raise ValueError(f"The events file has no column {event_column}")
+    values = alignment[f"column_{event_column}"]
+    return np.flatnonzero(np.isin(values.astype(str), [str(v) for v in event_values]))
+
+def extract_session_trials(trace_paths, cell_ids, alignment_path, out_folder, settings, fs):
+    """Writes the trial tensor of one session and a description of its axes.
+
+    trials.npy is float32 cells x trials x time, with the cells of every plane one after the
+    other. trials_info.npz holds, for each cell, its plane and suite2p ROI index, for each
+    trial, its position in the events file, its event frame, whether its whole window is in
+    the recording and every event column, and the time of each sample from the event in
+    seconds.
+
+    Args:
+        trace_paths (list): cells x frames .npy file of each plane.
+        cell_ids (list): suite2p ROI indices to keep in each plane.
+        alignment_path (Str or Path object): behav_alignment.npz of the session.
+        out_folder (Str or Path object): Folder for trials.npy and trials_info.npz.
+        settings (dict): pre_seconds, post_seconds, event_column, event_values and
+            out_of_range ("nan" keeps every trial, "drop" keeps trials whose whole window is
+            in the recording).
+        fs (float): Frame rate of the traces in Hz.
+
+    Returns:
+        tuple: cells, trials and samples per trial.
+    """
+    with np.load(alignment_path) as f:
+        alignment = dict(f)
+    events = select_events(alignment, settings["event_column"], settings["event_values"])
+    offsets = window_offsets(settings["pre_seconds"], settings["post_seconds"], fs)
+
+    traces = [np.load(path, mmap_mode="r") for path in trace_paths]
+    n_frames = min(t.shape[1] for t in traces) if traces else 0
+    index, inside = trial_indices(alignment["event_frames"][events], offsets, n_frames)
+    complete = inside.all(axis=1)
+    if settings["out_of_range"] == "drop":
+        events, index, inside, complete = events[complete], index[complete], inside[complete], complete[complete]
+
+    out_folder = Path(out_folder)
+    n_cells = sum(len(ids) for ids in cell_ids)
+    out = np.lib.format.open_memmap(out_folder / TRIAL_FILES[0], mode="w+", dtype=np.float32,
+                                    shape=(n_cells,) + index.shape)
+    start = 0
+    for plane_traces, ids in zip(traces, cell_ids):
+        gather_trials(plane_traces, index, inside, rows=ids, out=out[start:start + len(ids)])
+        start += len(ids)
+    out.flush()
+    del out
+
+    columns = {key: value[events] for key, value in alignment.items() if key.startswith(("event_", "column_"))
+               and value.ndim == 1 and len(value) == len(alignment["event_frames"])}
+    np.savez(out_folder / TRIAL_FILES[1],
+             cell_plane=np.repeat(np.arange(len(cell_ids)), [len(ids) for ids in cell_ids]),
+             cell_roi=np.concatenate(cell_ids) if cell_ids else np.zeros(0, int),
+             trial_event=events, trial_complete=complete, time=offsets / fs, **columns)
+    return n_cells, len(events), len(offsets)
+
+def export_cohort(sessions, out_folder):
+    """Joins the trial tensors of many sessions into one table for cohort analysis.
+
+    Sessions have different cells, so every (session, cell, trial) becomes a row. trials.npy
+    is float32 rows x time and trials.csv describes each row with animal, date, session,
+    plane, roi, trial, complete and the event columns. Sessions are copied one at a time.
+
+    Args:
+        sessions (list): (animal, date, session, folder with trials.npy and trials_info.npz).
+        out_folder (Str or Path object): Folder for the cohort files.
+
+    Returns:
+        DataFrame: The rows of trials.csv.
+    """
+    out_folder = Path(out_folder)
+    out_folder.mkdir(parents=True, exist_ok=True)
+    shapes, infos = [], []
+    for _, _, _, folder in sessions:
+        shapes.append(np.load(Path(folder) / TRIAL_FILES[0], mmap_mode="r").shape)
+        with np.load(Path(folder) / TRIAL_FILES[1]) as f:
+            infos.append(dict(f))
+    times = {tuple(np.round(info["time"], 6)) for info in infos}
+    if len(times) > 1:
+        raise ValueError("Sessions have different trial windows, extract them with the same settings and frame rate")
+
+    n_time = shapes[0][2] if shapes else 0
+    out = np.lib.format.open_memmap(out_folder / TRIAL_FILES[0], mode="w+", dtype=np.float32,
+                                    shape=(sum(s[0] * s[1] for s in shapes), n_time))
+    tables, start = [], 0
+    for (animal, date, session, folder), shape, info in zip(sessions, shapes, infos):
+        n_cells, n_trials, _ = shape
+        out[start:start + n_cells * n_trials] = np.load(Path(folder) / TRIAL_FILES[0], mmap_mode="r").reshape(-1, n_time)
+        start += n_cells * n_trials
+        # rows go cell by cell, then trial by trial, as in the reshaped tensor
+        table = pd.DataFrame({
+            "animal": animal, "date": date, "session": session,
+            "plane": np.repeat(info["cell_plane"], n_trials),
+            "roi": np.repeat(info["cell_roi"], n_trials),
+            "trial": np.tile(info["trial_event"], n_cells),
+            "complete": np.tile(info["trial_complete"], n_cells),
+        })
+        for key, value in info.items():
+            if key == "event_times" or key.startswith("column_"):
+                table[key] = np.tile(value, n_cells)
+        tables.append(table)
+    out.flush()
+    del out
+
+    table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    table.to_csv(out_folder / "trials.csv", index=False)
+    if infos:
+        np.save(out_folder / "time.npy", infos[0]["time"])
+    return table
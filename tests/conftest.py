@@ -0,0 +1,5 @@
+### Puts src on the path so tests import the modules the same way the scripts do
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
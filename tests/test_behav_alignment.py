@@ -0,0 +1,33 @@
+import numpy as np
+import tifffile
+
+from manifest import SessionManifest
+from test_prep import make_preprocess
+from trials import select_events
+
+def write_session(tmp_path, event_header):
+    tifffile.imwrite(tmp_path / "raw.tif", np.zeros((30, 8, 8), dtype=np.uint16))
+    (tmp_path / "events.csv").write_text(event_header + "\n0.5,1,a\n1.5,2,b\n")
+    (tmp_path / "frames.csv").write_text("\n".join(str(i * 0.1) for i in range(30)) + "\n")
+    preprocess = make_preprocess(tmp_path)
+    preprocess.manifest = SessionManifest(tmp_path / "manifest.json")
+    preprocess.event_file_local = tmp_path / "events.csv"
+    preprocess.frame_file_local = tmp_path / "frames.csv"
+    return preprocess
+
+def test_event_columns_named_like_fixed_keys(tmp_path):
+    preprocess = write_session(tmp_path, "timestamp,times,frames")
+    preprocess.align_behav()
+    with np.load(tmp_path / "proc_s2p" / "behav_alignment.npz") as f:
+        alignment = dict(f)
+    np.testing.assert_array_equal(alignment["column_times"], [1, 2])
+    np.testing.assert_array_equal(alignment["column_frames"], ["a", "b"])
+    np.testing.assert_array_equal(alignment["event_times"], [0.5, 1.5])
+    # frames are z-projected in threes
+    np.testing.assert_array_equal(alignment["event_frames"], [1, 5])
+    np.testing.assert_array_equal(select_events(alignment, "frames", ["b"]), [1])
+
+def test_duplicate_event_columns_are_not_aligned(tmp_path):
+    preprocess = write_session(tmp_path, "timestamp,trial,trial")
+    assert preprocess.align_behav() is False
+    assert not (tmp_path / "proc_s2p" / "behav_alignment.npz").exists()
@@ -0,0 +1,15 @@
+import pytest
+
+from benchmark import make_cases, make_stack, run_case
+
+CASES = make_cases(["remove_leftover_frames", "reshape_array", "process_in_chunks", "prep_for_s2p"], [61],
+                   ["uint16", "int16"], ["streaming", "memory"], [30], [1, 2], ["tif", "binary"], 3)
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: "-".join(str(v) for v in case.values()))
+def test_benchmark_case_runs(case, tmp_path_factory):
+    # a small stack per dtype, with a leftover frame, shared by the cases
+    data_dir = tmp_path_factory.getbasetemp() / "benchmark_data"
+    stack = make_stack(data_dir / f"stack_{case['dtype']}.tif", case["frames"], size=32, dtype=case["dtype"])
+    result = run_case(dict(case, stack=str(stack), out_dir=str(tmp_path_factory.mktemp("output")), repeat=1))
+    assert result["frames"] == 61
+    assert result["seconds"] > 0
@@ -0,0 +1,30 @@
+import shutil
+
+import numpy as np
+import tifffile
+
+from catalog import ProjectCatalog
+from test_prep import make_preprocess
+
+def test_make_dirs_creates_deleted_folders_again(tmp_path):
+    catalog = ProjectCatalog(tmp_path / "catalog.sqlite")
+    folder = tmp_path / "fast" / "proc_s2p"
+    catalog.make_dirs([folder])
+    shutil.rmtree(tmp_path / "fast")
+    catalog.make_dirs([folder])
+    assert folder.is_dir()
+
+def test_stage_runs_after_cached_session_folder_is_deleted(tmp_path):
+    tifffile.imwrite(tmp_path / "raw.tif", np.random.default_rng(0).integers(100, 200, (60, 16, 16)).astype(np.uint16))
+    preprocess = make_preprocess(tmp_path, chunk_size=30)
+    preprocess.config_data["catalog"] = {"path": str(tmp_path / "catalog.sqlite")}
+    preprocess.config_data["frame_qc"] = {"write_bad_frames": True}
+    preprocess.animal, preprocess.ses_path = "A1", "ses-001-20230201"
+    preprocess.make_dirs([preprocess.ses_ij_path, preprocess.ses_s2p_path])
+
+    # e.g. the fast disk was wiped between runs
+    shutil.rmtree(preprocess.ses_s2p_path)
+    shutil.rmtree(preprocess.ses_ij_path)
+    preprocess.make_dirs([preprocess.ses_ij_path, preprocess.ses_s2p_path])
+    preprocess.prep_for_s2p()
+    assert (preprocess.ses_s2p_path / "bad_frames.npy").is_file()
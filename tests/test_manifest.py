@@ -0,0 +1,71 @@
+import os
+
+from manifest import SessionManifest, file_records
+from test_prep import make_preprocess
+
+def test_in_place_outputs_only_have_to_exist(tmp_path):
+    data = tmp_path / "data.bin"
+    chunk = tmp_path / "chunk_0.tif"
+    data.write_bytes(b"\0" * 16)
+    chunk.write_bytes(b"\0" * 16)
+    records = [dict(r, in_place=True) if r["path"] == str(data) else r for r in file_records([data, chunk])]
+
+    manifest = SessionManifest(tmp_path / "manifest.json")
+    manifest.record("prep_for_s2p", {}, {}, records)
+
+    # rewritten by a later stage, e.g. suite2p registering data.bin
+    data.write_bytes(b"\1" * 32)
+    os.utime(data, (1, 1))
+    assert manifest.outputs_exist("prep_for_s2p")
+
+    # other outputs still have to be unchanged
+    chunk.write_bytes(b"\1" * 32)
+    assert not manifest.outputs_exist("prep_for_s2p")
+
+    chunk.write_bytes(b"\0" * 16)
+    data.unlink()
+    assert not manifest.outputs_exist("prep_for_s2p")
+
+def make_session(tmp_path):
+    preprocess = make_preprocess(tmp_path)
+    preprocess.config_data["storage"] = {"backend": "local"}
+    preprocess.manifest = SessionManifest(tmp_path / "manifest.json")
+    preprocess.imaging_file_remote = str(tmp_path / "remote" / "scan")
+    (tmp_path / "remote").mkdir()
+    return preprocess
+
+def test_download_is_stale_when_remote_file_changes(tmp_path):
+    preprocess = make_session(tmp_path)
+    remote = tmp_path / "remote" / "scan.tif"
+    remote.write_bytes(b"\0" * 16)
+    inputs = preprocess.stage_inputs("get_data")
+    assert inputs["size"] == 16
+    preprocess.manifest.record("get_data", inputs, {}, [])
+    assert preprocess.manifest.is_fresh("get_data", preprocess.stage_inputs("get_data"), {})
+
+    # re-uploaded under the same name
+    remote.write_bytes(b"\0" * 32)
+    assert not preprocess.manifest.is_fresh("get_data", preprocess.stage_inputs("get_data"), {})
+
+    # downloads recorded with only the remote path, or a remote that can't be reached, aren't rerun
+    preprocess.manifest.record("get_data", {"remote": preprocess.imaging_file_remote}, {}, [])
+    assert preprocess.manifest.is_fresh("get_data", preprocess.stage_inputs("get_data"), {})
+    # but downloading again records the size
+    preprocess.animal, preprocess.date, preprocess.ses_path = "A1", "01/02/2023", "ses-001-20230201"
+    assert preprocess.run_stage("get_data")
+    assert preprocess.manifest.stages["get_data"]["inputs"]["size"] == 32
+    remote.unlink()
+    assert preprocess.manifest.is_fresh("get_data", preprocess.stage_inputs("get_data"), {})
+
+def test_sessions_without_manifest_skipped_only_if_suite2p_finished(tmp_path):
+    preprocess = make_session(tmp_path)
+    plane = preprocess.final_ses_s2p_path / "suite2p" / "plane0"
+    plane.mkdir(parents=True)
+    # prep written straight into suite2p's binary, then interrupted
+    (plane / "data.bin").write_bytes(b"\0" * 16)
+    (plane / "ops.npy").write_bytes(b"\0" * 16)
+    assert not preprocess.do_suite2p_files_exist()
+
+    (plane / "stat.npy").write_bytes(b"\0" * 16)
+    (plane / "iscell.npy").write_bytes(b"\0" * 16)
+    assert preprocess.do_suite2p_files_exist()
@@ -0,0 +1,62 @@
+import logging
+from pathlib import Path
+
+import imageio
+import numpy as np
+import pytest
+import tifffile
+
+from helper_fx import Preprocess, process_in_chunks
+
+def make_preprocess(tmp_path, **prep_settings):
+    config_data = {"catalog": {"enabled": False}, "prep_settings": dict({"zplanes": 3, "n_workers": 1}, **prep_settings)}
+    preprocess = Preprocess(config_data, False, False, False)
+    preprocess.logger = logging.getLogger("test_prep")
+    preprocess.imaging_file_local = tmp_path / "raw.tif"
+    preprocess.ses_ij_path = tmp_path / "proc_ij"
+    preprocess.ses_s2p_path = tmp_path / "proc_s2p"
+    preprocess.final_ses_s2p_path = tmp_path / "proc_s2p"
+    preprocess.ses_ij_path.mkdir(exist_ok=True)
+    return preprocess
+
+def test_prep_with_new_settings_leaves_no_old_chunks(tmp_path):
+    frames = np.random.default_rng(0).integers(100, 200, (120, 16, 16)).astype(np.uint16)
+    tifffile.imwrite(tmp_path / "raw.tif", frames)
+
+    make_preprocess(tmp_path, chunk_size=15).prep_for_s2p()
+    assert len(list((tmp_path / "proc_ij").glob("chunk_*.tif"))) == 8
+
+    make_preprocess(tmp_path, chunk_size=60).prep_for_s2p()
+    chunks = sorted((tmp_path / "proc_ij").glob("chunk_*.tif"))
+    assert [c.name for c in chunks] == ["chunk_0.tif", "chunk_1.tif"]
+    written = np.concatenate([np.stack(imageio.mimread(c)) for c in chunks])
+    np.testing.assert_array_equal(written, frames.reshape(40, 3, 16, 16).max(axis=1))
+
+def test_chunk_size_must_fit_whole_binned_volumes(tmp_path):
+    preprocess = make_preprocess(tmp_path, chunk_size=60, temporal_bin=7)
+    with pytest.raises(ValueError):
+        preprocess.get_prep_settings()
+    with pytest.raises(ValueError):
+        process_in_chunks(np.zeros((120, 4, 4), dtype=np.uint16), tmp_path, chunk_size=60, zplanes=3, temporal_bin=7)
+
+def test_binary_ops_point_suite2p_at_bad_frames(tmp_path):
+    frames = np.random.default_rng(0).integers(100, 200, (120, 16, 16)).astype(np.uint16)
+    frames[30:33] = 0
+    tifffile.imwrite(tmp_path / "raw.tif", frames)
+
+    preprocess = make_preprocess(tmp_path, chunk_size=60, output="binary")
+    preprocess.config_data["frame_qc"] = {"write_bad_frames": True}
+    preprocess.prep_for_s2p()
+    # suite2p looks for bad_frames.npy in the first data_path of an existing binary's ops.npy
+    ops = np.load(tmp_path / "proc_s2p" / "suite2p" / "plane0" / "ops.npy", allow_pickle=True).item()
+    bad_frames = np.load(Path(ops["data_path"][0]) / "bad_frames.npy")
+    assert 10 in bad_frames
+
+def test_bad_frames_are_only_reported_by_default(tmp_path):
+    frames = np.random.default_rng(0).integers(100, 200, (120, 16, 16)).astype(np.uint16)
+    frames[30:33] = 0
+    tifffile.imwrite(tmp_path / "raw.tif", frames)
+
+    make_preprocess(tmp_path, chunk_size=60).prep_for_s2p()
+    assert (tmp_path / "proc_s2p" / "frame_qc.csv").is_file()
+    assert not list(tmp_path.rglob("bad_frames.npy"))
@@ -0,0 +1,24 @@
+import numpy as np
+
+from helper_fx import project_chunk
+
+def test_std_of_bright_pixels_with_little_variation():
+    # a 5000 baseline with an sd of about 3, and near-constant pixels close to the uint16 maximum
+    rng = np.random.default_rng(0)
+    chunk = rng.normal(5000, 3, (60, 64, 64)).round().astype(np.uint16)
+    chunk[:, :8] = 65000 + rng.integers(0, 2, (60, 8, 64))
+
+    std = project_chunk(chunk, zplanes=3, stats=("std",))["std"]
+    expected = chunk.reshape(20, 3, 64, 64).std(axis=1, dtype=np.float64)
+    np.testing.assert_allclose(std, expected, rtol=1e-4, atol=1e-4)
+    assert (std[:, 8:] > 0).mean() > 0.95
+
+def test_projections_match_numpy():
+    rng = np.random.default_rng(1)
+    chunk = rng.integers(0, 4000, (30, 16, 16)).astype(np.uint16)
+    projections = project_chunk(chunk, zplanes=3, stats=("max", "mean", "std", "sum"))
+    volumes = chunk.reshape(10, 3, 16, 16)
+    np.testing.assert_array_equal(projections["max"], volumes.max(axis=1))
+    np.testing.assert_allclose(projections["mean"], volumes.mean(axis=1), rtol=1e-6)
+    np.testing.assert_allclose(projections["sum"], volumes.sum(axis=1), rtol=1e-6)
+    np.testing.assert_allclose(projections["std"], volumes.std(axis=1), rtol=1e-4, atol=1e-3)
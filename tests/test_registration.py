@@ -0,0 +1,27 @@
+import logging
+
+import numpy as np
+
+from registration import SessionRegistration
+
+def save_ops(path, image):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, {"meanImg": image})
+    return path
+
+def test_no_sessions_to_register(tmp_path):
+    registration = SessionRegistration(tmp_path / "registration", {}, logging.getLogger("test_registration"))
+    assert registration.run({}) == {}
+
+def test_sessions_of_another_size_are_skipped(tmp_path):
+    image = np.random.default_rng(0).random((64, 64)).astype(np.float32)
+    ops_files = {
+        "ses-001": save_ops(tmp_path / "ses-001" / "ops.npy", image),
+        "ses-002": save_ops(tmp_path / "ses-002" / "ops.npy", np.roll(image, (3, -2), axis=(0, 1))),
+        "ses-003": save_ops(tmp_path / "ses-003" / "ops.npy", image[:32]),
+    }
+    registration = SessionRegistration(tmp_path / "registration", {}, logging.getLogger("test_registration"))
+    transforms = registration.run(ops_files)
+    assert sorted(transforms) == ["ses-001", "ses-002"]
+    # the reference is the average of both sessions, so only the difference of their shifts is known
+    np.testing.assert_allclose(transforms["ses-002"]["shift"] - transforms["ses-001"]["shift"], [-3, 2], atol=0.2)
@@ -0,0 +1,53 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from roi_matching import ROIMatcher, SessionROIs, match_pair
+
+def square(y, x, size=6):
+    yy, xx = np.mgrid[y:y + size, x:x + size]
+    return np.stack([yy.ravel(), xx.ravel()], axis=1)
+
+def save_session(plane_path, pixels, iscell):
+    plane_path.mkdir(parents=True)
+    stat = np.array([{"ypix": p[:, 0], "xpix": p[:, 1]} for p in pixels], dtype=object)
+    np.save(plane_path / "stat.npy", stat, allow_pickle=True)
+    np.save(plane_path / "iscell.npy", np.stack([iscell, np.ones(len(iscell))], axis=1))
+
+def test_match_pair_is_one_to_one(tmp_path):
+    shape = (64, 64)
+    a = SessionROIs([0, 1, 2], [square(10, 10), square(30, 30), square(50, 10)], {"shift": np.zeros(2)}, shape)
+    # session b is offset by (-2, 1), which its registration undoes
+    b_pixels = [square(31, 30), square(50, 13), square(10, 40), square(33, 30)]
+    b = SessionROIs([0, 1, 2, 5], [p + [-2, 1] for p in b_pixels], {"shift": np.array([2.0, -1.0])}, shape)
+
+    roi_a, roi_b, score = match_pair(a, b, max_distance=10, min_overlap=0.3)
+    # b's ROI 5 also overlaps a's ROI 1, but less than b's ROI 0
+    assert dict(zip(roi_a, roi_b)) == {1: 0, 2: 1}
+    np.testing.assert_allclose(score[np.argsort(roi_a)], [30 / 42, 18 / 54])
+
+def test_matched_rois_become_one_cell(tmp_path):
+    save_session(tmp_path / "ses-001", [square(10, 10), square(30, 30), square(50, 50)], np.array([1, 1, 0]))
+    save_session(tmp_path / "ses-002", [square(50, 50), square(31, 31), square(10, 40)], np.array([1, 1, 1]))
+    transforms = {session: {"shift": np.zeros(2)} for session in ["ses-001", "ses-002"]}
+    matcher = ROIMatcher(tmp_path / "roi_matching", {}, logging.getLogger("test_roi_matching"))
+
+    table = matcher.run({s: tmp_path / s for s in transforms}, transforms, (64, 64))
+    # ses-001's ROI 2 isn't a cell, so ses-002's ROI 0 has no match
+    assert table[["ses-001", "ses-002", "n_sessions"]].values.tolist() == [[1, 1, 2], [0, -1, 1], [-1, 0, 1], [-1, 2, 1]]
+    assert (tmp_path / "roi_matching" / "matches" / "ses-001__ses-002.npz").is_file()
+
+def test_cell_table_never_joins_two_rois_of_a_session(tmp_path):
+    matcher = ROIMatcher(tmp_path, {}, logging.getLogger("test_roi_matching"))
+    roi_ids = {"s1": np.array([0, 1]), "s2": np.array([0, 1]), "s3": np.array([1, 2])}
+    matches = pd.DataFrame({
+        "session_a": ["s1", "s2", "s1", "s1"], "roi_a": [0, 0, 0, 1],
+        "session_b": ["s2", "s3", "s3", "s2"], "roi_b": [0, 1, 2, 1],
+        "score": [0.9, 0.8, 0.7, 0.5],
+    })
+
+    table = matcher.cell_table(roi_ids, matches)
+    # s1/0 - s3/2 is left out, the cell already has s3's ROI 1 from a better match
+    assert table[["s1", "s2", "s3", "n_sessions"]].values.tolist() == [[0, 0, 1, 3], [1, 1, -1, 2], [-1, -1, 2, 1]]
+    assert table["cell_id"].tolist() == [0, 1, 2]
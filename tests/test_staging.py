@@ -0,0 +1,58 @@
+import logging
+import os
+
+import staging
+from staging import GB, StagingManager
+
+def make_manager(tmp_path, capacity_bytes):
+    return StagingManager(tmp_path / "fast", {"staging": {"capacity_gb": capacity_bytes / GB}}, logging.getLogger("test_staging"))
+
+def stage_session(manager, key, nbytes):
+    folder = manager.root / key
+    folder.mkdir()
+    (folder / "data.bin").write_bytes(b"\0" * nbytes)
+    manager.reserve(key, nbytes, [folder])
+    manager.release(key)
+    return folder
+
+def test_least_recently_used_sessions_are_evicted(tmp_path):
+    manager = make_manager(tmp_path, 100)
+    evicted = []
+    manager.on_evict = lambda key, paths: evicted.append(key)
+    old = stage_session(manager, "A1_ses-001", 40)
+    recent = stage_session(manager, "A1_ses-002", 40)
+    # reused by a rerun, so it becomes the most recently used
+    manager.reserve("A1_ses-001", 40, [old])
+    manager.release("A1_ses-001")
+
+    manager.reserve("A1_ses-003", 40, [manager.root / "A1_ses-003"])
+    assert evicted == ["A1_ses-002"]
+    assert not recent.exists() and old.exists()
+    assert set(manager.read_state()) == {"A1_ses-001", "A1_ses-003"}
+
+def test_copy_back_checks_every_file(tmp_path):
+    manager = make_manager(tmp_path, 100)
+    src = stage_session(manager, "A1_ses-001", 40)
+    (src / "plane0").mkdir()
+    (src / "plane0" / "F.npy").write_bytes(b"\1" * 8)
+    dst = tmp_path / "project" / "suite2p"
+
+    assert manager.copy_back("A1_ses-001", src, dst).result()
+    assert (dst / "plane0" / "F.npy").read_bytes() == b"\1" * 8
+    assert (dst / "data.bin").stat().st_size == 40
+    assert manager.read_state()["A1_ses-001"]["state"] == "done"
+
+def test_failed_copy_back_keeps_session_on_fast_disk(tmp_path, monkeypatch):
+    manager = make_manager(tmp_path, 100)
+    src = stage_session(manager, "A1_ses-001", 40)
+    dst = tmp_path / "project" / "suite2p"
+    # every copy comes out different from its source
+    monkeypatch.setattr(staging, "file_md5", lambda path: os.fsencode(path))
+
+    assert not manager.copy_back("A1_ses-001", src, dst).result()
+    assert not (dst / "data.bin").exists() and not (dst / "data.bin.tmp").exists()
+    assert manager.read_state()["A1_ses-001"]["state"] == "failed"
+
+    # not evicted even when space is needed
+    manager.reserve("A1_ses-002", 80, [manager.root / "A1_ses-002"])
+    assert src.exists()
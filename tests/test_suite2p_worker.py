@@ -0,0 +1,53 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import types
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import pytest
+
+from suite2p_worker import Suite2pClient, Suite2pWorker, worker_authkey
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    # the worker only needs default_ops and run_s2p from suite2p
+    monkeypatch.setitem(sys.modules, "suite2p", types.SimpleNamespace(default_ops=dict, run_s2p=lambda ops, db: None))
+    config_data = {"path_to_project_dir": str(tmp_path), "suite2p_worker": {"port": free_port(), "start": False}}
+    logger = logging.getLogger("test_suite2p_worker")
+    thread = threading.Thread(target=Suite2pWorker(config_data, logger).serve, daemon=True)
+    thread.start()
+    client = Suite2pClient(config_data, logger)
+    while client.ping() is None:
+        time.sleep(0.05)
+    yield config_data, client
+    client.stop()
+    thread.join(10)
+
+def test_authkey_is_random_and_private(tmp_path):
+    key = worker_authkey({"path_to_project_dir": str(tmp_path)})
+    path = tmp_path / "log" / "suite2p_worker.key"
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert worker_authkey({"path_to_project_dir": str(tmp_path)}) == key
+    assert worker_authkey({"path_to_project_dir": str(tmp_path / "other")}) != key
+
+def test_silent_client_does_not_block_others(worker):
+    config_data, client = worker
+    address = (config_data["suite2p_worker"].get("host", "127.0.0.1"), config_data["suite2p_worker"]["port"])
+    with socket.create_connection(address):
+        assert client.ping()["ok"]
+        assert client.run_s2p({"save_path0": "x"}, {})["ok"]
+
+def test_wrong_authkey_is_rejected(worker):
+    config_data, client = worker
+    with pytest.raises(AuthenticationError):
+        Client(("127.0.0.1", config_data["suite2p_worker"]["port"]), authkey=b"process2p")
+    assert client.ping()["ok"]
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from traces import compute_plane_traces, maximin_baseline, percentile_baseline
+
+SETTINGS = {"neuropil_coefficient": 0.7, "window_seconds": 2, "sigma_seconds": 0.5, "percentile": 8, "min_baseline": 1}
+
+def save_plane(plane_path, F, Fneu):
+    plane_path.mkdir()
+    np.save(plane_path / "F.npy", F.astype(np.float32))
+    np.save(plane_path / "Fneu.npy", Fneu.astype(np.float32))
+
+@pytest.mark.parametrize("method", ["maximin", "percentile"])
+def test_constant_trace_has_zero_dff(tmp_path, method):
+    save_plane(tmp_path / "plane0", np.full((3, 200), 500.0), np.full((3, 200), 100.0))
+    compute_plane_traces(tmp_path / "plane0", dict(SETTINGS, baseline=method), fs=10)
+    np.testing.assert_allclose(np.load(tmp_path / "plane0" / "Fcorr.npy"), 430)
+    np.testing.assert_allclose(np.load(tmp_path / "plane0" / "dff.npy"), 0, atol=1e-6)
+
+def test_blocks_of_rois_give_the_same_traces(tmp_path):
+    rng = np.random.default_rng(0)
+    F, Fneu = rng.normal(500, 50, (5, 300)), rng.normal(100, 10, (5, 300))
+    save_plane(tmp_path / "plane0", F, Fneu)
+    compute_plane_traces(tmp_path / "plane0", dict(SETTINGS, baseline="maximin"), fs=10, chunk_rois=2)
+    blocks = np.load(tmp_path / "plane0" / "dff.npy")
+    compute_plane_traces(tmp_path / "plane0", dict(SETTINGS, baseline="maximin"), fs=10)
+    np.testing.assert_array_equal(np.load(tmp_path / "plane0" / "dff.npy"), blocks)
+
+def test_maximin_baseline_matches_sliding_min_and_max():
+    F = np.random.default_rng(0).normal(size=(2, 50))
+    window = 5
+    # scipy's filters repeat the edge frame, as numpy's symmetric padding does
+    padded = np.pad(F, ((0, 0), (2, 2)), mode="symmetric")
+    minimum = np.stack([padded[:, i:i + window].min(axis=1) for i in range(50)], axis=1)
+    padded = np.pad(minimum, ((0, 0), (2, 2)), mode="symmetric")
+    maximum = np.stack([padded[:, i:i + window].max(axis=1) for i in range(50)], axis=1)
+    np.testing.assert_allclose(maximin_baseline(F, window, 0), maximum)
+
+def test_percentile_baseline_matches_per_frame_percentile():
+    F = np.random.default_rng(0).normal(size=(3, 40))
+    window = 9
+    padded = np.pad(F, ((0, 0), (4, 4)), mode="reflect")
+    expected = np.stack([np.percentile(padded[:, i:i + window], 8, axis=1) for i in range(40)], axis=1)
+    np.testing.assert_allclose(percentile_baseline(F, window, 8, step=1), expected)
+    # windows computed every few frames stay close
+    assert np.abs(percentile_baseline(F, window, 8, step=3) - expected).max() < 1
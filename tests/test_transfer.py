@@ -0,0 +1,69 @@
+import os
+
+from transfer import LocalBackend, get_backend
+
+def test_copy_batch_reports_each_file(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    (remote / "events.csv").write_text("0.5\n")
+    (remote / "frames.csv").write_text("0.1\n")
+    backend = get_backend({"storage": {"backend": "local", "parallelism": 2}})
+    pairs = [(str(remote / name), str(tmp_path / "local" / name)) for name in ["events.csv", "missing.csv", "frames.csv"]]
+
+    results = backend.copy_batch(pairs)
+    assert [r.remote for r in results] == [p[0] for p in pairs]
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[1].message
+    assert (tmp_path / "local" / "frames.csv").read_text() == "0.1\n"
+
+class FlakyBackend(LocalBackend):
+    # copies only part of the file on the first attempts, as an interrupted transfer would
+    def __init__(self, failures, **kwargs):
+        super().__init__(backoff=0, **kwargs)
+        self.failures = failures
+        self.offsets = []
+
+    def fetch(self, remote, part):
+        self.offsets.append(os.path.getsize(part) if os.path.isfile(part) else 0)
+        if len(self.offsets) <= self.failures:
+            with open(remote, "rb") as src, open(part, "ab") as dst:
+                src.seek(self.offsets[-1])
+                dst.write(src.read(100))
+            raise OSError("connection reset")
+        super().fetch(remote, part)
+
+def test_download_retries_and_resumes(tmp_path):
+    remote, local = tmp_path / "scan.tif", tmp_path / "local" / "scan.tif"
+    data = os.urandom(1000)
+    remote.write_bytes(data)
+
+    backend = FlakyBackend(failures=2, retries=3)
+    result = backend.download(str(remote), str(local))
+    assert result.ok and result.attempts == 3
+    # each attempt carries on from the partial file
+    assert backend.offsets == [0, 100, 200]
+    assert local.read_bytes() == data
+    assert not os.path.exists(f"{local}.part")
+
+def test_failed_download_leaves_no_local_file(tmp_path):
+    remote, local = tmp_path / "scan.tif", tmp_path / "local" / "scan.tif"
+    remote.write_bytes(os.urandom(1000))
+
+    result = FlakyBackend(failures=5, retries=1).download(str(remote), str(local))
+    assert not result.ok and result.attempts == 2
+    assert "connection reset" in result.message
+    assert not local.exists()
+
+def test_download_is_verified_against_remote_md5(tmp_path):
+    remote, local = tmp_path / "scan.tif", tmp_path / "local" / "scan.tif"
+    remote.write_bytes(os.urandom(1000))
+
+    class CorruptBackend(LocalBackend):
+        def stat(self, remote):
+            return 1000, "0" * 32
+
+    result = CorruptBackend(retries=1, backoff=0, verify_md5=True).download(str(remote), str(local))
+    assert not result.ok and result.message == "md5 does not match remote"
+    assert not local.exists()
+    # the bad copy is thrown away rather than resumed
+    assert not os.path.exists(f"{local}.part")
@@ -0,0 +1,40 @@
+import numpy as np
+
+from trials import extract_session_trials, gather_trials, trial_indices, window_offsets
+
+def test_window_edges_are_nan():
+    traces = np.arange(20, dtype=np.float32)[None, :] + 100 * np.arange(2)[:, None]
+    offsets = window_offsets(0.3, 0.2, fs=10)
+    assert offsets.tolist() == [-3, -2, -1, 0, 1, 2]
+
+    # at the start, in the middle, at the end and outside the recording
+    index, inside = trial_indices([1, 10, 18, -1], offsets, n_frames=20)
+    trials = gather_trials(traces, index, inside)
+    nan = np.nan
+    np.testing.assert_array_equal(trials[1], [[nan, nan, 100, 101, 102, 103],
+                                              [107, 108, 109, 110, 111, 112],
+                                              [115, 116, 117, 118, 119, nan],
+                                              [nan] * 6])
+
+def test_incomplete_trials_are_kept_or_dropped(tmp_path):
+    np.save(tmp_path / "dff.npy", np.tile(np.arange(20, dtype=np.float32), (4, 1)))
+    np.savez(tmp_path / "behav_alignment.npz", event_frames=np.array([1, 10, 18, -1]),
+             column_trial=np.array(["a", "b", "b", "b"]))
+    (tmp_path / "nan").mkdir()
+    (tmp_path / "drop").mkdir()
+    settings = {"pre_seconds": 0.3, "post_seconds": 0.2, "event_column": None, "event_values": None, "out_of_range": "nan"}
+
+    shape = extract_session_trials([tmp_path / "dff.npy"], [np.array([0, 2])], tmp_path / "behav_alignment.npz",
+                                   tmp_path / "nan", settings, fs=10)
+    assert shape == (2, 4, 6)
+    with np.load(tmp_path / "nan" / "trials_info.npz") as info:
+        assert info["trial_complete"].tolist() == [False, True, False, False]
+        assert info["column_trial"].tolist() == ["a", "b", "b", "b"]
+
+    settings.update(out_of_range="drop", event_column="trial", event_values=["b"])
+    shape = extract_session_trials([tmp_path / "dff.npy"], [np.array([0, 2])], tmp_path / "behav_alignment.npz",
+                                   tmp_path / "drop", settings, fs=10)
+    assert shape == (2, 1, 6)
+    np.testing.assert_array_equal(np.load(tmp_path / "drop" / "trials.npy")[:, 0], [np.arange(7, 13)] * 2)
+    with np.load(tmp_path / "drop" / "trials_info.npz") as info:
+        assert info["trial_event"].tolist() == [1]